@@ -9,30 +9,22 @@ import torch
 import json
 import os
 import time
+import glob
+import random
+import queue
+import threading
 import numpy as np
-from typing import List, Dict
+from typing import List, Dict, Callable
 from Constants import *
 
 
-class ProparaDataset(torch.utils.data.Dataset):
-
-    def __init__(self, data_path: str, is_test: bool):
-        super(ProparaDataset, self).__init__()
-
-        print('[INFO] Starting load...')
-        print(f'[INFO] Load data from {data_path}')
-        start_time = time.time()
-
-        self.dataset = json.load(open(data_path, 'r', encoding='utf-8'))
-        self.state2idx = state2idx
-        self.idx2state = idx2state
-        self.is_test = is_test
-
-        print(f'[INFO] {len(self.dataset)} instances of data loaded. Time Elapse: {time.time() - start_time}s')
-
-    
-    def __len__(self):
-        return len(self.dataset)
+class ProparaInstanceReader:
+    """
+    Converts a raw JSON instance into the tensors consumed by the model.
+    Shared by the in-memory dataset and the streaming dataset.
+    """
+    state2idx = state2idx
+    idx2state = idx2state
 
 
     def get_mask(self, mention_idx: List[int], para_len: int) -> List[int]:
@@ -43,9 +35,7 @@ class ProparaDataset(torch.utils.data.Dataset):
         return [1 if i in mention_idx else 0 for i in range(para_len)]
 
 
-    def __getitem__(self, index: int):
-
-        instance = self.dataset[index]
+    def build_sample(self, instance: Dict) -> Dict:
 
         entity_name = instance['entity']  # used in the evaluation process
         para_id = instance['id']  # used in the evaluation process
@@ -59,21 +49,26 @@ class ProparaDataset(torch.utils.data.Dataset):
                     'total_sents': total_sents,
                     'total_loc_cands': total_loc_cands,
                     'loc_cand_list': loc_cand_list,
-                    'raw_gold_loc': instance['gold_loc_seq']
+                    'raw_gold_loc': instance.get('gold_loc_seq')
                     }
         paragraph = instance['paragraph'].strip().split()  # Elmo processes list of words     
         assert len(paragraph) == total_tokens
-        gold_state_seq = torch.IntTensor([self.state2idx[label] for label in instance['gold_state_seq']])
 
-        loc2idx = {loc_cand_list[idx]: idx for idx in range(total_loc_cands)}
-        loc2idx['-'] = NIL_LOC
-        loc2idx['?'] = UNK_LOC
-        # note that the loc_cand_list in exactly "idx2loc" (excluding '?' and '-')
+        if 'gold_state_seq' in instance:
+            gold_state_seq = torch.IntTensor([self.state2idx[label] for label in instance['gold_state_seq']])
+
+            loc2idx = {loc_cand_list[idx]: idx for idx in range(total_loc_cands)}
+            loc2idx['-'] = NIL_LOC
+            loc2idx['?'] = UNK_LOC
+            # note that the loc_cand_list in exactly "idx2loc" (excluding '?' and '-')
 
-        # for train and dev sets, all gold locations should have been included in candidate set
-        # for test set, the gold location may not in the candidate set
-        gold_loc_seq = torch.IntTensor([loc2idx[loc] if (loc in loc_cand_list or loc in ['-', '?']) else UNK_LOC
-                                            for loc in instance['gold_loc_seq'][1:]])
+            # for train and dev sets, all gold locations should have been included in candidate set
+            # for test set, the gold location may not in the candidate set
+            gold_loc_seq = torch.IntTensor([loc2idx[loc] if (loc in loc_cand_list or loc in ['-', '?']) else UNK_LOC
+                                                for loc in instance['gold_loc_seq'][1:]])
+        else:  # unlabeled data for inference only, the gold sequences are all padding
+            gold_state_seq = torch.IntTensor([PAD_STATE] * total_sents)
+            gold_loc_seq = torch.IntTensor([PAD_LOC] * total_sents)
 
         assert gold_loc_seq.size() == gold_state_seq.size()
         sentence_list = instance['sentence_list']
@@ -101,6 +96,216 @@ class ProparaDataset(torch.utils.data.Dataset):
         return sample
 
 
+class ProparaDataset(ProparaInstanceReader, torch.utils.data.Dataset):
+
+    def __init__(self, data_path: str, is_test: bool):
+        super(ProparaDataset, self).__init__()
+
+        print('[INFO] Starting load...')
+        print(f'[INFO] Load data from {data_path}')
+        start_time = time.time()
+
+        self.dataset = json.load(open(data_path, 'r', encoding='utf-8'))
+        self.is_test = is_test
+
+        print(f'[INFO] {len(self.dataset)} instances of data loaded. Time Elapse: {time.time() - start_time}s')
+
+    
+    def __len__(self):
+        return len(self.dataset)
+
+
+    def __getitem__(self, index: int):
+        return self.build_sample(self.dataset[index])
+
+
+    def vocabulary(self) -> List[str]:
+        """
+        All distinct words of the paragraphs, e.g. to precompute the Elmo word cache.
+        """
+        return sorted({word for instance in self.dataset for word in instance['paragraph'].strip().split()})
+
+
+class PreprocessedDataset(torch.utils.data.Dataset):
+    """
+    The samples of a ProparaDataset, built once and kept in memory, e.g. to be shared by the trials of a sweep.
+    The tensors of each field are concatenated into one flat tensor and samples are views of it, so share_memory
+    moves a few large tensors (instead of one per sample) to shared memory, which other processes then map
+    instead of copying. The samples are read-only: Collate pads them into new tensors.
+    """
+    tensor_fields = ['gold_loc_seq', 'gold_state_seq', 'entity_mask', 'verb_mask', 'loc_mask']
+
+    def __init__(self, dataset: ProparaDataset):
+        super(PreprocessedDataset, self).__init__()
+        samples = [dataset[i] for i in range(len(dataset))]
+        self.words = dataset.vocabulary()
+        self.others = [{key: value for key, value in sample.items() if key not in self.tensor_fields} for sample in samples]
+        self.sizes = {key: [sample[key].size() for sample in samples] for key in self.tensor_fields}
+        self.offsets = {key: np.cumsum([0] + [sample[key].numel() for sample in samples]).tolist() for key in self.tensor_fields}
+        self.tensors = {key: torch.cat([sample[key].reshape(-1) for sample in samples]) for key in self.tensor_fields}
+
+
+    def share_memory(self) -> 'PreprocessedDataset':
+        for tensor in self.tensors.values():
+            tensor.share_memory_()
+        return self
+
+
+    def __len__(self):
+        return len(self.others)
+
+
+    def __getitem__(self, index: int):
+        sample = dict(self.others[index])  # Collate replaces the fields of the sample
+        for key in self.tensor_fields:
+            start, end = self.offsets[key][index], self.offsets[key][index + 1]
+            sample[key] = self.tensors[key][start:end].view(self.sizes[key][index])
+        return sample
+
+
+    def vocabulary(self) -> List[str]:
+        return self.words
+
+
+class ProparaIterableDataset(ProparaInstanceReader, torch.utils.data.IterableDataset):
+    """
+    Streaming variant of ProparaDataset, which reads instances lazily from JSONL files (one instance per line)
+    instead of loading the whole split into memory.
+    data_path can be a single JSONL file, a directory of shards, or a glob pattern (e.g. data/train/*.jsonl).
+    Shards are assigned to DataLoader workers, and instances are shuffled through a fixed-size buffer.
+    Shard order and buffer shuffling are seeded by (seed, epoch, worker_id), so every run is reproducible.
+    """
+    def __init__(self, data_path: str, is_test: bool, shuffle_buffer: int = 0, seed: int = 1234):
+        super(ProparaIterableDataset, self).__init__()
+
+        self.shard_files = self.find_shards(data_path)
+        self.is_test = is_test
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.shard_sizes = None
+
+        print(f'[INFO] Streaming data from {len(self.shard_files)} shard(s) in {data_path}')
+
+
+    def find_shards(self, data_path: str) -> List[str]:
+        """
+        Expand data_path to a sorted list of shard files.
+        """
+        if os.path.isdir(data_path):
+            shard_files = [os.path.join(data_path, name) for name in os.listdir(data_path) if name.endswith('.jsonl')]
+        else:
+            shard_files = glob.glob(data_path)
+
+        if not shard_files:
+            raise FileNotFoundError(f'No JSONL shard found in {data_path}')
+        return sorted(shard_files)
+
+
+    def set_epoch(self, epoch: int):
+        """
+        Change the shuffling order. Should be called before iterating over the dataset in each epoch.
+        """
+        self.epoch = epoch
+
+
+    def count_instances(self) -> Dict[str, int]:
+        """
+        Number of instances in each shard. Counting lines only scans the files, instances are not parsed.
+        """
+        if self.shard_sizes is None:
+            self.shard_sizes = {}
+            for shard in self.shard_files:
+                with open(shard, 'r', encoding='utf-8') as shard_file:
+                    self.shard_sizes[shard] = sum(1 for line in shard_file if line.strip())
+        return self.shard_sizes
+
+
+    def __len__(self):
+        """
+        Number of instances of an epoch, NOT the number of batches: the len() of a DataLoader over this dataset
+        ignores the partial batches of the workers, use num_batches instead.
+        """
+        return sum(self.count_instances().values())
+
+
+    def num_batches(self, batch_size: int, num_workers: int) -> int:
+        """
+        Number of batches of the current epoch when loaded by num_workers DataLoader workers (0 for the main process).
+        Every worker batches its own instances, so each of them yields a last partial batch.
+        """
+        num_workers = max(num_workers, 1)
+        shard_files = self.epoch_shards()
+        if len(shard_files) >= num_workers:
+            shard_sizes = self.count_instances()
+            worker_sizes = [sum(shard_sizes[shard] for shard in shard_files[worker_id::num_workers])
+                            for worker_id in range(num_workers)]
+        else:
+            total_instances = len(self)
+            worker_sizes = [total_instances // num_workers + (worker_id < total_instances % num_workers)
+                            for worker_id in range(num_workers)]
+        return sum((size + batch_size - 1) // batch_size for size in worker_sizes)
+
+
+    def epoch_shards(self) -> List[str]:
+        """
+        The shards in the order of the current epoch, which is the same in all workers.
+        """
+        shard_files = list(self.shard_files)
+        if self.shuffle_buffer > 1:
+            random.Random(f'{self.seed}-{self.epoch}').shuffle(shard_files)
+        return shard_files
+
+
+    def read_instances(self, worker_id: int, num_workers: int):
+        """
+        Yield the raw instances that belong to this worker.
+        If there are enough shards, each worker reads its own shards;
+        otherwise all workers read all shards and take every num_workers-th instance.
+        """
+        shard_files = self.epoch_shards()
+        split_by_shard = len(shard_files) >= num_workers
+        if split_by_shard:
+            shard_files = shard_files[worker_id::num_workers]
+
+        line_idx = 0
+        for shard in shard_files:
+            with open(shard, 'r', encoding='utf-8') as shard_file:
+                for line in shard_file:
+                    if not line.strip():
+                        continue
+                    if split_by_shard or line_idx % num_workers == worker_id:
+                        yield json.loads(line)
+                    line_idx += 1
+
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+
+        instances = self.read_instances(worker_id = worker_id, num_workers = num_workers)
+        if self.shuffle_buffer <= 1:
+            for instance in instances:
+                yield self.build_sample(instance)
+            return
+
+        rng = random.Random(f'{self.seed}-{self.epoch}-{worker_id}')
+        buffer = []
+        for instance in instances:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(instance)
+                continue
+            # emit a random instance from the buffer and put the new one in its place
+            idx = rng.randrange(self.shuffle_buffer)
+            yield self.build_sample(buffer[idx])
+            buffer[idx] = instance
+
+        rng.shuffle(buffer)
+        for instance in buffer:
+            yield self.build_sample(instance)
+
+
 # For paragraphs, we pad them to the max number of tokens in a batch
 # For sentences, we pad them to the max number of sentences in a batch
 # For location candidates, we pad them to the max number of location candidates in a batch
@@ -218,3 +423,104 @@ class Collate:
         return torch.cat([vec, pad_vec], dim = dim)
 
         
+
+
+class BatchPrefetcher:
+    """
+    Iterate over the batches of a DataLoader, with the model inputs of the next batches prepared on a background thread
+    while the current batch is computed: character ids of the paragraphs, number of candidates and sentences of
+    each instance, and all tensors moved to GPU (on a side CUDA stream). At most queue_size batches are prepared ahead.
+    wait_time accumulates the time the loop spent blocked waiting for a batch, and char_ids_time is the time
+    the character ids of the last returned batch took to compute (on the background thread).
+    """
+    tensor_fields = ['char_paragraph', 'entity_mask', 'verb_mask', 'loc_mask',
+                     'gold_loc_seq', 'gold_state_seq', 'num_cands', 'num_sents']
+
+    def __init__(self, loader: torch.utils.data.DataLoader, to_char_ids: Callable, cuda: bool, queue_size: int = 2):
+        assert queue_size >= 1
+        self.loader = loader
+        self.to_char_ids = to_char_ids
+        self.cuda = cuda
+        self.queue_size = queue_size
+        self.stream = torch.cuda.Stream() if cuda else None
+        self.wait_time = 0
+        self.char_ids_time = 0
+
+
+    def __len__(self):
+        return len(self.loader)
+
+
+    def __iter__(self):
+        batch_queue = queue.Queue(maxsize = self.queue_size)
+        stop = threading.Event()
+        worker = threading.Thread(target = self.produce, args = (batch_queue, stop), daemon = True)
+        worker.start()
+
+        try:
+            while True:
+                wait_start_time = time.time()
+                kind, item = batch_queue.get()
+                self.wait_time += time.time() - wait_start_time
+
+                if kind == 'end':
+                    return
+                if kind == 'error':
+                    raise item
+                batch, copied, self.char_ids_time = item
+                if copied is not None:  # make the current stream wait for the copies, which own the memory from now on
+                    current_stream = torch.cuda.current_stream()
+                    current_stream.wait_event(copied)
+                    for key in self.tensor_fields:
+                        batch[key].record_stream(current_stream)
+                yield batch
+        finally:  # also reached when the loop is left early
+            stop.set()
+
+
+    def produce(self, batch_queue: queue.Queue, stop: threading.Event):
+        try:
+            for batch in self.loader:
+                if not self.put(batch_queue, stop, ('batch', self.prepare(batch))):
+                    return
+        except Exception as e:
+            self.put(batch_queue, stop, ('error', e))
+            return
+        self.put(batch_queue, stop, ('end', None))
+
+
+    @staticmethod
+    def put(batch_queue: queue.Queue, stop: threading.Event, item) -> bool:
+        """
+        Put an item in the queue, give up if the consumer has stopped. Return whether the item was put.
+        """
+        while not stop.is_set():
+            try:
+                batch_queue.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+    def prepare(self, batch: Dict):
+        """
+        Add the model inputs that are not built by Collate, and move the tensors to GPU.
+        Return the batch, a CUDA event that marks the end of the copies (None on CPU), and the time of to_char_ids.
+        """
+        metadata = batch['metadata']
+        start_time = time.time()
+        batch['char_paragraph'] = self.to_char_ids(batch['paragraph'])
+        char_ids_time = time.time() - start_time
+        batch['num_cands'] = torch.IntTensor([meta['total_loc_cands'] for meta in metadata])
+        batch['num_sents'] = torch.IntTensor([meta['total_sents'] for meta in metadata])
+
+        if not self.cuda:
+            return batch, None, char_ids_time
+
+        with torch.cuda.stream(self.stream):
+            for key in self.tensor_fields:
+                batch[key] = batch[key].pin_memory().cuda(non_blocking = True)
+            copied = torch.cuda.Event()
+            copied.record(self.stream)
+        return batch, copied, char_ids_time
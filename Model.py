@@ -11,17 +11,19 @@ import json
 import os
 import time
 import numpy as np
-from typing import List, Dict
+from typing import List, Dict, Tuple, Optional, Union
 from Constants import *
 from utils import *
-from allennlp.modules.elmo import Elmo
+from allennlp.modules.elmo import Elmo, _ElmoBiLm
+from allennlp.nn.util import remove_sentence_boundaries, add_sentence_boundary_token_ids
 from torchcrf import CRF
+from profiling import PhaseProfiler
 import argparse
 
 
 class NCETModel(nn.Module):
 
-    def __init__(self, opt: argparse.Namespace, is_test: bool):
+    def __init__(self, opt: argparse.Namespace, is_test: bool, elmo_bilm: nn.Module = None, word_cache: 'ElmoWordCache' = None):
 
         super(NCETModel, self).__init__()
         self.opt = opt
@@ -29,30 +31,40 @@ class NCETModel(nn.Module):
         self.embed_size = opt.embed_size
 
         self.EmbeddingLayer = NCETEmbedding(embed_size = opt.embed_size, elmo_dir = opt.elmo_dir,
-                                            dropout = opt.dropout, elmo_dropout = opt.elmo_dropout)
+                                            dropout = opt.dropout, elmo_dropout = opt.elmo_dropout,
+                                            backend = opt.embedding, word_vectors = opt.word_vectors,
+                                            word_cache = word_cache if word_cache is not None else getattr(opt, 'elmo_cache', False),
+                                            elmo_bilm = elmo_bilm)
         self.TokenEncoder = nn.LSTM(input_size = opt.embed_size, hidden_size = opt.hidden_size,
                                     num_layers = 1, batch_first = True, bidirectional = True)
         self.Dropout = nn.Dropout(p = opt.dropout)
 
+        # entity mentions are pooled once and shared by both decoders
+        self.MaskedMean = MaskedMeanPooling()
+
         # state tracking modules
-        self.StateTracker = StateTracker(hidden_size = opt.hidden_size, dropout = opt.dropout)
-        self.CRFLayer = CRF(NUM_STATES, batch_first = True)
+        self.StateTracker = StateTracker(hidden_size = opt.hidden_size, dropout = opt.dropout, pooling = self.MaskedMean)
+        self.CRFLayer = BatchedCRF(NUM_STATES, batch_first = True)
 
         # location prediction modules
-        self.LocationPredictor = LocationPredictor(hidden_size = opt.hidden_size, dropout = opt.dropout)
+        self.LocationPredictor = LocationPredictor(hidden_size = opt.hidden_size, dropout = opt.dropout, pooling = self.MaskedMean)
         self.CrossEntropy = nn.CrossEntropyLoss(ignore_index = PAD_LOC, reduction = 'mean')
 
         self.is_test = is_test
-        
+        self.checkpoint_activations = getattr(opt, 'checkpoint_activations', False)  # a training option, not defined by the inference scripts
+        self.profiler = PhaseProfiler(enabled = False)  # replaced by -profile to time the phases of the model
+
 
     def forward(self, char_paragraph: torch.Tensor, entity_mask: torch.IntTensor, verb_mask: torch.IntTensor,
                 loc_mask: torch.IntTensor, gold_loc_seq: torch.IntTensor, gold_state_seq: torch.IntTensor,
-                num_cands: torch.IntTensor):
+                num_cands: torch.IntTensor, compute_metrics: bool = True):
         """
         Args:
             gold_loc_seq: size (batch, max_sents)
             gold_state_seq: size (batch, max_sents)
             num_cands: size(batch,)
+            compute_metrics: if False (training only), skip Viterbi decoding and accuracy computation,
+                             return None for the correct counts and the total counts as device tensors
         """
         assert entity_mask.size(-2) == verb_mask.size(-2) == loc_mask.size(-2) == gold_state_seq.size(-1) == gold_loc_seq.size(-1)
         assert entity_mask.size(-1) == verb_mask.size(-1) == loc_mask.size(-1) == char_paragraph.size(-2)
@@ -61,42 +73,218 @@ class NCETModel(nn.Module):
         max_sents = gold_state_seq.size(-1)
         max_cands = loc_mask.size(-3)
 
-        embeddings = self.EmbeddingLayer(char_paragraph, verb_mask)  # (batch, max_tokens, embed_size)
-        token_rep, _ = self.TokenEncoder(embeddings)  # (batch, max_tokens, 2*hidden_size)
-        token_rep = self.Dropout(token_rep)
+        token_rep = self.encode(char_paragraph, verb_mask)  # (batch, max_tokens, 2*hidden_size)
         assert token_rep.size() == (batch_size, max_tokens, 2 * self.hidden_size)
+        entity_rep = self.MaskedMean(source = token_rep, mask = entity_mask)  # (batch, max_sents, 2*hidden_size)
 
         # state cheng prediction
         # size (batch, max_sents, NUM_STATES)
-        tag_logits = self.StateTracker(encoder_out = token_rep, entity_mask = entity_mask, verb_mask = verb_mask)
+        with self.profiler.phase('StateTracker'):
+            tag_logits = self.StateTracker(encoder_out = token_rep, entity_rep = entity_rep, entity_mask = entity_mask, verb_mask = verb_mask)
         tag_mask = (gold_state_seq != PAD_STATE) # mask the padded part so they won't count in loss
-        log_likelihood = self.CRFLayer(emissions = tag_logits, tags = gold_state_seq.long(), mask = tag_mask, reduction = 'token_mean')
+        with self.profiler.phase('CRF loss'):
+            log_likelihood = self.CRFLayer(emissions = tag_logits, tags = gold_state_seq.long(), mask = tag_mask, reduction = 'token_mean')
 
         state_loss = -log_likelihood  # State classification loss is negative log likelihood
-        pred_state_seq = self.CRFLayer.decode(emissions=tag_logits, mask=tag_mask)
-        assert len(pred_state_seq) == batch_size
-        correct_state_pred, total_state_pred = compute_state_accuracy(pred=pred_state_seq, gold=gold_state_seq.tolist(),
-                                                        pad_value=PAD_STATE)
+        compute_metrics = compute_metrics or self.is_test  # predictions are always needed at test time
+        correct_state_pred, total_state_pred = None, torch.sum(tag_mask)  # number of tokens of the loss
+        if compute_metrics:
+            with self.profiler.phase('CRF decode'):
+                pred_state_seq = self.CRFLayer.viterbi_tags(emissions=tag_logits, mask=tag_mask)  # (batch, max_sents)
+            assert pred_state_seq.size() == (batch_size, max_sents)
+            correct_state_pred, total_state_pred = compute_state_accuracy(pred=pred_state_seq, gold=gold_state_seq,
+                                                            pad_value=PAD_STATE)
 
         # location prediction
         # size (batch, max_cands, max_sents)
-        loc_logits = self.LocationPredictor(encoder_out = token_rep, entity_mask = entity_mask, loc_mask = loc_mask)
-        loc_logits = loc_logits.transpose(-1, -2)  # size (batch, max_sents, max_cands)
-        masked_loc_logits = self.mask_loc_logits(loc_logits = loc_logits, num_cands = num_cands)  # (batch, max_sents, max_cands)
+        num_sents = torch.sum(tag_mask, dim = -1)  # (batch,)
+        with self.profiler.phase('LocationPredictor'):
+            masked_loc_logits = self.get_loc_logits(token_rep, entity_rep = entity_rep, loc_mask = loc_mask,
+                                                    num_cands = num_cands, num_sents = num_sents)  # (batch, max_sents, max_cands)
         masked_gold_loc_seq = self.mask_undefined_loc(gold_loc_seq = gold_loc_seq, mask_value = PAD_LOC)  # (batch, max_sents)
         loc_loss = self.CrossEntropy(input = masked_loc_logits.view(batch_size * max_sents, max_cands),
                                      target = masked_gold_loc_seq.view(batch_size * max_sents).long())
-        correct_loc_pred, total_loc_pred = compute_loc_accuracy(logits = masked_loc_logits, gold = masked_gold_loc_seq,
-                                                                pad_value = PAD_LOC)
+        correct_loc_pred, total_loc_pred = None, torch.sum(masked_gold_loc_seq != PAD_LOC)
+        if compute_metrics:
+            correct_loc_pred, total_loc_pred = compute_loc_accuracy(logits = masked_loc_logits, gold = masked_gold_loc_seq,
+                                                                    pad_value = PAD_LOC)
         # assert total_loc_pred > 0
 
         if self.is_test:  # inference
+            pred_state_seq = [unpad(inst, pad_value = PAD_STATE) for inst in pred_state_seq.tolist()]
             pred_loc_seq = get_pred_loc(loc_logits = masked_loc_logits, gold_loc_seq = gold_loc_seq)
             return pred_state_seq, pred_loc_seq, correct_state_pred, total_state_pred, correct_loc_pred, total_loc_pred
 
         return state_loss, loc_loss, correct_state_pred, total_state_pred, correct_loc_pred, total_loc_pred
 
 
+    def predict(self, char_paragraph: torch.Tensor, entity_mask: torch.IntTensor, verb_mask: torch.IntTensor,
+                loc_mask: torch.IntTensor, num_cands: torch.IntTensor, num_sents: torch.IntTensor, lazy_loc: bool = False,
+                loc_topk: int = 0, reset_states: bool = False):
+        """
+        Gold-free inference: only predict the state and location sequences, without computing any loss or metric.
+        Should be called in eval mode under torch.no_grad().
+        Args:
+            num_cands: number of location candidates of each instance, size (batch,)
+            num_sents: number of sentences of each instance, size (batch,)
+            lazy_loc: if True, only predict the locations that are kept by predict_consistent_loc (see predict_loc_lazily)
+            loc_topk: if positive, only keep the loc_topk best candidates of each instance by a cheap pre-ranking
+                      (see rank_candidates) before running LocationPredictor
+            reset_states: if True, Elmo starts from zero states instead of the final states of the previous batch,
+                          like the exported models (see ScriptModel.py)
+        Return:
+            pred_state_seq: predicted state indices padded with PAD_STATE, size (batch, max_sents)
+            pred_loc_seq: predicted candidate indices padded with PAD_LOC, size (batch, max_sents)
+        """
+        assert entity_mask.size(-2) == verb_mask.size(-2) == loc_mask.size(-2)
+        assert entity_mask.size(-1) == verb_mask.size(-1) == loc_mask.size(-1) == char_paragraph.size(-2)
+        max_sents = entity_mask.size(-2)
+
+        if reset_states:
+            self.EmbeddingLayer.reset_states()
+        token_rep = self.encode(char_paragraph, verb_mask)  # (batch, max_tokens, 2*hidden_size)
+        entity_rep = self.MaskedMean(source = token_rep, mask = entity_mask)  # (batch, max_sents, 2*hidden_size)
+
+        with self.profiler.phase('StateTracker'):
+            tag_logits = self.StateTracker(encoder_out = token_rep, entity_rep = entity_rep, entity_mask = entity_mask, verb_mask = verb_mask)
+        tag_mask = get_length_mask(lengths = num_sents, max_len = max_sents)  # (batch, max_sents)
+        # Viterbi decoding always runs in fp32, even if the rest of the model is in reduced precision
+        with self.profiler.phase('CRF decode'):
+            pred_state_seq = self.CRFLayer.viterbi_tags(emissions = tag_logits.float(), mask = tag_mask)
+        kept_cands = None
+        if 0 < loc_topk < loc_mask.size(-3):
+            with self.profiler.phase('candidate ranking'):
+                kept_cands = self.select_candidates(token_rep, entity_mask = entity_mask, loc_mask = loc_mask,
+                                                    num_cands = num_cands, k = loc_topk)  # (batch, loc_topk)
+            loc_mask = loc_mask.gather(dim = 1, index = kept_cands[:, :, None, None].expand(-1, -1, *loc_mask.size()[2:]))
+            num_cands = torch.clamp(num_cands, max = loc_topk)
+
+        with self.profiler.phase('LocationPredictor'):
+            if lazy_loc:
+                pred_loc_seq = self.predict_loc_lazily(token_rep, entity_rep = entity_rep, loc_mask = loc_mask, num_cands = num_cands,
+                                                       num_sents = num_sents, pred_state_seq = pred_state_seq)
+            else:
+                masked_loc_logits = self.get_loc_logits(token_rep, entity_rep = entity_rep, loc_mask = loc_mask,
+                                                        num_cands = num_cands, num_sents = num_sents)  # (batch, max_sents, max_cands)
+                pred_loc_seq = torch.argmax(masked_loc_logits.float(), dim = -1).masked_fill(~tag_mask, value = PAD_LOC)
+
+        if kept_cands is not None:  # map the indices among the kept candidates back to the original candidates
+            pred_loc_seq = torch.where(pred_loc_seq >= 0, kept_cands.gather(dim = 1, index = pred_loc_seq.clamp(min = 0)), pred_loc_seq)
+
+        return pred_state_seq, pred_loc_seq
+
+
+    def rank_candidates(self, token_rep, entity_mask: torch.IntTensor, loc_mask: torch.IntTensor, num_cands: torch.IntTensor):
+        """
+        Cheap, parameter-free pre-ranking of the location candidates: the dot product of the mean representation of
+        all mentions of the entity and the mean representation of all mentions of each candidate.
+        Return:
+            scores - padded candidates are -inf, size (batch, max_cands)
+        """
+        entity_mentions = torch.gt(torch.sum(entity_mask, dim = 1, keepdim = True), 0)  # (batch, 1, max_tokens)
+        cand_mentions = torch.gt(torch.sum(loc_mask, dim = 2), 0)  # (batch, max_cands, max_tokens)
+        entity_rep = self.MaskedMean(source = token_rep, mask = entity_mentions)  # (batch, 1, 2*hidden_size)
+        cand_rep = self.MaskedMean(source = token_rep, mask = cand_mentions)  # (batch, max_cands, 2*hidden_size)
+
+        scores = torch.bmm(cand_rep.float(), entity_rep.float().transpose(1, 2)).squeeze(dim = -1)  # (batch, max_cands)
+        valid_cands = get_length_mask(lengths = num_cands, max_len = scores.size(-1))
+        return scores.masked_fill(~valid_cands, value = float('-inf'))
+
+
+    def select_candidates(self, token_rep, entity_mask: torch.IntTensor, loc_mask: torch.IntTensor, num_cands: torch.IntTensor, k: int):
+        """
+        Indices of the k best candidates of each instance by rank_candidates, in their original order,
+        so the real candidates of an instance with fewer than k candidates come first.
+        Return:
+            kept_cands - size (batch, k)
+        """
+        scores = self.rank_candidates(token_rep, entity_mask = entity_mask, loc_mask = loc_mask, num_cands = num_cands)
+        kept_cands = torch.topk(scores, k = k, dim = -1)[1]
+        return torch.sort(kept_cands, dim = -1)[0]
+
+
+    def predict_loc_lazily(self, token_rep, entity_rep, loc_mask: torch.IntTensor, num_cands: torch.IntTensor,
+                           num_sents: torch.Tensor, pred_state_seq: torch.Tensor):
+        """
+        Location predictions are only kept at the steps whose predicted state is C or M (see predict_consistent_loc),
+        so LocationPredictor only runs for the entities that have such a step, and only the logits of these steps are used.
+        Return:
+            pred_loc_seq: predicted candidate indices at C/M steps, UNK_LOC (no prediction) at the other steps,
+                          padded with PAD_LOC, size (batch, max_sents)
+        """
+        needs_loc = find_loc_steps(pred_state_seq)  # (batch, max_sents)
+        pred_loc_seq = torch.full_like(pred_state_seq, UNK_LOC).masked_fill(pred_state_seq == PAD_STATE, value = PAD_LOC)
+        active = needs_loc.any(dim = -1).nonzero().squeeze(dim = -1)  # entities that need a location, (num_active,)
+        if active.size(0) == 0:
+            return pred_loc_seq
+
+        active_cands = num_cands[active]
+        max_cands = active_cands.max().item()
+        # size (num_active, max_sents, max_cands of the active entities)
+        masked_loc_logits = self.get_loc_logits(token_rep[active], entity_rep = entity_rep[active],
+                                                loc_mask = loc_mask[active][:, :max_cands], num_cands = active_cands,
+                                                num_sents = num_sents[active])
+
+        entity_idx, sent_idx = needs_loc[active].nonzero().unbind(dim = -1)
+        step_logits = masked_loc_logits[entity_idx, sent_idx]  # (num_steps, max_cands)
+        pred_loc_seq[active[entity_idx], sent_idx] = torch.argmax(step_logits.float(), dim = -1)
+        return pred_loc_seq
+
+
+    def encode(self, char_paragraph: torch.Tensor, verb_mask: torch.IntTensor):
+        """
+        Embed and encode the paragraphs.
+        Return:
+            token_rep - size (batch, max_tokens, 2*hidden_size)
+        """
+        with self.profiler.phase('embedding'):
+            backend_outputs = self.EmbeddingLayer.run_frozen(char_paragraph)
+            embeddings = self.run_block(self.EmbeddingLayer.project, verb_mask, *backend_outputs)  # (batch, max_tokens, embed_size)
+        num_tokens = count_tokens(char_paragraph)  # (batch,)
+        with self.profiler.phase('TokenEncoder'):
+            token_rep = self.run_block(self.encode_embeddings, embeddings, num_tokens)  # (batch, max_tokens, 2*hidden_size)
+        return token_rep
+
+
+    def encode_embeddings(self, embeddings, num_tokens: torch.Tensor):
+        token_rep = self.encode_tokens(embeddings, num_tokens = num_tokens)
+        return self.Dropout(token_rep)
+
+
+    def get_loc_logits(self, token_rep, entity_rep, loc_mask: torch.IntTensor, num_cands: torch.IntTensor, num_sents: torch.Tensor):
+        """
+        Score every location candidate in every sentence, padded candidates are masked to -inf.
+        Return:
+            masked_loc_logits - size (batch, max_sents, max_cands)
+        """
+        # size (batch, max_cands, max_sents)
+        loc_logits = self.run_block(self.LocationPredictor, token_rep, entity_rep, loc_mask, num_cands, num_sents)
+        loc_logits = loc_logits.transpose(-1, -2)  # size (batch, max_sents, max_cands)
+        masked_loc_logits = self.mask_loc_logits(loc_logits = loc_logits, num_cands = num_cands)  # (batch, max_sents, max_cands)
+        return masked_loc_logits
+
+
+    def run_block(self, block, *inputs: torch.Tensor):
+        """
+        Run a block of the model. With -checkpoint_activations, the activations inside the block are not stored
+        during training, but recomputed in the backward pass, which trades extra computation for a lower peak memory.
+        """
+        if self.checkpoint_activations and self.training and torch.is_grad_enabled():
+            return checkpoint_block(block, *inputs)
+        return block(*inputs)
+
+
+    def encode_tokens(self, embeddings, num_tokens: torch.Tensor):
+        """
+        Run TokenEncoder over the real tokens of each paragraph, the same in training and inference.
+        The outputs of padded tokens are all-zero.
+        Args:
+            embeddings - size (batch, max_tokens, embed_size)
+            num_tokens - number of real tokens in each paragraph, size (batch,)
+        """
+        return run_packed_lstm(self.TokenEncoder, inputs = embeddings, lengths = num_tokens)
+
+
     def mask_loc_logits(self, loc_logits, num_cands: torch.IntTensor):
         """
         Mask the padded candidates with an -inf score, so they will have a likelihood = 0 after softmax
@@ -110,9 +298,7 @@ class NCETModel(nn.Module):
         max_cands = loc_logits.size(-1)
 
         # first, we create a mask tensor that masked all positions above the num_cands limit
-        range_tensor = torch.arange(start = 1, end = max_cands + 1)
-        if not self.opt.no_cuda:
-            range_tensor = range_tensor.cuda()
+        range_tensor = torch.arange(start = 1, end = max_cands + 1, device = loc_logits.device)
         range_tensor = range_tensor.unsqueeze(dim = 0).expand(batch_size, max_cands)
         bool_range = torch.gt(range_tensor, num_cands.unsqueeze(dim = -1))  # find the off-limit positions
         assert bool_range.size() == (batch_size, max_cands)
@@ -138,16 +324,66 @@ class NCETModel(nn.Module):
 
     
 class NCETEmbedding(nn.Module):
-
-    def __init__(self, embed_size: int, elmo_dir: str, dropout: float, elmo_dropout: float):
+    """
+    Token embeddings (from one of the backends below, projected to embed_size - 1) + verb indicator.
+    elmo: allennlp's 2x4096 Elmo, frozen.
+    static: memory-mapped pre-trained word vectors + a small character CNN, see StaticEmbedding.
+    Both backends take the character ids of the paragraph, so the rest of the model does not depend on the choice.
+    word_cache can also be an already computed ElmoWordCache, and elmo_bilm an already loaded Elmo biLM (see build_bilm),
+    e.g. shared by the trials of a sweep.
+    """
+    def __init__(self, embed_size: int, elmo_dir: str, dropout: float, elmo_dropout: float,
+                 backend: str = 'elmo', word_vectors: str = None, word_cache: Union[bool, 'ElmoWordCache'] = False,
+                 elmo_bilm: nn.Module = None):
 
         super(NCETEmbedding, self).__init__()
         self.embed_size = embed_size
-        self.options_file = os.path.join(elmo_dir, 'elmo_2x4096_512_2048cnn_2xhighway_options.json')
-        self.weight_file = os.path.join(elmo_dir, 'elmo_2x4096_512_2048cnn_2xhighway_weights.hdf5')
-        self.elmo = Elmo(self.options_file, self.weight_file, num_output_representations=1, requires_grad=False,
-                            do_layer_norm=False, dropout=elmo_dropout)
-        self.embed_project = Linear(1024, self.embed_size - 1, dropout = dropout)  # 1024 is the default size of Elmo, leave 1 dim for verb indicator
+        self.backend = backend
+        if isinstance(word_cache, ElmoWordCache):
+            self.word_cache = word_cache
+        else:
+            self.word_cache = ElmoWordCache() if word_cache and backend == 'elmo' else None
+
+        if backend == 'elmo':
+            self.options_file, self.weight_file = self.elmo_files(elmo_dir)
+            # the random initialization of the biLM (overwritten by its weight file) does not consume the global RNG,
+            # so the trainable layers get the same initial weights whether the biLM is built here or shared (-mode sweep)
+            with torch.random.fork_rng(devices = []):
+                if elmo_bilm is None:
+                    self.elmo = Elmo(self.options_file, self.weight_file, num_output_representations=1, requires_grad=False,
+                                        do_layer_norm=False, dropout=elmo_dropout)
+                else:  # only the scalar mix is created, the frozen biLM is not loaded again
+                    self.elmo = Elmo(None, None, num_output_representations=1, do_layer_norm=False, dropout=elmo_dropout,
+                                     module=elmo_bilm)
+            if elmo_bilm is not None:
+                self.reset_states()  # left by the previous model of the biLM
+            self.backend_size = 1024  # 1024 is the default size of Elmo
+        elif backend == 'static':
+            if word_vectors is None:
+                raise ValueError('The static embedding backend needs word vectors, please specify -word_vectors')
+            self.static = StaticEmbedding(word_vectors, dropout = elmo_dropout)
+            self.backend_size = self.static.output_size
+        else:
+            raise ValueError(f'Unknown embedding backend: {backend}')
+
+        self.embed_project = Linear(self.backend_size, self.embed_size - 1, dropout = dropout)  # leave 1 dim for verb indicator
+
+
+    @staticmethod
+    def elmo_files(elmo_dir: str) -> Tuple[str, str]:
+        """
+        Paths of the options file and the weight file of Elmo.
+        """
+        return (os.path.join(elmo_dir, 'elmo_2x4096_512_2048cnn_2xhighway_options.json'),
+                os.path.join(elmo_dir, 'elmo_2x4096_512_2048cnn_2xhighway_weights.hdf5'))
+
+
+    @staticmethod
+    def build_bilm(elmo_dir: str) -> nn.Module:
+        """
+        Load the frozen biLM of Elmo alone, to be passed as elmo_bilm to several models.
+        """
+        return _ElmoBiLm(*NCETEmbedding.elmo_files(elmo_dir), requires_grad=False)
 
 
     def forward(self, char_paragraph: torch.Tensor, verb_mask: torch.IntTensor):
@@ -158,31 +394,121 @@ class NCETEmbedding(nn.Module):
         Return:
             embeddings - token embeddings, size (batch, max_tokens, embed_size)
         """
-        batch_size = char_paragraph.size(0)
-        max_tokens = char_paragraph.size(1)
+        return self.project(verb_mask, *self.run_frozen(char_paragraph))
+
+
+    def run_frozen(self, char_paragraph: torch.Tensor) -> List[torch.Tensor]:
+        """
+        Run the frozen part of the backend, which is never recomputed by activation checkpointing:
+        the biLM of Elmo (which also carries its LSTM states over batches), or the word vector lookup.
+        Return:
+            a list of tensors, the inputs of function "project"
+        """
+        if self.backend == 'elmo' and self.word_cache is not None:
+            return self.run_cached_bilm(char_paragraph)
+        if self.backend == 'elmo':
+            bilm_output = self.elmo._elmo_lstm(char_paragraph)
+            return bilm_output['activations'] + [bilm_output['mask']]
+        return [self.static.lookup_words(char_paragraph), char_paragraph]
 
-        elmo_embeddings = self.get_elmo(char_paragraph, batch_size = batch_size, max_tokens = max_tokens)
-        if self.embed_size != 1025:
-            elmo_embeddings = self.embed_project(elmo_embeddings)
-        verb_indicator = self.get_verb_indicator(verb_mask, batch_size = batch_size, max_tokens = max_tokens)
-        embeddings = torch.cat([elmo_embeddings, verb_indicator], dim = -1)
+
+    def run_cached_bilm(self, char_paragraph: torch.Tensor) -> List[torch.Tensor]:
+        """
+        Same as the forward pass of the Elmo biLM (_ElmoBiLm.forward), but the context-independent token embeddings
+        are gathered from the word cache instead of running the character CNN.
+        """
+        bilm = self.elmo._elmo_lstm
+        type_representation, mask = self.word_cache.lookup(char_paragraph, token_embedder = bilm._token_embedder)
+        lstm_outputs = bilm._elmo_lstm(type_representation, mask)
+
+        # the first layer is duplicated, as in _ElmoBiLm.forward
+        activations = [torch.cat([type_representation, type_representation], dim = -1) * mask.float().unsqueeze(-1)]
+        activations += [layer_activations.squeeze(0) for layer_activations in torch.chunk(lstm_outputs, lstm_outputs.size(0), dim = 0)]
+        return activations + [mask]
+
+
+    def cache_words(self, words: List[str]):
+        """
+        Precompute the cached token embeddings of the given words, e.g. the vocabulary of the dataset.
+        """
+        if self.word_cache is not None:
+            with torch.no_grad():
+                self.word_cache.add_words(batch_to_char_ids([words]).squeeze(dim = 0).tolist(),
+                                          token_embedder = self.elmo._elmo_lstm._token_embedder)
+
+
+    def project(self, verb_mask: torch.IntTensor, *backend_outputs: torch.Tensor):
+        """
+        Run the trainable part of the backend, project its outputs to embed_size - 1 and append the verb indicator.
+        """
+        if self.backend == 'elmo':
+            token_embeddings = self.mix_elmo(*backend_outputs)
+        else:
+            token_embeddings = self.static.combine(*backend_outputs)  # (batch, max_tokens, backend_size)
+        batch_size = token_embeddings.size(0)
+        max_tokens = token_embeddings.size(1)
+
+        # Elmo may return fp32 outputs when the model is converted to a reduced precision, cast them back
+        dtype = next(self.parameters()).dtype
+        token_embeddings = token_embeddings.to(dtype)
+        if self.embed_size - 1 != self.backend_size:
+            token_embeddings = self.embed_project(token_embeddings)
+        verb_indicator = self.get_verb_indicator(verb_mask, batch_size = batch_size, max_tokens = max_tokens).to(dtype)
+        embeddings = torch.cat([token_embeddings, verb_indicator], dim = -1)
 
         assert embeddings.size() == (batch_size, max_tokens, self.embed_size)
         return embeddings
 
 
-    def get_elmo(self, char_paragraph: torch.Tensor, batch_size: int, max_tokens: int):
+    def mix_elmo(self, *bilm_output: torch.Tensor):
         """
-        Compute the Elmo embedding of the paragraphs.
+        Compute the Elmo embedding of the paragraphs from the outputs of the biLM, same as Elmo.forward:
+        trainable scalar mix of the layers, removal of the sentence boundaries and dropout.
+        Args:
+            bilm_output - activations of each biLM layer, size (batch, max_tokens + 2, 1024), followed by the mask
         Return:
             Elmo embeddings, size(batch, max_tokens, elmo_embed_size=1024)
         """
-        # embeddings['elmo_representations'] is a list of tensors with length 'num_output_representations' (here it = 1)
-        elmo_embeddings = self.elmo(char_paragraph)['elmo_representations'][0]  # (batch, max_tokens, elmo_embed_size=1024)
-        assert elmo_embeddings.size() == (batch_size, max_tokens, 1024)
-        return elmo_embeddings
+        *layer_activations, mask_with_bos_eos = bilm_output
+        representation_with_bos_eos = self.elmo.scalar_mix_0(layer_activations, mask_with_bos_eos)
+        elmo_embeddings, _ = remove_sentence_boundaries(representation_with_bos_eos, mask_with_bos_eos)
+        return self.elmo._dropout(elmo_embeddings)
 
     
+    def reset_states(self):
+        """
+        Clear the LSTM states that Elmo carries over from the previous batch. The static backend is stateless.
+        """
+        if self.backend == 'elmo':
+            self.elmo._elmo_lstm._elmo_lstm.reset_states()
+
+
+    def get_states(self) -> Optional[Tuple[torch.Tensor, ...]]:
+        """
+        The LSTM states that Elmo carries over to the next batch, None if there are none (or for the static backend).
+        """
+        if self.backend == 'elmo':
+            return self.elmo._elmo_lstm._elmo_lstm._states
+        return None
+
+
+    def set_states(self, states: Optional[Tuple[torch.Tensor, ...]]):
+        """
+        Restore the LSTM states returned by get_states, moved to the device of Elmo.
+        """
+        if self.backend == 'elmo':
+            device = next(self.elmo.parameters()).device
+            self.elmo._elmo_lstm._elmo_lstm._states = tuple(state.to(device) for state in states) if states is not None else None
+
+
+    def clear_word_cache(self):
+        """
+        Drop the cached token embeddings, which are stale after the weights of Elmo are converted (e.g. quantized).
+        """
+        if self.word_cache is not None:
+            self.word_cache = ElmoWordCache()
+
+
     def get_verb_indicator(self, verb_mask: torch.IntTensor, batch_size: int, max_tokens: int):
         """
         Get the binary scalar indicator for each token
@@ -192,11 +518,188 @@ class NCETEmbedding(nn.Module):
         return verb_indicator
 
 
+class ElmoWordCache:
+    """
+    Cache of the context-independent token embeddings of Elmo (character CNN + highway + projection), keyed by the
+    character ids of each word. These layers are frozen, so each word always gets the same embedding and only needs
+    to be computed once. Words that are not cached yet are computed and added on the fly.
+    The cache is not a part of the state dict.
+    """
+    def __init__(self):
+        self.word2idx = {}  # character ids of a word (tuple) -> row in self.embeddings
+        self.embeddings = None  # (num_words, projection_dim)
+        self.bos_embedding = None
+        self.eos_embedding = None
+
+
+    def lookup(self, char_paragraph: torch.Tensor, token_embedder: nn.Module):
+        """
+        Args:
+            char_paragraph - character ids of the paragraph, size (batch, max_tokens, max_chars)
+            token_embedder - the character encoder of the Elmo biLM, used for the words that are not cached yet
+        Return:
+            token embeddings with sentence boundaries, size (batch, max_tokens + 2, projection_dim)
+            mask with sentence boundaries, size (batch, max_tokens + 2)
+        """
+        batch_size, max_tokens, max_chars = char_paragraph.size()
+        device = next(token_embedder.parameters()).device
+        if self.embeddings is not None and self.embeddings.device != device:  # e.g. precomputed before model.cuda()
+            self.embeddings = self.embeddings.to(device)
+            self.bos_embedding, self.eos_embedding = self.bos_embedding.to(device), self.eos_embedding.to(device)
+
+        words, inverse = torch.unique(char_paragraph.view(-1, max_chars), dim = 0, return_inverse = True)
+        words = [tuple(char_ids) for char_ids in words.tolist()]
+        self.add_words(words, token_embedder = token_embedder)
+
+        word_idx = torch.tensor([self.word2idx[char_ids] for char_ids in words], device = device)
+        embeddings = self.embeddings[word_idx][inverse.to(device)].view(batch_size, max_tokens, -1)
+
+        mask = ((char_paragraph > 0).long().sum(dim = -1) > 0).long()  # same as _ElmoCharacterEncoder
+        return add_sentence_boundary_token_ids(embeddings, mask, self.bos_embedding, self.eos_embedding)
+
+
+    def share_memory(self) -> 'ElmoWordCache':
+        """
+        Move the cached embeddings to shared memory, e.g. to be used by other processes without copying.
+        add_words never writes into them, it replaces them by new tensors.
+        """
+        for tensor in (self.embeddings, self.bos_embedding, self.eos_embedding):
+            if tensor is not None:
+                tensor.share_memory_()
+        return self
+
+
+    def add_words(self, words: List[Tuple[int]], token_embedder: nn.Module, chunk_size: int = 1024):
+        """
+        Compute and cache the embeddings of words, each given by its character ids. Padding (all-zero ids) gets a zero vector.
+        """
+        words = [char_ids for char_ids in dict.fromkeys(map(tuple, words)) if char_ids not in self.word2idx]
+        real_words = [char_ids for char_ids in words if any(char_ids)]
+        paddings = [char_ids for char_ids in words if not any(char_ids)]
+        if not words:
+            return
+
+        weight = next(token_embedder.parameters())
+        new_embeddings = []
+        for start in range(0, len(real_words), chunk_size):
+            # the words of a chunk are embedded as one sequence, the character encoder adds the sentence boundaries around it
+            char_ids = torch.tensor(real_words[start: start + chunk_size], device = weight.device).unsqueeze(dim = 0)
+            token_embedding = token_embedder(char_ids)['token_embedding'].squeeze(dim = 0)  # (chunk_size + 2, projection_dim)
+            self.bos_embedding, self.eos_embedding = token_embedding[0], token_embedding[-1]
+            new_embeddings.append(token_embedding[1: -1])
+        new_embeddings.append(weight.new_zeros(len(paddings), token_embedder.get_output_dim()))
+        new_embeddings = torch.cat(new_embeddings, dim = 0)
+
+        offset = len(self.word2idx)
+        self.word2idx.update({char_ids: offset + idx for idx, char_ids in enumerate(real_words + paddings)})
+        self.embeddings = new_embeddings if self.embeddings is None else torch.cat([self.embeddings, new_embeddings], dim = 0)
+
+
+class StaticEmbedding(nn.Module):
+    """
+    A fast alternative to Elmo: frozen pre-trained word vectors + a small trainable character CNN.
+    The word vectors are memory-mapped from a .npy file (see utils.convert_word_vectors), so only the rows of the
+    words in the current batch are read, and they are not stored in the checkpoint.
+    Words are recovered from the Elmo character ids, out-of-vocabulary words get all-zero word vectors.
+    """
+    def __init__(self, vectors_file: str, dropout: float, char_embed_size: int = 16,
+                 filters: List = ((1, 32), (2, 32), (3, 64), (4, 64), (5, 64))):
+
+        super(StaticEmbedding, self).__init__()
+        self.vectors_file = vectors_file
+        self.vectors = np.load(vectors_file, mmap_mode = 'r')  # (vocab_size, word_size)
+        vocab_file = os.path.splitext(vectors_file)[0] + '.vocab'
+        with open(vocab_file, 'r', encoding = 'utf-8') as fin:
+            self.word2idx = {word: idx for idx, word in enumerate(fin.read().split('\n')[:len(self.vectors)])}
+
+        self.CharEmbedding = nn.Embedding(num_embeddings = 262, embedding_dim = char_embed_size, padding_idx = 0)  # Elmo char ids are in [0, 261]
+        self.Convolutions = nn.ModuleList([nn.Conv1d(in_channels = char_embed_size, out_channels = num_filters, kernel_size = width)
+                                           for width, num_filters in filters])
+        self.Dropout = nn.Dropout(p = dropout)
+        self.output_size = self.vectors.shape[1] + sum(num_filters for _, num_filters in filters)
+
+
+    def forward(self, char_paragraph: torch.Tensor):
+        """
+        Args:
+            char_paragraph - character ids of the paragraph, size (batch, max_tokens, max_chars)
+        Return:
+            token embeddings, the embeddings of padded tokens are all-zero, size (batch, max_tokens, output_size)
+        """
+        return self.combine(self.lookup_words(char_paragraph), char_paragraph)
+
+
+    def combine(self, word_rep: torch.Tensor, char_paragraph: torch.Tensor):
+        """
+        Concat the word vectors (size (batch, max_tokens, word_size)) with the outputs of the character CNN.
+        """
+        char_rep = self.encode_chars(char_paragraph)  # (batch, max_tokens, num_filters)
+        embeddings = torch.cat([word_rep.to(char_rep.dtype), char_rep], dim = -1)
+
+        is_token = (char_paragraph > 0).any(dim = -1, keepdim = True)  # (batch, max_tokens, 1)
+        embeddings = embeddings.masked_fill(~is_token, value = 0)
+        return self.Dropout(embeddings)
+
+
+    def encode_chars(self, char_paragraph: torch.Tensor):
+        """
+        Character CNN: convolutions of several widths, max-pooled over the characters of each word.
+        """
+        batch_size, max_tokens, max_chars = char_paragraph.size()
+        char_embeddings = self.CharEmbedding(char_paragraph.view(-1, max_chars).long())  # (batch*max_tokens, max_chars, char_embed_size)
+        char_embeddings = char_embeddings.transpose(1, 2)  # Conv1d takes (N, channels, length)
+
+        char_rep = [torch.max(conv(char_embeddings), dim = -1)[0] for conv in self.Convolutions]
+        char_rep = torch.relu(torch.cat(char_rep, dim = -1))  # (batch*max_tokens, num_filters)
+        return char_rep.view(batch_size, max_tokens, -1)
+
+
+    def lookup_words(self, char_paragraph: torch.Tensor):
+        """
+        Look up the word vectors of the tokens. Each distinct word in the batch is decoded and read from disk only once.
+        """
+        batch_size, max_tokens, max_chars = char_paragraph.size()
+        words, inverse = torch.unique(char_paragraph.view(-1, max_chars).cpu(), dim = 0, return_inverse = True)
+        word_ids = torch.LongTensor([self.get_word_id(char_ids) for char_ids in words.tolist()])
+        in_vocab = word_ids >= 0
+
+        word_vectors = torch.zeros(len(word_ids), self.vectors.shape[1])
+        if in_vocab.any():
+            # fancy indexing on the memory map only reads the requested rows
+            word_vectors[in_vocab] = torch.from_numpy(np.asarray(self.vectors[word_ids[in_vocab].numpy()], dtype = np.float32))
+
+        word_vectors = word_vectors[inverse].view(batch_size, max_tokens, -1)
+        return word_vectors.to(char_paragraph.device)
+
+
+    def get_word_id(self, char_ids: List[int]) -> int:
+        """
+        Decode a word from its Elmo character ids (utf-8 bytes shifted by 1, ids above 256 are special characters),
+        and find it in the vocabulary, falling back to lower case. Return -1 if it is not found.
+        """
+        word = bytes(char_id - 1 for char_id in char_ids if 0 < char_id <= 256).decode('utf-8', 'ignore')
+        if not word:  # padding or sentence boundary tokens
+            return -1
+        return self.word2idx.get(word, self.word2idx.get(word.lower(), -1))
+
+
+    def __getstate__(self):
+        # the memory map is re-opened instead of being copied into memory (e.g. by copy.deepcopy in inference.py)
+        state = self.__dict__.copy()
+        state['vectors'] = None
+        return state
+
+
+    def __setstate__(self, state):
+        super(StaticEmbedding, self).__setstate__(state)
+        self.vectors = np.load(self.vectors_file, mmap_mode = 'r')
+
+
 class StateTracker(nn.Module):
     """
     State tracking decoder: sentence-level Bi-LSTM + linear + CRF
     """
-    def __init__(self, hidden_size: int, dropout: float):
+    def __init__(self, hidden_size: int, dropout: float, pooling: nn.Module):
 
         super(StateTracker, self).__init__()
         self.hidden_size = hidden_size
@@ -204,19 +707,21 @@ class StateTracker(nn.Module):
                                     num_layers = 1, batch_first = True, bidirectional = True)
         self.Dropout = nn.Dropout(p = dropout)
         self.Hidden2Tag = Linear(d_in = 2 * hidden_size, d_out = NUM_STATES, dropout = 0)
+        self.MaskedMean = pooling
 
 
-    def forward(self, encoder_out, entity_mask, verb_mask):
+    def forward(self, encoder_out, entity_rep, entity_mask, verb_mask):
         """
         Args:
             encoder_out: output of the encoder, size (batch, max_tokens, 2 * hidden_size)
+            entity_rep: averaged entity mentions in each sentence, size (batch, max_sents, 2 * hidden_size)
             entity_mask: size (batch, max_sents, max_tokens)
             verb_mask: size (batch, max_sents, max_tokens)
         """
         batch_size = encoder_out.size(0)
         max_sents = entity_mask.size(-2)
 
-        decoder_in = self.get_masked_input(encoder_out, entity_mask, verb_mask, batch_size = batch_size)  # (batch, max_sents, 4 * hidden_size)
+        decoder_in = self.get_masked_input(encoder_out, entity_rep, entity_mask, verb_mask, batch_size = batch_size)  # (batch, max_sents, 4 * hidden_size)
         decoder_out, _ = self.Decoder(decoder_in)  # (batch, max_sents, 2 * hidden_size), forward & backward concatenated
         decoder_out = self.Dropout(decoder_out)
         tag_logits = self.Hidden2Tag(decoder_out)  # (batch, max_sents, num_tags)
@@ -225,7 +730,7 @@ class StateTracker(nn.Module):
         return tag_logits
     
 
-    def get_masked_input(self, encoder_out, entity_mask, verb_mask, batch_size: int):
+    def get_masked_input(self, encoder_out, entity_rep, entity_mask, verb_mask, batch_size: int):
         """
         If the entity does not exist in this sentence (entity_mask is all-zero),
         then replace it with an all-zero vector;
@@ -235,8 +740,8 @@ class StateTracker(nn.Module):
         assert entity_mask.size(-1) == encoder_out.size(-2)
 
         max_sents = entity_mask.size(-2)
-        entity_rep = self.get_masked_mean(source = encoder_out, mask = entity_mask, batch_size = batch_size)  # (batch, max_sents, 2 * hidden_size)
-        verb_rep = self.get_masked_mean(source = encoder_out, mask = verb_mask, batch_size = batch_size)  # (batch, max_sents, 2 * hidden_size)
+        verb_rep = self.MaskedMean(source = encoder_out, mask = verb_mask)  # (batch, max_sents, 2 * hidden_size)
+        assert entity_rep.size() == verb_rep.size() == (batch_size, max_sents, 2 * self.hidden_size)
         concat_rep = torch.cat([entity_rep, verb_rep], dim = -1)  # (batch, max_sents, 4 * hidden_size)
 
         assert concat_rep.size() == (batch_size, max_sents, 4 * self.hidden_size)
@@ -247,37 +752,11 @@ class StateTracker(nn.Module):
         return masked_rep
 
 
-    def get_masked_mean(self, source, mask, batch_size: int):
-        """
-        Args:
-            source - input tensors, size(batch, tokens, 2 * hidden_size)
-            mask - binary masked vectors, size(batch, sents, tokens)
-        Return:
-            the average of unmasked input tensors, size (batch, sents, 2 * hidden_size)
-        """
-        max_sents = mask.size(-2)
-
-        bool_mask = (mask.unsqueeze(dim = -1) == 0)  # turn binary masks to boolean values
-        masked_source = source.unsqueeze(dim = 1).masked_fill(bool_mask, value = 0)
-        masked_source = torch.sum(masked_source, dim = -2)  # sum the unmasked vectors
-        assert masked_source.size() == (batch_size, max_sents, 2 * self.hidden_size)
-
-        num_unmasked_tokens = torch.sum(mask, dim = -1, keepdim = True)  # compute the denominator of average op
-        masked_mean = torch.div(input = masked_source, other = num_unmasked_tokens)  # average the unmasked vectors
-
-        # division op may cause nan while encoutering 0, so replace nan with 0
-        is_nan = torch.isnan(masked_mean)
-        masked_mean = masked_mean.masked_fill(is_nan, value = 0)
-
-        assert masked_mean.size() == (batch_size, max_sents, 2 * self.hidden_size)
-        return masked_mean
-
-
 class LocationPredictor(nn.Module):
     """
     Location prediction decoder: sentence-level Bi-LSTM + linear + softmax
     """
-    def __init__(self, hidden_size: int, dropout: float):
+    def __init__(self, hidden_size: int, dropout: float, pooling: nn.Module):
 
         super(LocationPredictor, self).__init__()
         self.hidden_size = hidden_size
@@ -285,44 +764,59 @@ class LocationPredictor(nn.Module):
                                     num_layers = 1, batch_first = True, bidirectional = True)
         self.Dropout = nn.Dropout(p = dropout)
         self.Hidden2Score = Linear(d_in = 2 * hidden_size, d_out = 1, dropout = 0)
+        self.MaskedMean = pooling
 
 
-    def forward(self, encoder_out, entity_mask, loc_mask):
+    def forward(self, encoder_out, entity_rep, loc_mask, num_cands, num_sents):
         """
         Args:
             encoder_out: output of the encoder, size (batch, max_tokens, 2 * hidden_size)
-            entity_mask: size (batch, max_sents, max_tokens)
+            entity_rep: averaged entity mentions in each sentence, size (batch, max_sents, 2 * hidden_size)
             loc_mask: size (batch, max_cands, max_sents, max_tokens)
+            num_cands: number of location candidates of each instance, size (batch,)
+            num_sents: number of sentences of each instance, size (batch,)
+        Return:
+            loc_logits: size (batch, max_cands, max_sents), padded candidates are left as 0
         """
         batch_size = encoder_out.size(0)
         max_cands = loc_mask.size(-3)
         max_sents = loc_mask.size(-2)
 
-        decoder_in = self.get_masked_input(encoder_out, entity_mask, loc_mask, batch_size = batch_size)
-        decoder_in = decoder_in.view(batch_size * max_cands, max_sents, 4 * self.hidden_size)
-        decoder_out, _ = self.Decoder(decoder_in)  # (batch, max_sents, 2 * hidden_size), forward & backward concatenated
-        assert decoder_out.size() == (batch_size * max_cands, max_sents, 2 * self.hidden_size)
+        decoder_in = self.get_masked_input(encoder_out, entity_rep, loc_mask, batch_size = batch_size)
+
+        # only feed the real (instance, candidate) pairs to the decoder, since the scores of
+        # padded candidates will be masked to -inf anyway
+        valid_cands = get_length_mask(lengths = num_cands, max_len = max_cands)  # (batch, max_cands)
+        valid_idx = valid_cands.nonzero()
+        batch_idx, cand_idx = valid_idx[:, 0], valid_idx[:, 1]
+        loc_logits = decoder_in.new_zeros(batch_size, max_cands, max_sents)
+        if valid_idx.size(0) == 0:
+            return loc_logits
+
+        decoder_in = decoder_in[batch_idx, cand_idx]  # (num_pairs, max_sents, 4 * hidden_size)
+        pair_sents = num_sents.to(device = batch_idx.device)[batch_idx]
+        # run the decoder over the true number of sentences of each pair
+        decoder_out = run_packed_lstm(self.Decoder, inputs = decoder_in, lengths = pair_sents)
+        assert decoder_out.size() == (valid_idx.size(0), max_sents, 2 * self.hidden_size)
 
-        decoder_out = decoder_out.view(batch_size, max_cands, max_sents, 2 * self.hidden_size)
         decoder_out = self.Dropout(decoder_out)
-        loc_logits = self.Hidden2Score(decoder_out).squeeze(dim = -1)  # (batch, max_cands, max_sents)
+        pair_logits = self.Hidden2Score(decoder_out).squeeze(dim = -1)  # (num_pairs, max_sents)
+        loc_logits = loc_logits.index_put((batch_idx, cand_idx), pair_logits)  # scatter back to (batch, max_cands, max_sents)
 
         return loc_logits
 
-    def get_masked_input(self, encoder_out, entity_mask, loc_mask, batch_size: int):
+    def get_masked_input(self, encoder_out, entity_rep, loc_mask, batch_size: int):
         """
         Concat the mention positions of the entity and each location candidate
         """
-        assert entity_mask.size(-1) == loc_mask.size(-1) == encoder_out.size(-2)
-        assert entity_mask.size(-2) == loc_mask.size(-2)
+        assert loc_mask.size(-1) == encoder_out.size(-2)
+        assert entity_rep.size(-2) == loc_mask.size(-2)
 
         max_cands = loc_mask.size(-3)
         max_sents = loc_mask.size(-2)
 
-        # (batch, max_sents, 2 * hidden_size)
-        entity_rep = self.get_masked_mean(source = encoder_out, mask = entity_mask, batch_size = batch_size)
         # (batch, max_cands, max_sents, 2 * hidden_size)
-        loc_rep = self.get_masked_loc_mean(source = encoder_out, mask = loc_mask, batch_size = batch_size)
+        loc_rep = self.MaskedMean(source = encoder_out, mask = loc_mask)
         entity_rep = entity_rep.unsqueeze(dim = 1).expand_as(loc_rep)
         assert entity_rep.size() == loc_rep.size() == (batch_size, max_cands, max_sents, 2 * self.hidden_size)
 
@@ -332,58 +826,60 @@ class LocationPredictor(nn.Module):
         return concat_rep
 
 
-    def get_masked_loc_mean(self, source, mask, batch_size: int):
+class MaskedMeanPooling(nn.Module):
+    """
+    Average the token representations selected by a binary mask.
+    Parameter-free, so one instance is shared by NCETModel and the two decoders.
+    """
+    def forward(self, source, mask):
         """
         Args:
-            source - input tensors, size(batch, tokens, 2 * hidden_size)
-            mask - binary masked vectors, size(batch, cands, sents, tokens)
+            source - input tensors, size (batch, tokens, dim)
+            mask - binary masked vectors, size (batch, sents, tokens) or (batch, cands, sents, tokens)
         Return:
-            the average of unmasked input tensors, size (batch, cands, sents, 2 * hidden_size)
+            the average of unmasked input tensors, size (batch, sents, dim) or (batch, cands, sents, dim)
         """
-        max_sents = mask.size(-2)
-        max_cands = mask.size(-3)
-
-        bool_mask = (mask.unsqueeze(dim = -1) == 0)  # turn binary masks to boolean values
-        source = source.unsqueeze(dim = 1).unsqueeze(dim = 1)  # expand source to (batch, 1, 1, tokens, 2*hidden)
-        masked_source = source.masked_fill(bool_mask, value = 0)  # (batch, cands, sents, tokens, 2*hidden)
-        masked_source = torch.sum(masked_source, dim = -2)  # (batch, cands, sents, 2*hidden)
-        assert masked_source.size() == (batch_size, max_cands, max_sents, 2 * self.hidden_size)
+        batch_size = source.size(0)
+        max_tokens = source.size(-2)
+        assert mask.size(0) == batch_size and mask.size(-1) == max_tokens
+        out_size = mask.size()[:-1] + (source.size(-1),)
 
-        num_unmasked_tokens = torch.sum(mask, dim = -1, keepdim = True)  # (batch, cands, sents, 1)
-        masked_mean = torch.div(input = masked_source, other = num_unmasked_tokens)  # (batch, cands, sents, 2*hidden)
+        # flatten all leading mask dimensions, then sum the unmasked vectors with a batched matmul,
+        # so that no (batch, ..., tokens, dim) tensor is materialized.
+        # sums and counts are accumulated in fp32 if the model runs in reduced precision
+        mask = mask.float().view(batch_size, -1, max_tokens)
+        masked_source = torch.bmm(mask, source.float())  # (batch, rows, dim)
 
-        # division op may cause nan while encoutering 0, so replace nan with 0
-        is_nan = torch.isnan(masked_mean)
-        masked_mean = masked_mean.masked_fill(is_nan, value = 0)
+        num_unmasked_tokens = torch.sum(mask, dim = -1, keepdim = True)  # compute the denominator of average op
+        # all-zero rows have a zero sum, so clamping the denominator to 1 gives 0 instead of nan
+        masked_mean = torch.div(masked_source, num_unmasked_tokens.clamp(min = 1))  # average the unmasked vectors
 
-        assert masked_mean.size() == (batch_size, max_cands, max_sents, 2 * self.hidden_size)
-        return masked_mean
+        return masked_mean.to(dtype = source.dtype).view(out_size)
 
 
-    def get_masked_mean(self, source, mask, batch_size: int):
+class BatchedCRF(CRF):
+    """
+    CRF layer with a fully tensorized Viterbi decoder.
+    CRF.decode backtracks every sequence with Python loops and returns lists,
+    while viterbi_tags backtracks the whole batch at once and keeps the result on device.
+    """
+    def viterbi_tags(self, emissions: torch.Tensor, mask: torch.Tensor) -> torch.LongTensor:
         """
+        Find the most likely tag sequences, the results are identical to CRF.decode.
         Args:
-            source - input tensors, size(batch, tokens, 2 * hidden_size)
-            mask - binary masked vectors, size(batch, sents, tokens)
+            emissions - emission scores, size (batch, seq_len, num_tags) if batch_first
+            mask - size (batch, seq_len) if batch_first, the first timestep of each sequence must be unmasked
         Return:
-            the average of unmasked input tensors, size (batch, sents, 2 * hidden_size)
+            best tag sequences padded with PAD_STATE, size (batch, seq_len) if batch_first
         """
-        max_sents = mask.size(-2)
-
-        bool_mask = (mask.unsqueeze(dim = -1) == 0)  # turn binary masks to boolean values
-        masked_source = source.unsqueeze(dim = 1).masked_fill(bool_mask, value = 0)  # for masked tokens, turn its value to 0
-        masked_source = torch.sum(masked_source, dim = -2)  # sum the unmasked token representations
-        assert masked_source.size() == (batch_size, max_sents, 2 * self.hidden_size)
-
-        num_unmasked_tokens = torch.sum(mask, dim = -1, keepdim = True)  # compute the denominator of average op (number of unmasked tokens)
-        masked_mean = torch.div(input = masked_source, other = num_unmasked_tokens)  # average the unmasked vectors
-
-        # division op may cause nan while encoutering 0, so replace nan with 0
-        is_nan = torch.isnan(masked_mean)
-        masked_mean = masked_mean.masked_fill(is_nan, value = 0)
-
-        assert masked_mean.size() == (batch_size, max_sents, 2 * self.hidden_size)
-        return masked_mean
+        if self.batch_first:
+            emissions = emissions.transpose(0, 1)
+            mask = mask.transpose(0, 1)
+        best_tags = viterbi_decode(emissions, mask = mask.bool(), start_transitions = self.start_transitions,
+                                   transitions = self.transitions, end_transitions = self.end_transitions, pad_value = PAD_STATE)
+        if self.batch_first:
+            best_tags = best_tags.transpose(0, 1)
+        return best_tags
 
 
 class Linear(nn.Module):
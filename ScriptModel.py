@@ -0,0 +1,328 @@
+"""
+TorchScript port of the gold-free inference path of NCET (NCETModel.predict), used by export.py for TorchScript and ONNX export.
+The modules reuse the trained weights of an NCETModel and only re-implement the forward pass in scriptable code,
+so the exported model can be loaded with torch.jit.load, without allennlp or any code of this repo.
+Dropout is omitted since the exported model is only used for inference.
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from typing import List, Tuple
+from Constants import *
+from utils import count_tokens, get_length_mask, viterbi_decode
+from Model import NCETModel, MaskedMeanPooling
+
+
+class ScriptLstmCell(nn.Module):
+    """
+    One direction of one layer of Elmo's bi-LSTM (allennlp's LstmCellWithProjection).
+    Instead of sorting the batch by length, all sequences are stepped together,
+    and a sequence only updates its states on its valid timesteps.
+    """
+    def __init__(self, cell: nn.Module):
+
+        super(ScriptLstmCell, self).__init__()
+        assert cell.memory_cell_clip_value is not None and cell.state_projection_clip_value is not None
+        self.input_linearity = cell.input_linearity
+        self.state_linearity = cell.state_linearity
+        self.state_projection = cell.state_projection
+        self.hidden_size = cell.hidden_size
+        self.cell_size = cell.cell_size
+        self.go_forward = cell.go_forward
+        self.memory_cell_clip_value = float(cell.memory_cell_clip_value)
+        self.state_projection_clip_value = float(cell.state_projection_clip_value)
+
+
+    def forward(self, inputs, lengths):
+        """
+        Args:
+            inputs - size (batch, max_len, input_size)
+            lengths - number of valid timesteps of each sequence, size (batch,)
+        Return:
+            outputs - size (batch, max_len, hidden_size), padded timesteps are all-zero
+        """
+        batch_size = inputs.size(0)
+        total_timesteps = inputs.size(1)
+        cell_size = self.cell_size
+
+        outputs = inputs.new_zeros(batch_size, total_timesteps, self.hidden_size)
+        memory = inputs.new_zeros(batch_size, cell_size)
+        state = inputs.new_zeros(batch_size, self.hidden_size)
+
+        for timestep in range(total_timesteps):
+            index = timestep if self.go_forward else total_timesteps - timestep - 1
+
+            # gates are in the order of input, forget, memory, output
+            projected = self.input_linearity(inputs[:, index]) + self.state_linearity(state)
+            input_gate = torch.sigmoid(projected[:, 0:cell_size])
+            forget_gate = torch.sigmoid(projected[:, cell_size:2 * cell_size])
+            memory_init = torch.tanh(projected[:, 2 * cell_size:3 * cell_size])
+            output_gate = torch.sigmoid(projected[:, 3 * cell_size:4 * cell_size])
+
+            new_memory = input_gate * memory_init + forget_gate * memory
+            new_memory = torch.clamp(new_memory, -self.memory_cell_clip_value, self.memory_cell_clip_value)
+            new_state = self.state_projection(output_gate * torch.tanh(new_memory))
+            new_state = torch.clamp(new_state, -self.state_projection_clip_value, self.state_projection_clip_value)
+
+            is_valid = torch.gt(lengths, index).unsqueeze(dim = -1)  # (batch, 1)
+            memory = torch.where(is_valid, new_memory, memory)
+            state = torch.where(is_valid, new_state, state)
+            outputs[:, index] = new_state.masked_fill(~is_valid, 0.0)
+
+        return outputs
+
+
+class ScriptElmoLayer(nn.Module):
+    """
+    One layer of Elmo's bi-LSTM, the two directions have separate inputs.
+    All layers except the first one have residual connections.
+    """
+    def __init__(self, forward_cell: nn.Module, backward_cell: nn.Module, residual: bool):
+
+        super(ScriptElmoLayer, self).__init__()
+        self.forward_cell = ScriptLstmCell(forward_cell)
+        self.backward_cell = ScriptLstmCell(backward_cell)
+        self.residual = residual
+
+
+    def forward(self, forward_in, backward_in, lengths) -> Tuple[torch.Tensor, torch.Tensor]:
+        forward_out = self.forward_cell(forward_in, lengths)
+        backward_out = self.backward_cell(backward_in, lengths)
+        if self.residual:
+            forward_out = forward_out + forward_in
+            backward_out = backward_out + backward_in
+        return forward_out, backward_out
+
+
+class ScriptElmo(nn.Module):
+    """
+    Port of allennlp's Elmo with a single output representation and no layer norm, in eval mode.
+    allennlp's Elmo is stateful, i.e. its bi-LSTM starts from the final states of the previous batch.
+    ScriptElmo is stateless and always starts from zero states, which equals NCETModel.predict with reset_states = True.
+    """
+    def __init__(self, elmo: nn.Module):
+
+        super(ScriptElmo, self).__init__()
+        char_encoder = elmo._elmo_lstm._token_embedder
+        elmo_lstm = elmo._elmo_lstm._elmo_lstm
+        scalar_mix = elmo.scalar_mix_0
+        assert char_encoder._options['char_cnn']['activation'] == 'relu'
+        assert not scalar_mix.do_layer_norm
+
+        # context-insensitive token embedding: character CNN + highway + projection
+        self.char_embedding = nn.Parameter(char_encoder._char_embedding_weights.detach().clone(), requires_grad = False)
+        self.convolutions = nn.ModuleList(char_encoder._convolutions)
+        self.highways = nn.ModuleList(char_encoder._highways._layers)
+        self.projection = char_encoder._projection
+        self.register_buffer('bos_characters', char_encoder._beginning_of_sentence_characters.clone().long())
+        self.register_buffer('eos_characters', char_encoder._end_of_sentence_characters.clone().long())
+
+        # bi-LSTM
+        self.layers = nn.ModuleList([ScriptElmoLayer(forward_cell = getattr(elmo_lstm, f'forward_layer_{i}'),
+                                                     backward_cell = getattr(elmo_lstm, f'backward_layer_{i}'),
+                                                     residual = i > 0)
+                                     for i in range(elmo_lstm.num_layers)])
+
+        # scalar mix of the token embedding layer and all LSTM layers
+        mix_weights = F.softmax(torch.cat([parameter.detach() for parameter in scalar_mix.scalar_parameters]), dim = 0)
+        self.register_buffer('mix_weights', mix_weights)
+        self.register_buffer('gamma', scalar_mix.gamma.detach().clone())
+
+
+    def forward(self, char_ids):
+        """
+        Args:
+            char_ids - character ids of the paragraphs, size (batch, max_tokens, max_chars)
+        Return:
+            Elmo embeddings, size (batch, max_tokens, 1024), padded tokens are all-zero
+        """
+        batch_size = char_ids.size(0)
+        max_tokens = char_ids.size(1)
+        num_tokens = count_tokens(char_ids)  # (batch,)
+
+        # add <S> and </S> around each paragraph
+        char_ids_with_bos_eos = torch.zeros(batch_size, max_tokens + 2, char_ids.size(2), dtype = torch.long, device = char_ids.device)
+        char_ids_with_bos_eos[:, 1:-1] = char_ids
+        char_ids_with_bos_eos[:, 0] = self.bos_characters.expand(batch_size, -1)
+        char_ids_with_bos_eos[torch.arange(batch_size, device = char_ids.device), num_tokens + 1] = self.eos_characters.expand(batch_size, -1)
+        lengths = num_tokens + 2
+        mask = get_length_mask(lengths = lengths, max_len = max_tokens + 2).unsqueeze(dim = -1)
+
+        token_embedding = self.embed_tokens(char_ids_with_bos_eos)  # (batch, max_tokens + 2, projection_dim)
+        layer_outputs = [torch.cat([token_embedding, token_embedding], dim = -1).masked_fill(~mask, 0.0)]
+        forward_out, backward_out = token_embedding, token_embedding
+        for layer in self.layers:
+            forward_out, backward_out = layer(forward_out, backward_out, lengths)
+            layer_outputs.append(torch.cat([forward_out, backward_out], dim = -1))
+
+        mixed = self.mix_weights[0] * layer_outputs[0]
+        for i in range(1, len(layer_outputs)):
+            mixed = mixed + self.mix_weights[i] * layer_outputs[i]
+        mixed = self.gamma * mixed
+
+        # remove <S> and </S>
+        token_mask = get_length_mask(lengths = num_tokens, max_len = max_tokens).unsqueeze(dim = -1)
+        return mixed[:, 1:-1].masked_fill(~token_mask, 0.0)
+
+
+    def embed_tokens(self, char_ids):
+        """
+        Character CNN over each token.
+        Return:
+            token embeddings, size (batch, num_tokens, projection_dim)
+        """
+        batch_size = char_ids.size(0)
+        num_tokens = char_ids.size(1)
+        char_embedding = F.embedding(char_ids.view(-1, char_ids.size(2)), self.char_embedding)
+        char_embedding = char_embedding.transpose(1, 2)  # (batch * num_tokens, char_embed_dim, max_chars)
+
+        convs = torch.jit.annotate(List[torch.Tensor], [])
+        for conv in self.convolutions:
+            convolved, _ = torch.max(conv(char_embedding), dim = -1)
+            convs.append(torch.relu(convolved))
+        token_embedding = torch.cat(convs, dim = -1)
+
+        for highway in self.highways:
+            projected = highway(token_embedding)
+            dim = token_embedding.size(-1)
+            nonlinear_part = torch.relu(projected[:, 0:dim])
+            gate = torch.sigmoid(projected[:, dim:2 * dim])
+            token_embedding = gate * token_embedding + (1 - gate) * nonlinear_part
+
+        token_embedding = self.projection(token_embedding)
+        return token_embedding.view(batch_size, num_tokens, -1)
+
+
+class PackedLSTM(nn.Module):
+    """
+    Scriptable version of utils.run_packed_lstm: run a batch_first LSTM only over the valid timesteps of each sequence.
+    """
+    def __init__(self, lstm: nn.LSTM):
+
+        super(PackedLSTM, self).__init__()
+        self.lstm = lstm
+
+
+    def forward(self, inputs, lengths):
+        # sort by length explicitly instead of enforce_sorted = False, which cannot be exported to ONNX
+        sorted_lengths, sort_idx = torch.sort(lengths.long(), descending = True)
+        packed_inputs = pack_padded_sequence(inputs.index_select(0, sort_idx), sorted_lengths.to('cpu'), batch_first = True)
+        packed_outputs, _ = self.lstm(packed_inputs)
+        outputs, _ = pad_packed_sequence(packed_outputs, batch_first = True, total_length = inputs.size(1))
+        _, restore_idx = torch.sort(sort_idx)
+        return outputs.index_select(0, restore_idx)
+
+
+class ScriptNCET(nn.Module):
+    """
+    Scriptable NCETModel.predict, built from a trained NCETModel.
+    """
+    def __init__(self, model: NCETModel):
+
+        super(ScriptNCET, self).__init__()
+        embedding_layer = model.EmbeddingLayer
+        if embedding_layer.backend != 'elmo':
+            raise ValueError(f'Only models with the Elmo embedding backend can be exported, got {embedding_layer.backend}')
+        self.elmo = ScriptElmo(embedding_layer.elmo)
+        if embedding_layer.embed_size != 1025:
+            self.embed_project = embedding_layer.embed_project.linear
+        else:
+            self.embed_project = nn.Identity()
+        self.TokenEncoder = PackedLSTM(model.TokenEncoder)
+        self.MaskedMean = MaskedMeanPooling()
+
+        self.StateDecoder = model.StateTracker.Decoder
+        self.Hidden2Tag = model.StateTracker.Hidden2Tag.linear
+        self.register_buffer('start_transitions', model.CRFLayer.start_transitions.detach().clone())
+        self.register_buffer('transitions', model.CRFLayer.transitions.detach().clone())
+        self.register_buffer('end_transitions', model.CRFLayer.end_transitions.detach().clone())
+
+        self.LocDecoder = PackedLSTM(model.LocationPredictor.Decoder)
+        self.Hidden2Score = model.LocationPredictor.Hidden2Score.linear
+
+        # TorchScript does not read module-level constants
+        self.pad_state = PAD_STATE
+        self.pad_loc = PAD_LOC
+
+
+    def forward(self, char_paragraph, entity_mask, verb_mask, loc_mask, num_cands, num_sents) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Same arguments and return values as NCETModel.predict.
+        """
+        tag_logits, loc_logits = self.score(char_paragraph, entity_mask, verb_mask, loc_mask, num_cands, num_sents)
+        tag_mask = get_length_mask(lengths = num_sents, max_len = entity_mask.size(-2))  # (batch, max_sents)
+
+        pred_state_seq = viterbi_decode(tag_logits.float().transpose(0, 1), tag_mask.transpose(0, 1),
+                                        self.start_transitions, self.transitions, self.end_transitions, self.pad_state)
+        pred_state_seq = pred_state_seq.transpose(0, 1)
+        pred_loc_seq = torch.argmax(loc_logits.float(), dim = -1).masked_fill(~tag_mask, self.pad_loc)
+
+        return pred_state_seq, pred_loc_seq
+
+
+    def score(self, char_paragraph, entity_mask, verb_mask, loc_mask, num_cands, num_sents) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Everything before decoding.
+        Return:
+            tag_logits - emission scores of the CRF, size (batch, max_sents, NUM_STATES)
+            loc_logits - scores of the location candidates, padded candidates are -inf, size (batch, max_sents, max_cands)
+        """
+        # embedding: Elmo + verb indicator
+        elmo_embeddings = self.embed_project(self.elmo(char_paragraph))
+        verb_indicator = torch.sum(verb_mask, dim = 1).unsqueeze(dim = -1).to(dtype = elmo_embeddings.dtype)
+        embeddings = torch.cat([elmo_embeddings, verb_indicator], dim = -1)  # (batch, max_tokens, embed_size)
+
+        token_rep = self.TokenEncoder(embeddings, count_tokens(char_paragraph))  # (batch, max_tokens, 2*hidden_size)
+        entity_rep = self.MaskedMean(token_rep, entity_mask)  # (batch, max_sents, 2*hidden_size)
+
+        tag_logits = self.track_states(token_rep, entity_rep, entity_mask, verb_mask)
+        loc_logits = self.score_locations(token_rep, entity_rep, loc_mask, num_cands, num_sents)
+        return tag_logits, loc_logits
+
+
+    def track_states(self, token_rep, entity_rep, entity_mask, verb_mask):
+        """
+        Same as StateTracker.forward.
+        """
+        verb_rep = self.MaskedMean(token_rep, verb_mask)  # (batch, max_sents, 2*hidden_size)
+        decoder_in = torch.cat([entity_rep, verb_rep], dim = -1)  # (batch, max_sents, 4*hidden_size)
+        entity_absent = torch.eq(torch.sum(entity_mask, dim = -1), 0).unsqueeze(dim = -1)
+        decoder_in = decoder_in.masked_fill(entity_absent, 0.0)
+        decoder_out, _ = self.StateDecoder(decoder_in)
+        return self.Hidden2Tag(decoder_out)
+
+
+    def score_locations(self, token_rep, entity_rep, loc_mask, num_cands, num_sents):
+        """
+        Same as NCETModel.get_loc_logits, padded candidates are masked to -inf.
+        Return:
+            loc_logits - size (batch, max_sents, max_cands)
+        """
+        batch_size = loc_mask.size(0)
+        max_cands = loc_mask.size(1)
+        max_sents = loc_mask.size(2)
+
+        loc_rep = self.MaskedMean(token_rep, loc_mask)  # (batch, max_cands, max_sents, 2*hidden_size)
+        decoder_in = torch.cat([entity_rep.unsqueeze(dim = 1).expand_as(loc_rep), loc_rep], dim = -1)
+
+        # only score the real (instance, candidate) pairs
+        valid_cands = get_length_mask(lengths = num_cands, max_len = max_cands)  # (batch, max_cands)
+        valid_idx = valid_cands.nonzero()
+        batch_idx, cand_idx = valid_idx[:, 0], valid_idx[:, 1]
+        loc_logits = decoder_in.new_zeros(batch_size, max_cands, max_sents)
+        if valid_idx.size(0) > 0:
+            decoder_out = self.LocDecoder(decoder_in[batch_idx, cand_idx], num_sents.to(device = batch_idx.device)[batch_idx])
+            loc_logits[batch_idx, cand_idx] = self.Hidden2Score(decoder_out).squeeze(dim = -1)
+
+        loc_logits = loc_logits.transpose(1, 2)
+        padded_cands = ~valid_cands.unsqueeze(dim = 1)  # (batch, 1, max_cands)
+        return loc_logits.masked_fill(padded_cands, float('-inf'))
+
+
+class ScoreNCET(ScriptNCET):
+    """
+    ScriptNCET without decoding, for ONNX export. Viterbi decoding is done on the host by OnnxRuntimeModel.
+    """
+    def forward(self, char_paragraph, entity_mask, verb_mask, loc_mask, num_cands, num_sents) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.score(char_paragraph, entity_mask, verb_mask, loc_mask, num_cands, num_sents)
@@ -0,0 +1,550 @@
+"""
+Micro-benchmarks for the building blocks of NCET.
+Each task compares the current implementation against the straightforward alternative on batches
+whose shapes follow the length distribution of a real data split.
+"""
+import time
+import json
+import os
+import re
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+import torch
+import torch.nn as nn
+import numpy as np
+from typing import List, Dict
+from Constants import *
+from utils import *
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('-task', type=str, choices=['encoder', 'decoder', 'packing', 'train_step', 'viterbi', 'embedding', 'memory', 'scaling', 'restore'], required=True, help="which benchmark to run")
+parser.add_argument('-data', type=str, default="data/train.json",
+                    help="data split to draw paragraph lengths from, random lengths are used if it does not exist")
+parser.add_argument('-batch_size', type=int, default=64)
+parser.add_argument('-embed_size', type=int, default=128, help="embedding size (including the verb indicator)")
+parser.add_argument('-hidden_size', type=int, default=128, help="hidden size of lstm")
+parser.add_argument('-lr', type=float, default=1e-3, help="learning rate")
+parser.add_argument('-dropout', type=float, default=0.5, help="dropout rate")
+parser.add_argument('-elmo_dropout', type=float, default=0.5, help="dropout rate of elmo embedding")
+parser.add_argument('-elmo_dir', type=str, default='elmo', help="directory that contains options and weight files for allennlp Elmo")
+parser.add_argument('-embedding', type=str, choices=['elmo', 'static'], default='elmo',
+                    help="embedding backend. elmo: allennlp Elmo. static: memory-mapped word vectors + character CNN, much faster")
+parser.add_argument('-word_vectors', type=str, default=None,
+                    help="word vectors (.npy, created by utils.convert_word_vectors) of the static embedding backend")
+parser.add_argument('-batch_sizes', type=str, default='16,32,64,128', help="comma-separated batch sizes of the memory benchmark")
+parser.add_argument('-processes', type=str, default='1,2,4',
+                    help="comma-separated numbers of processes of the scaling benchmark (data-parallel training on this machine)")
+parser.add_argument('-master_port', type=int, default=29500, help="first port used by the process groups of the scaling benchmark")
+parser.add_argument('-restore', type=str, default=None, help="checkpoint of the restore benchmark")
+parser.add_argument('-num_batches', type=int, default=20, help="number of batches to time in each setting")
+parser.add_argument('-no_cuda', action='store_true', default=False, help="if true, will only use cpu")
+opt = parser.parse_args()
+
+torch.manual_seed(1234)
+np.random.seed(1234)
+
+
+def sample_lengths(key: str, low: int, high: int) -> List[List[int]]:
+    """
+    Sample opt.num_batches batches of lengths (e.g. 'total_tokens') from the data split.
+    """
+    if os.path.exists(opt.data):
+        data = json.load(open(opt.data, 'r', encoding='utf-8'))
+        lengths = [instance[key] for instance in data]
+        print(f'[INFO] Sampling {key} from {opt.data}')
+    else:
+        lengths = np.random.randint(low, high + 1, size = 1000).tolist()
+        print(f'[WARNING] {opt.data} not found, sampling {key} uniformly from [{low}, {high}]')
+
+    return [np.random.choice(lengths, size = opt.batch_size).tolist() for _ in range(opt.num_batches)]
+
+
+def synchronize():
+    if not opt.no_cuda:
+        torch.cuda.synchronize()
+
+
+def time_batches(run_fn, batches: List) -> float:
+    """
+    Run run_fn on each batch (after one warm-up batch), return the number of instances processed per second.
+    """
+    run_fn(batches[0])
+    synchronize()
+    start_time = time.time()
+    for batch in batches:
+        run_fn(batch)
+    synchronize()
+    total_instances = len(batches) * opt.batch_size
+    return total_instances / (time.time() - start_time)
+
+
+def bench_encoder():
+    """
+    TokenEncoder: padded Bi-LSTM over max_tokens vs packed Bi-LSTM over the true paragraph lengths.
+    """
+    encoder = nn.LSTM(input_size = opt.embed_size, hidden_size = opt.hidden_size,
+                      num_layers = 1, batch_first = True, bidirectional = True)
+    if not opt.no_cuda:
+        encoder.cuda()
+
+    batches = []
+    for lengths in sample_lengths(key = 'total_tokens', low = 50, high = 250):
+        embeddings = torch.randn(len(lengths), max(lengths), opt.embed_size)
+        lengths = torch.LongTensor(lengths)
+        if not opt.no_cuda:
+            embeddings = embeddings.cuda()
+        batches.append((embeddings, lengths))
+
+    padding_ratio = 1 - sum(lengths.sum().item() for _, lengths in batches) / \
+                        sum(embeddings.size(0) * embeddings.size(1) for embeddings, _ in batches)
+    print(f'[INFO] {padding_ratio * 100:.1f}% of the token positions are padding')
+
+    def padded_forward(batch):
+        embeddings, _ = batch
+        return encoder(embeddings)[0]
+
+    def packed_forward(batch):
+        embeddings, lengths = batch
+        return run_packed_lstm(encoder, inputs = embeddings, lengths = lengths)
+
+    def padded_step(batch):
+        padded_forward(batch).sum().backward()
+
+    def packed_step(batch):
+        packed_forward(batch).sum().backward()
+
+    with torch.no_grad():
+        padded_infer = time_batches(padded_forward, batches)
+        packed_infer = time_batches(packed_forward, batches)
+    padded_train = time_batches(padded_step, batches)
+    packed_train = time_batches(packed_step, batches)
+
+    print(f'TokenEncoder throughput (instances/s), batch size {opt.batch_size}:\n'
+          f'Inference: padded {padded_infer:.1f}, packed {packed_infer:.1f}, speedup {packed_infer / padded_infer:.2f}x\n'
+          f'Training (forward + backward): padded {padded_train:.1f}, packed {packed_train:.1f}, '
+          f'speedup {packed_train / padded_train:.2f}x')
+
+
+def bench_viterbi():
+    """
+    CRF decoding: torchcrf's CRF.decode (Python backtracking, returns lists) vs BatchedCRF.viterbi_tags (tensorized).
+    """
+    from Model import BatchedCRF
+
+    crf = BatchedCRF(NUM_STATES, batch_first = True)
+    if not opt.no_cuda:
+        crf.cuda()
+
+    batches = []
+    for lengths in sample_lengths(key = 'total_sents', low = 3, high = 10):
+        lengths = torch.LongTensor(lengths)
+        emissions = torch.randn(len(lengths), lengths.max().item(), NUM_STATES)
+        mask = torch.arange(lengths.max().item()).unsqueeze(dim = 0) < lengths.unsqueeze(dim = -1)
+        if not opt.no_cuda:
+            emissions, mask = emissions.cuda(), mask.cuda()
+        batches.append((emissions, mask))
+
+    # check that both decoders give exactly the same output
+    for emissions, mask in batches:
+        list_tags = crf.decode(emissions = emissions, mask = mask)
+        tensor_tags = crf.viterbi_tags(emissions = emissions, mask = mask)
+        assert [unpad(inst, pad_value = PAD_STATE) for inst in tensor_tags.tolist()] == list_tags
+    print('[INFO] viterbi_tags matches CRF.decode on all batches')
+
+    with torch.no_grad():
+        list_speed = time_batches(lambda batch: crf.decode(emissions = batch[0], mask = batch[1]), batches)
+        tensor_speed = time_batches(lambda batch: crf.viterbi_tags(emissions = batch[0], mask = batch[1]), batches)
+
+    print(f'Viterbi decoding throughput (sequences/s), batch size {opt.batch_size}:\n'
+          f'CRF.decode: {list_speed:.1f}, viterbi_tags: {tensor_speed:.1f}, speedup {tensor_speed / list_speed:.2f}x')
+
+
+def bench_decoder():
+    """
+    Location decoder: padded Bi-LSTM over all (instance, candidate) pairs and max_sents vs packed Bi-LSTM
+    over the real pairs and their true number of sentences.
+    """
+    decoder = nn.LSTM(input_size = 4 * opt.hidden_size, hidden_size = opt.hidden_size,
+                      num_layers = 1, batch_first = True, bidirectional = True)
+    if not opt.no_cuda:
+        decoder.cuda()
+
+    batches = []
+    # the numbers of sentences and candidates are sampled independently
+    for sents, cands in zip(sample_lengths(key = 'total_sents', low = 3, high = 10),
+                            sample_lengths(key = 'total_loc_candidates', low = 1, high = 10)):
+        num_sents, num_cands = torch.LongTensor(sents), torch.LongTensor(cands)
+        decoder_in = torch.randn(len(sents), max(cands), max(sents), 4 * opt.hidden_size)
+        if not opt.no_cuda:
+            decoder_in, num_sents, num_cands = decoder_in.cuda(), num_sents.cuda(), num_cands.cuda()
+        batches.append((decoder_in, num_cands, num_sents))
+
+    real_steps = sum((num_cands * num_sents).sum().item() for _, num_cands, num_sents in batches)
+    padded_steps = sum(decoder_in.size(0) * decoder_in.size(1) * decoder_in.size(2) for decoder_in, _, _ in batches)
+    print(f'[INFO] {(1 - real_steps / padded_steps) * 100:.1f}% of the decoder timesteps are padding')
+
+    def padded_forward(batch):
+        decoder_in, _, _ = batch
+        batch_size, max_cands, max_sents, input_size = decoder_in.size()
+        return decoder(decoder_in.view(batch_size * max_cands, max_sents, input_size))[0]
+
+    def packed_forward(batch):
+        decoder_in, num_cands, num_sents = batch
+        valid_idx = get_length_mask(lengths = num_cands, max_len = decoder_in.size(1)).nonzero()
+        batch_idx, cand_idx = valid_idx[:, 0], valid_idx[:, 1]
+        return run_packed_lstm(decoder, inputs = decoder_in[batch_idx, cand_idx], lengths = num_sents[batch_idx])
+
+    def padded_step(batch):
+        padded_forward(batch).sum().backward()
+
+    def packed_step(batch):
+        packed_forward(batch).sum().backward()
+
+    with torch.no_grad():
+        padded_infer = time_batches(padded_forward, batches)
+        packed_infer = time_batches(packed_forward, batches)
+    padded_train = time_batches(padded_step, batches)
+    packed_train = time_batches(packed_step, batches)
+
+    print(f'Location decoder throughput (instances/s), batch size {opt.batch_size}:\n'
+          f'Inference: padded {padded_infer:.1f}, packed {packed_infer:.1f}, speedup {packed_infer / padded_infer:.2f}x\n'
+          f'Training (forward + backward): padded {padded_train:.1f}, packed {packed_train:.1f}, '
+          f'speedup {packed_train / padded_train:.2f}x')
+
+
+def load_batches(is_test: bool) -> List[Dict]:
+    """
+    Read the first opt.num_batches batches of opt.data and convert them to the keyword arguments of NCETModel.
+    """
+    from torch.utils.data import DataLoader
+    from allennlp.modules.elmo import batch_to_ids
+    from Dataset import ProparaDataset, Collate
+
+    dataset = ProparaDataset(opt.data, is_test = is_test)
+    data_loader = DataLoader(dataset = dataset, batch_size = opt.batch_size, shuffle = False, collate_fn = Collate())
+
+    batches = []
+    for batch in data_loader:
+        if len(batches) == opt.num_batches:
+            break
+        inputs = {'char_paragraph': batch_to_ids(batch['paragraph']),
+                  'entity_mask': batch['entity_mask'],
+                  'verb_mask': batch['verb_mask'],
+                  'loc_mask': batch['loc_mask'],
+                  'gold_loc_seq': batch['gold_loc_seq'],
+                  'gold_state_seq': batch['gold_state_seq'],
+                  'num_cands': torch.IntTensor([meta['total_loc_cands'] for meta in batch['metadata']])}
+        if not opt.no_cuda:
+            inputs = {key: value.cuda() for key, value in inputs.items()}
+        batches.append(inputs)
+
+    return batches
+
+
+def bench_packing():
+    """
+    Whole training step of NCETModel with packed TokenEncoder and decoder LSTMs vs the same LSTMs run over the padding
+    (the outputs differ, only the speed is compared).
+    """
+    import Model
+    from Model import NCETModel
+
+    batches = load_batches(is_test = False)
+    model = NCETModel(opt = opt, is_test = False)
+    if not opt.no_cuda:
+        model.cuda()
+    model.train()
+    optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr = opt.lr)
+
+    def train_step(inputs):
+        model.zero_grad()
+        state_loss, loc_loss, *_ = model(**inputs, compute_metrics = False)
+        (state_loss + loc_loss).backward()
+        optimizer.step()
+
+    packed_speed = time_batches(train_step, batches)
+    Model.run_packed_lstm = lambda lstm, inputs, lengths: lstm(inputs)[0]
+    try:
+        padded_speed = time_batches(train_step, batches)
+    finally:
+        Model.run_packed_lstm = run_packed_lstm
+
+    print(f'Training throughput (steps/s), batch size {opt.batch_size}:\n'
+          f'Padded LSTMs: {padded_speed / opt.batch_size:.3f}, packed LSTMs: {packed_speed / opt.batch_size:.3f}, '
+          f'speedup {packed_speed / padded_speed:.2f}x')
+
+
+def bench_train_step():
+    """
+    Training step with Viterbi decoding and accuracy on every batch vs loss-only training step.
+    """
+    from Model import NCETModel
+
+    batches = load_batches(is_test = False)
+    model = NCETModel(opt = opt, is_test = False)
+    if not opt.no_cuda:
+        model.cuda()
+    model.train()
+    optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr = opt.lr)
+
+    def train_step(inputs, compute_metrics: bool):
+        model.zero_grad()
+        state_loss, loc_loss, *_ = model(**inputs, compute_metrics = compute_metrics)
+        (state_loss + loc_loss).backward()
+        optimizer.step()
+
+    full_speed = time_batches(lambda inputs: train_step(inputs, compute_metrics = True), batches)
+    loss_only_speed = time_batches(lambda inputs: train_step(inputs, compute_metrics = False), batches)
+
+    print(f'Training throughput (steps/s), batch size {opt.batch_size}:\n'
+          f'With metrics: {full_speed / opt.batch_size:.3f}, loss only: {loss_only_speed / opt.batch_size:.3f}, '
+          f'speedup {loss_only_speed / full_speed:.2f}x')
+
+
+def bench_embedding():
+    """
+    Embedding backends: Elmo vs static word vectors + character CNN, for the embedding layer alone and the whole inference.
+    Accuracy depends on training, compare trained models of both backends with "train.py -mode test" instead.
+    """
+    from Model import NCETModel
+
+    if opt.word_vectors is None:
+        raise RuntimeError("Did not specify -word_vectors option")
+    batches = load_batches(is_test = False)
+    for inputs in batches:
+        inputs['num_sents'] = torch.sum(inputs['gold_state_seq'] != PAD_STATE, dim = -1)
+
+    def predict(model, inputs):
+        return model.predict(inputs['char_paragraph'], inputs['entity_mask'], inputs['verb_mask'],
+                             inputs['loc_mask'], inputs['num_cands'], inputs['num_sents'])
+
+    results = {}
+    for backend in ['elmo', 'static']:
+        opt.embedding = backend
+        model = NCETModel(opt = opt, is_test = True)
+        if not opt.no_cuda:
+            model.cuda()
+        model.eval()
+        with torch.no_grad():
+            embed_speed = time_batches(lambda inputs: model.EmbeddingLayer(inputs['char_paragraph'], inputs['verb_mask']), batches)
+            predict_speed = time_batches(lambda inputs: predict(model, inputs), batches)
+        num_params = sum(p.numel() for p in model.EmbeddingLayer.parameters())
+        results[backend] = (embed_speed, predict_speed, num_params)
+        del model
+
+    print(f'Inference throughput (instances/s), batch size {opt.batch_size}:')
+    for backend, (embed_speed, predict_speed, num_params) in results.items():
+        print(f'{backend}: embedding layer {embed_speed:.1f}, whole model {predict_speed:.1f}, '
+              f'{num_params / 1e6:.1f}M embedding parameters')
+    print(f'Speedup of static: embedding layer {results["static"][0] / results["elmo"][0]:.2f}x, '
+          f'whole model {results["static"][1] / results["elmo"][1]:.2f}x')
+
+
+def get_memory() -> (float, float):
+    """
+    Current and peak memory in MB since the last reset_peak_memory(): allocated CUDA memory, or the RSS of the process on CPU.
+    """
+    if not opt.no_cuda:
+        return torch.cuda.memory_allocated() / 2**20, torch.cuda.max_memory_allocated() / 2**20
+    status = dict(re.findall(r'(Vm\w+):\s+(\d+) kB', open('/proc/self/status').read()))
+    return int(status['VmRSS']) / 1024, int(status['VmHWM']) / 1024
+
+
+def reset_peak_memory():
+    if not opt.no_cuda:
+        torch.cuda.reset_max_memory_allocated()
+    else:
+        with open('/proc/self/clear_refs', 'w') as fout:  # resets the peak RSS (Linux only)
+            fout.write('5')
+
+
+def measure_train_step(batch_size: int, checkpoint_activations: bool, results: multiprocessing.Queue):
+    """
+    Run in a fresh process, so that memory freed by the previous setting does not hide the peak of this one.
+    Report the peak memory of the training steps on top of the memory after setup, and the time of a step.
+    """
+    from Model import NCETModel
+
+    opt.batch_size = batch_size
+    opt.checkpoint_activations = checkpoint_activations
+    batches = load_batches(is_test = False)
+    model = NCETModel(opt = opt, is_test = False)
+    if not opt.no_cuda:
+        model.cuda()
+    model.train()
+    optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr = opt.lr)
+
+    def train_step(inputs):
+        model.zero_grad()
+        state_loss, loc_loss, *_ = model(**inputs, compute_metrics = False)
+        (state_loss + loc_loss).backward()
+        optimizer.step()
+
+    train_step(batches[0])  # warm up, and allocate the gradients and the optimizer states
+    synchronize()
+    base_memory, _ = get_memory()
+    reset_peak_memory()
+    speed = time_batches(train_step, batches)
+    _, peak_memory = get_memory()
+    results.put((peak_memory - base_memory, batch_size / speed))
+
+
+def bench_memory():
+    """
+    Peak memory and time of a training step with vs without activation checkpointing, at several batch sizes.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    device = 'CPU (RSS)' if opt.no_cuda else 'CUDA (allocated)'
+    print(f'Training step peak memory on {device} above the model and optimizer states (MB), and step time (s):')
+
+    for batch_size in [int(size) for size in opt.batch_sizes.split(',')]:
+        measures = []
+        for checkpoint_activations in [False, True]:
+            process = context.Process(target = measure_train_step, args = (batch_size, checkpoint_activations, results))
+            process.start()
+            measures.append(results.get())
+            process.join()
+        (plain_memory, plain_time), (ckpt_memory, ckpt_time) = measures
+        print(f'batch size {batch_size}: plain {plain_memory:.1f} MB {plain_time:.3f}s, '
+              f'checkpointing {ckpt_memory:.1f} MB {ckpt_time:.3f}s, '
+              f'peak memory {ckpt_memory / plain_memory:.2f}x, step time {ckpt_time / plain_time:.2f}x')
+
+
+def measure_distributed_step(rank: int, world_size: int, results: multiprocessing.Queue):
+    """
+    One process of the scaling benchmark: time data-parallel training steps, each process training on its own batches
+    and averaging the gradients with the others (see train.py -nproc). Process 0 reports the total throughput.
+    """
+    from Model import NCETModel
+
+    init_distributed(rank = rank, world_size = world_size, master_addr = '127.0.0.1', master_port = opt.master_port + world_size)
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))  # same as train.py
+    if not opt.no_cuda:
+        torch.cuda.set_device(rank % torch.cuda.device_count())
+    batches = load_batches(is_test = False)
+    model = NCETModel(opt = opt, is_test = False)
+    if not opt.no_cuda:
+        model.cuda()
+    model.train()
+    optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr = opt.lr)
+
+    def train_step(inputs):
+        model.zero_grad()
+        state_loss, loc_loss, *_ = model(**inputs, compute_metrics = False)
+        (state_loss + loc_loss).backward()
+        all_reduce_gradients(model)
+        optimizer.step()
+
+    speed = time_batches(train_step, batches)  # the steps of all processes are synchronized by the all-reduce
+    if rank == 0:
+        results.put(speed * world_size)
+    dist.destroy_process_group()
+
+
+def bench_scaling():
+    """
+    Throughput of data-parallel training with 1 to N processes on this machine.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    print(f'Data-parallel training throughput (instances/s), batch size {opt.batch_size} per process:')
+
+    base_speed = None
+    for world_size in [int(num) for num in opt.processes.split(',')]:
+        processes = [context.Process(target = measure_distributed_step, args = (rank, world_size, results))
+                     for rank in range(world_size)]
+        for process in processes:
+            process.start()
+        speed = results.get()
+        for process in processes:
+            process.join()
+
+        base_speed = base_speed or speed / world_size
+        print(f'{world_size} process(es): {speed:.1f}, speedup {speed / base_speed:.2f}x, '
+              f'scaling efficiency {speed / base_speed / world_size * 100:.1f}%')
+
+
+def measure_restore(path: str, fast: bool, results: multiprocessing.Queue):
+    """
+    Restore a checkpoint in a fresh process, report the time and the peak RSS on top of the memory after the imports.
+    fast: through checkpoint.restore_model. Otherwise, the former path of test mode: build the model with its
+    weights initialized (Elmo reads its weight file), read the full state dict and load it.
+    """
+    from Model import NCETModel
+    from checkpoint import restore_model
+
+    opt.no_cuda = True  # restoring runs on CPU, measure the RSS
+    base_memory, _ = get_memory()
+    reset_peak_memory()
+    start_time = time.time()
+    if fast:
+        restore_model(opt, path)
+    else:
+        model = NCETModel(opt = opt, is_test = True)
+        model.load_state_dict(torch.load(path))
+    restore_time = time.time() - start_time
+    _, peak_memory = get_memory()
+    results.put((restore_time, peak_memory - base_memory))
+
+
+def bench_restore():
+    """
+    Time and peak memory of restoring the checkpoint of -restore for testing. The former path on a full checkpoint
+    (with the Elmo weights) is compared with the fast path (no weight initialization, lazy loading, see
+    checkpoint.restore_model) on the same full checkpoint and on a slim one. Both checkpoints are written
+    from -restore to a temporary directory first.
+    """
+    from checkpoint import restore_model, slim_checkpoint
+
+    if not opt.restore:
+        raise RuntimeError("Did not specify -restore option")
+    opt.no_cuda = True
+    model = restore_model(opt, opt.restore)
+    checkpoint_dir = tempfile.mkdtemp()
+    full_path, slim_path = os.path.join(checkpoint_dir, 'full.pt'), os.path.join(checkpoint_dir, 'slim.pt')
+    torch.save(model.state_dict(), full_path)
+    torch.save(slim_checkpoint(model), slim_path)
+    del model
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    print(f'Restoring {opt.restore}, time (s) and peak RSS above the imports (MB):')
+    measures = {}
+    for name, path, fast in [('former, full checkpoint', full_path, False), ('fast, full checkpoint', full_path, True),
+                             ('fast, slim checkpoint', slim_path, True)]:
+        process = context.Process(target = measure_restore, args = (path, fast, results))
+        process.start()
+        measures[name] = results.get()
+        process.join()
+    shutil.rmtree(checkpoint_dir)
+
+    base_time, base_memory = measures['former, full checkpoint']
+    for name, (restore_time, memory) in measures.items():
+        print(f'{name}: {restore_time:.2f}s {memory:.1f} MB, '
+              f'speedup {base_time / restore_time:.2f}x, peak memory {memory / base_memory:.2f}x')
+
+
+if __name__ == "__main__":
+
+    if opt.task == 'encoder':
+        bench_encoder()
+    elif opt.task == 'decoder':
+        bench_decoder()
+    elif opt.task == 'packing':
+        bench_packing()
+    elif opt.task == 'train_step':
+        bench_train_step()
+    elif opt.task == 'viterbi':
+        bench_viterbi()
+    elif opt.task == 'embedding':
+        bench_embedding()
+    elif opt.task == 'memory':
+        bench_memory()
+    elif opt.task == 'scaling':
+        bench_scaling()
+    elif opt.task == 'restore':
+        bench_restore()
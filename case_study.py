@@ -11,9 +11,12 @@ from torch.utils.data import DataLoader
 from allennlp.modules.elmo import batch_to_ids
 from Dataset import *
 from Model import *
+from inference import quantize_model, check_bfloat16_support, convert_to_bfloat16, compare_with_float
+from checkpoint import restore_model
 import os
 import re
 import argparse
+import functools
 print(f'[INFO] Import modules time: {time.time() - import_start_time}s')
 torch.set_printoptions(threshold=np.inf)
 
@@ -27,11 +30,32 @@ parser.add_argument('-dropout', type=float, default=0.5, help="dropout rate")
 parser.add_argument('-elmo_dropout', type=float, default=0.5, help="dropout rate of elmo embedding")
 parser.add_argument('-loc_loss', type=float, default=1.0, help="hyper-parameter to weight location loss and state_loss")
 parser.add_argument('-elmo_dir', type=str, default='elmo', help="directory that contains options and weight files for allennlp Elmo")
+parser.add_argument('-embedding', type=str, choices=['elmo', 'static'], default='elmo',
+                    help="embedding backend. elmo: allennlp Elmo. static: memory-mapped word vectors + character CNN, much faster")
+parser.add_argument('-word_vectors', type=str, default=None,
+                    help="word vectors (.npy, created by utils.convert_word_vectors) of the static embedding backend")
+parser.add_argument('-elmo_cache', action='store_true', default=False,
+                    help="cache the context-independent token embeddings of Elmo by word, precomputed over the vocabulary "
+                         "of the data, so the character CNN of Elmo only runs once per word")
 
 parser.add_argument('-restore', type=str, default=None, help="restoring model path")
 parser.add_argument('-test_set', type=str, default="data/test.json", help="path to test set")
 parser.add_argument('-output', type=str, default=None, help="path to store prediction outputs")
 parser.add_argument('-no_cuda', action='store_true', default=False, help="if true, will only use cpu")
+parser.add_argument('-prefetch', type=int, default=2,
+                    help="number of batches whose inputs are prepared ahead on a background thread while the model runs")
+parser.add_argument('-quantize', type=str, choices=['none', 'dynamic'], default='none',
+                    help="dynamic: apply int8 dynamic quantization to LSTM and Linear modules for CPU inference, "
+                         "and compare latency, model size and accuracy with the float model")
+parser.add_argument('-precision', type=str, choices=['fp32', 'bf16'], default='fp32',
+                    help="bf16: run CPU inference with bfloat16 weights and activations (CRF decoding stays in fp32), "
+                         "and compare latency, accuracy and predictions with the fp32 model")
+parser.add_argument('-lazy_loc', action='store_true', default=False,
+                    help="decode the states first, and only score the locations of the entities with a C or M step, "
+                         "which are the only locations kept in the output")
+parser.add_argument('-loc_topk', type=int, default=0,
+                    help="if positive, only keep the k best location candidates of each instance by a cheap pre-ranking "
+                         "before running the location decoder")
 opt = parser.parse_args()
 
 
@@ -93,7 +117,7 @@ def get_output(metadata: Dict, pred_state_seq: List[int], pred_loc_seq: List[int
 
     pred_state_seq = [idx2state[idx] for idx in pred_state_seq]
     gold_state_seq = [idx2state[idx] for idx in gold_state_seq if idx != PAD_STATE]
-    pred_loc_seq = [loc_cand_list[idx] for idx in pred_loc_seq]
+    pred_loc_seq = [loc_cand_list[idx] if idx >= 0 else '?' for idx in pred_loc_seq]  # negative: no prediction (lazy location scoring)
     gold_loc_seq = metadata['raw_gold_loc']  # gold locations in string form
 
     pred_loc_seq = predict_consistent_loc(pred_state_seq = pred_state_seq, pred_loc_seq = pred_loc_seq)
@@ -172,47 +196,44 @@ def write_output(output: List[Dict], output_filepath: str, sentences: List[List[
           f'Location Accuracy: {loc_accuracy * 100:.3f}%')
 
 
-def test(test_set, model):
+def test(test_set, model, write_prediction: bool = True, lazy_loc: bool = False, loc_topk: int = 0) -> Dict:
     print('[INFO] Start testing...')
-    test_batch = DataLoader(dataset = test_set, batch_size = opt.batch_size, shuffle = False, collate_fn = Collate())
+    test_batch = BatchPrefetcher(DataLoader(dataset = test_set, batch_size = opt.batch_size, shuffle = False, collate_fn = Collate()),
+                                 to_char_ids = batch_to_ids, cuda = not opt.no_cuda, queue_size = opt.prefetch)
 
     start_time = time.time()
     report_state_correct, report_state_pred = 0, 0
     report_loc_correct, report_loc_pred = 0, 0
+    model_time = 0
     output_result = []
     all_sentences = []
+    all_predictions = []
 
     with torch.no_grad():
         for batch in test_batch:
 
-            paragraphs = batch['paragraph']
-            char_paragraph = batch_to_ids(paragraphs)
             all_sentences.extend(batch['sentences'])
-            entity_mask = batch['entity_mask']
-            verb_mask = batch['verb_mask']
-            loc_mask = batch['loc_mask']
             gold_loc_seq = batch['gold_loc_seq']
             gold_state_seq = batch['gold_state_seq']
             metadata = batch['metadata']
-            num_cands = torch.IntTensor([meta['total_loc_cands'] for meta in metadata])
 
-            if not opt.no_cuda:
-                char_paragraph = char_paragraph.cuda()
-                entity_mask = entity_mask.cuda()
-                verb_mask = verb_mask.cuda()
-                loc_mask = loc_mask.cuda()
-                gold_loc_seq = gold_loc_seq.cuda()
-                gold_state_seq = gold_state_seq.cuda()
-                num_cands = num_cands.cuda()
-
-            test_result = model(char_paragraph=char_paragraph, entity_mask=entity_mask, verb_mask=verb_mask,
-                                loc_mask=loc_mask, gold_loc_seq=gold_loc_seq, gold_state_seq=gold_state_seq,
-                                num_cands=num_cands)
-
-            pred_state_seq, pred_loc_seq, test_state_correct, test_state_pred,\
-                test_loc_correct, test_loc_pred = test_result
-
-            batch_size = len(paragraphs)
+            # gold sequences are only used for the accuracy report, not by the model
+            model_start_time = time.time()
+            pred_state_seq, pred_loc_seq = model.predict(char_paragraph=batch['char_paragraph'], entity_mask=batch['entity_mask'],
+                                                         verb_mask=batch['verb_mask'], loc_mask=batch['loc_mask'],
+                                                         num_cands=batch['num_cands'], num_sents=batch['num_sents'],
+                                                         lazy_loc=lazy_loc, loc_topk=loc_topk)
+            model_time += time.time() - model_start_time
+            test_state_correct, test_state_pred = compute_state_accuracy(pred=pred_state_seq, gold=gold_state_seq,
+                                                                         pad_value=PAD_STATE)
+            # lazy location scoring only predicts the locations at the steps with a C or M state
+            test_loc_correct, test_loc_pred = compute_loc_pred_accuracy(pred=pred_loc_seq, gold=gold_loc_seq,
+                                                                        step_mask=find_loc_steps(pred_state_seq) if lazy_loc else None)
+            pred_state_seq = [unpad(inst, pad_value=PAD_STATE) for inst in pred_state_seq.tolist()]
+            pred_loc_seq = [unpad(inst, pad_value=PAD_LOC) for inst in pred_loc_seq.tolist()]
+            all_predictions.extend(zip(pred_state_seq, pred_loc_seq))
+
+            batch_size = len(metadata)
             for i in range(batch_size):
                 pred_instance = get_output(metadata = metadata[i], pred_state_seq = pred_state_seq[i], pred_loc_seq = pred_loc_seq[i],
                                            gold_state_seq = gold_state_seq[i].tolist())
@@ -225,15 +246,23 @@ def test(test_set, model):
 
     total_accuracy = (report_state_correct + report_loc_correct) / (report_state_pred + report_loc_pred)
     state_accuracy = report_state_correct / report_state_pred
-    loc_accuracy = report_loc_correct / report_loc_pred
+    loc_accuracy = report_loc_correct / max(report_loc_pred, 1)
 
     print(f'Test:\n'
            f'Total Accuracy: {total_accuracy * 100:.3f}%, '
            f'State Prediction Accuracy: {state_accuracy * 100:.3f}%, '
            f'Location Accuracy: {loc_accuracy * 100:.3f}%')
 
-    write_output(output = output_result, output_filepath = opt.output, sentences = all_sentences)
-    print(f'[INFO] Test finished. Time elapse: {time.time() - start_time}s')
+    if write_prediction:
+        write_output(output = output_result, output_filepath = opt.output, sentences = all_sentences)
+    total_time = time.time() - start_time
+    print(f'[INFO] Test finished. Time elapse: {total_time}s, '
+          f'data wait: {test_batch.wait_time:.2f}s ({test_batch.wait_time / total_time * 100:.1f}%)')
+
+    return {'model_time': model_time, 'latency': model_time / len(test_set) * 1000, 'total_time': total_time,
+            'data_wait': test_batch.wait_time,
+            'throughput': len(test_set) / model_time, 'predictions': all_predictions,
+            'total_accuracy': total_accuracy * 100, 'state_accuracy': state_accuracy * 100, 'loc_accuracy': loc_accuracy * 100}
 
 
 if __name__ == "__main__":
@@ -241,12 +270,31 @@ if __name__ == "__main__":
 
     print('[INFO] Start loading trained model...')
     restore_start_time = time.time()
-    model = NCETModel(opt=opt, is_test=True)
-    model_state_dict = torch.load(opt.restore)
-    model.load_state_dict(model_state_dict)
+    model = restore_model(opt, opt.restore)
     model.eval()
-    print(f'[INFO] Loaded model from {opt.restore}, time elapse: {time.time() - restore_start_time}s')
-
-    if not opt.no_cuda:
-        model.cuda()
-    test(test_set, model)
\ No newline at end of file
+    print(f'[INFO] Loaded model from {opt.restore}, time elapse: {time.time() - restore_start_time}s, '
+          f'peak RSS: {peak_rss():.0f}MB')
+    if opt.elmo_cache:
+        cache_start_time = time.time()
+        model.EmbeddingLayer.cache_words(test_set.vocabulary())
+        print(f'[INFO] Cached the Elmo token embeddings of the test set, time elapse: {time.time() - cache_start_time}s')
+
+    if opt.quantize == 'dynamic' and opt.precision != 'fp32':
+        raise RuntimeError("-quantize and -precision cannot be used together")
+    test_fn = functools.partial(test, lazy_loc = opt.lazy_loc, loc_topk = opt.loc_topk)
+
+    if opt.quantize == 'dynamic':
+        # quantized kernels only run on CPU, the float model is evaluated first as a reference
+        opt.no_cuda = True
+        compare_with_float(test_fn, test_set, model, optimize_fn = quantize_model, optimized_name = 'int8')
+
+    elif opt.precision == 'bf16':
+        # reduced precision targets CPU inference, the fp32 model is evaluated first as a reference
+        check_bfloat16_support()
+        opt.no_cuda = True
+        compare_with_float(test_fn, test_set, model, optimize_fn = convert_to_bfloat16, optimized_name = 'bf16')
+
+    else:
+        if not opt.no_cuda:
+            model.cuda()
+        test_fn(test_set, model)
\ No newline at end of file
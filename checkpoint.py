@@ -0,0 +1,198 @@
+import os
+import queue
+import inspect
+import zipfile
+import threading
+import contextlib
+import argparse
+import torch
+import torch.nn as nn
+from typing import Dict, List
+from Model import NCETModel
+
+
+def frozen_parameters(model: nn.Module) -> List[str]:
+    """
+    Names of the parameters that are never trained, i.e. the Elmo biLM.
+    """
+    return [name for name, param in model.named_parameters() if not param.requires_grad]
+
+
+def slim_checkpoint(model: nn.Module, snapshot: Dict[str, torch.Tensor] = None) -> Dict:
+    """
+    A checkpoint of the model without the frozen Elmo weights, which are only referred to by their weight file
+    and are loaded from it again when the checkpoint is restored (see load_checkpoint).
+    The weights are cloned (see clone_tensors), or taken from the snapshot of AsyncEvaluator if given, so the checkpoint
+    does not change when training continues.
+    """
+    frozen = frozen_parameters(model)
+    if snapshot is not None:
+        state_dict = dict(snapshot)
+    else:
+        state_dict = clone_tensors({key: tensor for key, tensor in model.state_dict().items() if key not in frozen})
+
+    weight_file = getattr(model.EmbeddingLayer, 'weight_file', None) if model.EmbeddingLayer.backend == 'elmo' else None
+    return {'model': state_dict, 'frozen': frozen, 'elmo_weight_file': weight_file,
+            'elmo_weight_size': os.path.getsize(weight_file) if weight_file is not None else None}
+
+
+def is_slim_checkpoint(checkpoint: Dict) -> bool:
+    return 'model' in checkpoint and 'frozen' in checkpoint
+
+
+def clone_tensors(obj):
+    """
+    Clone all tensors in a (nested) dict, list or tuple, e.g. the optimizer state, so it can be written in the background
+    while training goes on. The clones stay on the device of the tensors: on GPU, cloning is queued without waiting for
+    the device, and CheckpointWriter moves the clones to CPU on its own thread. On CPU, the training thread still
+    stalls for one copy in memory of the weights (without the frozen Elmo weights) and of the optimizer state.
+    """
+    return map_tensors(obj, lambda tensor: tensor.detach().clone())
+
+
+def to_cpu(obj):
+    """
+    Move all tensors in a (nested) dict, list or tuple to CPU, tensors already on CPU are not copied.
+    """
+    return map_tensors(obj, lambda tensor: tensor.cpu())
+
+
+def map_tensors(obj, fn):
+    if isinstance(obj, torch.Tensor):
+        return fn(obj)
+    if isinstance(obj, dict):
+        return {key: map_tensors(value, fn) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(map_tensors(value, fn) for value in obj)
+    return obj
+
+
+def load_checkpoint(model: nn.Module, path: str, map_location = None, lazy: bool = False):
+    """
+    Load a checkpoint saved by training into a model built with the same options: either a slim checkpoint,
+    whose frozen Elmo weights are already loaded by the model from -elmo_dir, or a full state dict of older versions.
+    lazy: map the checkpoint file into memory instead of reading it (if supported by torch), and skip the frozen weights
+    of a full state dict, so they are not read from the disk a second time.
+    """
+    if lazy and 'mmap' in inspect.signature(torch.load).parameters and zipfile.is_zipfile(path):
+        checkpoint = torch.load(path, map_location = map_location, mmap = True)
+    else:
+        if lazy:
+            print(f'[INFO] Cannot memory-map {path} (needs PyTorch 2.1 or later and the zip file format), reading it instead')
+        checkpoint = torch.load(path, map_location = map_location)
+    if lazy and not is_slim_checkpoint(checkpoint):
+        frozen = frozen_parameters(model)
+        checkpoint = {'model': {key: tensor for key, tensor in checkpoint.items() if key not in frozen},
+                      'frozen': frozen, 'elmo_weight_file': None}
+    load_model_state(model, checkpoint, name = path)
+
+
+def load_model_state(model: nn.Module, checkpoint: Dict, name: str):
+    """
+    Load a slim checkpoint (or a full state dict of older versions) that is already in memory, e.g. the model
+    of a training state. name is only used by the error messages.
+    """
+    if not is_slim_checkpoint(checkpoint):
+        model.load_state_dict(checkpoint)
+        return
+
+    weight_file = checkpoint['elmo_weight_file']
+    if weight_file is not None:
+        model_weight_file = model.EmbeddingLayer.weight_file
+        if os.path.basename(weight_file) != os.path.basename(model_weight_file) or \
+                checkpoint['elmo_weight_size'] != os.path.getsize(model_weight_file):
+            print(f'[WARNING] The checkpoint was trained with the Elmo weights of {weight_file}, '
+                  f'which differ from {model_weight_file}')
+
+    missing_keys, unexpected_keys = model.load_state_dict(checkpoint['model'], strict = False)
+    missing_keys = set(missing_keys) - set(frozen_parameters(model))
+    if missing_keys or unexpected_keys:
+        raise RuntimeError(f'Error(s) in loading the checkpoint {name}: missing keys {sorted(missing_keys)}, '
+                           f'unexpected keys {sorted(unexpected_keys)}')
+
+
+@contextlib.contextmanager
+def skip_init():
+    """
+    Build modules without initializing their weights (random or orthogonal initialization by torch.nn.init),
+    for models whose weights are all loaded afterwards. The weights are left as allocated (torch.empty).
+    """
+    names = [name for name in dir(nn.init) if name.endswith('_') and not name.startswith('_')]
+    initializers = {name: getattr(nn.init, name) for name in names}
+    try:
+        for name in names:
+            setattr(nn.init, name, lambda tensor, *args, **kwargs: tensor)
+        yield
+    finally:
+        for name, initializer in initializers.items():
+            setattr(nn.init, name, initializer)
+
+
+def restore_model(opt: argparse.Namespace, path: str, map_location = None) -> NCETModel:
+    """
+    Build the model for testing and load a checkpoint into it. The model is built without initializing the weights,
+    since all of them are then loaded, from the Elmo weight file or from the checkpoint, and the checkpoint is loaded
+    lazily (see load_checkpoint).
+    """
+    with skip_init():
+        model = NCETModel(opt = opt, is_test = True)
+    load_checkpoint(model, path, map_location = map_location, lazy = True)
+    return model
+
+
+class CheckpointWriter:
+    """
+    Write checkpoints on a background thread, so training does not wait for the disk, nor for the copy of the tensors
+    from GPU to CPU. Each checkpoint is written to a temporary file which is then renamed, so a checkpoint file
+    is always complete.
+    At most max_pending checkpoints wait in memory. Errors of the thread are raised by the next call.
+    """
+    def __init__(self, max_pending: int = 2):
+        self.queue = queue.Queue(maxsize = max_pending)
+        self.thread = None
+        self.error = None
+
+
+    def save(self, checkpoint: Dict, path: str):
+        self.check_error()
+        if self.thread is None:  # started on first use, e.g. not in the processes that never save
+            self.thread = threading.Thread(target = self.write, daemon = True)
+            self.thread.start()
+        self.queue.put((checkpoint, path))
+
+
+    def write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            checkpoint, path = item
+            try:
+                torch.save(to_cpu(checkpoint), path + '.tmp')
+                os.replace(path + '.tmp', path)
+            except Exception as error:
+                self.error = error
+            self.queue.task_done()
+
+
+    def flush(self):
+        """
+        Wait until all queued checkpoints are written.
+        """
+        self.queue.join()
+        self.check_error()
+
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.check_error()
+
+
+    def check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Failed to write a checkpoint') from error
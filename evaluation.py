@@ -0,0 +1,149 @@
+import time
+import queue
+import argparse
+import traceback
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+from typing import Dict, List, Tuple
+from torch.utils.data import DataLoader
+from allennlp.modules.elmo import batch_to_ids
+from Dataset import ProparaDataset, Collate, BatchPrefetcher
+from Model import NCETModel
+
+
+def run_evaluation(dev_set, model: NCETModel, opt: argparse.Namespace) -> Dict:
+    """
+    Compute the losses and accuracies of the model on the dev set.
+    """
+    dev_batch = BatchPrefetcher(DataLoader(dataset = dev_set, batch_size = opt.batch_size, shuffle = False, collate_fn = Collate()),
+                                to_char_ids = batch_to_ids, cuda = not opt.no_cuda, queue_size = opt.prefetch)
+
+    start_time = time.time()
+    report_state_loss, report_loc_loss = 0, 0
+    report_state_correct, report_state_pred = 0, 0
+    report_loc_correct, report_loc_pred = 0, 0
+
+    with torch.no_grad():
+        for batch in dev_batch:
+
+            eval_result = model(char_paragraph = batch['char_paragraph'], entity_mask = batch['entity_mask'],
+                                verb_mask = batch['verb_mask'], loc_mask = batch['loc_mask'],
+                                gold_loc_seq = batch['gold_loc_seq'], gold_state_seq = batch['gold_state_seq'],
+                                num_cands = batch['num_cands'])
+
+            eval_state_loss, eval_loc_loss, eval_state_correct, eval_state_pred, \
+                eval_loc_correct, eval_loc_pred = eval_result
+
+            report_state_loss += eval_state_loss.item() * eval_state_pred
+            report_loc_loss += eval_loc_loss.item() * eval_loc_pred
+            report_state_correct += eval_state_correct
+            report_state_pred += eval_state_pred
+            report_loc_correct += eval_loc_correct
+            report_loc_pred += eval_loc_pred
+
+    state_loss = report_state_loss / report_state_pred  # average over all elements
+    loc_loss = report_loc_loss / report_loc_pred
+
+    return {'total_loss': state_loss + opt.loc_loss * loc_loss, 'state_loss': state_loss, 'loc_loss': loc_loss,
+            'total_accuracy': (report_state_correct + report_loc_correct) / (report_state_pred + report_loc_pred),
+            'state_accuracy': report_state_correct / report_state_pred,
+            'loc_accuracy': report_loc_correct / report_loc_pred,
+            'time': time.time() - start_time, 'data_wait': dev_batch.wait_time}
+
+
+def evaluation_worker(opt: argparse.Namespace, dev_path: str, snapshots: mp.Queue, results: mp.Queue, stop: mp.Event):
+    """
+    Entry of the evaluation process: build the model and the dev set once, then evaluate every snapshot it receives,
+    until it receives None or stop is set.
+    """
+    try:
+        if opt.eval_threads > 0:
+            torch.set_num_threads(opt.eval_threads)
+        dev_set = ProparaDataset(dev_path, is_test = False)
+        model = NCETModel(opt = opt, is_test = False)
+        if opt.elmo_cache:  # only depends on the frozen weights, stays valid for all snapshots
+            model.EmbeddingLayer.cache_words(dev_set.vocabulary())
+        if not opt.no_cuda:
+            model.cuda()
+        model.eval()
+
+        while True:
+            item = snapshots.get()
+            if item is None or stop.is_set():
+                break
+            round_id, snapshot = item
+            model.load_state_dict(snapshot, strict = False)  # frozen weights are not in the snapshot
+            results.put(('result', (round_id, run_evaluation(dev_set, model, opt))))
+
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+
+
+class AsyncEvaluator:
+    """
+    Evaluate snapshots of the model weights on the dev set in a background process while training continues.
+    The snapshots only contain the weights that can change during training, the evaluation process loads
+    the frozen ones (Elmo) by itself. Results are returned in the order of submission.
+    """
+    def __init__(self, opt: argparse.Namespace, dev_path: str, max_pending: int = 2):
+        assert max_pending >= 1
+        context = mp.get_context('spawn')  # CUDA cannot be used in forked processes
+        self.snapshots = context.Queue()
+        self.results = context.Queue()
+        self.stop = context.Event()
+        self.process = context.Process(target = evaluation_worker,
+                                       args = (opt, dev_path, self.snapshots, self.results, self.stop), daemon = True)
+        self.process.start()
+        self.max_pending = max_pending
+        self.pending = {}  # round id -> (name, snapshot), until the result arrives
+        self.next_round = 0
+
+
+    def submit(self, model: nn.Module, name: str):
+        """
+        Snapshot the current weights of the model and queue them for evaluation. This does not wait: training
+        only blocks in poll, when more than max_pending rounds are pending after a submission.
+        """
+        frozen = {param_name for param_name, param in model.named_parameters() if not param.requires_grad}
+        snapshot = {key: tensor.detach().cpu().clone() for key, tensor in model.state_dict().items() if key not in frozen}
+        self.snapshots.put((self.next_round, snapshot))
+        self.pending[self.next_round] = (name, snapshot)
+        self.next_round += 1
+
+
+    def poll(self, block: bool = False) -> List[Tuple[str, Dict, Dict]]:
+        """
+        Collect the finished rounds, as (name, evaluation result, snapshot).
+        If block, or if too many rounds are pending, wait until at least one round finishes.
+        """
+        finished = []
+        while self.pending:
+            wait = (block or len(self.pending) > self.max_pending) and not finished
+            try:
+                kind, item = self.results.get(timeout = 1) if wait else self.results.get_nowait()
+            except queue.Empty:
+                if not wait:
+                    break
+                if not self.process.is_alive():
+                    raise RuntimeError(f'Evaluation process exited with code {self.process.exitcode}')
+                continue
+
+            if kind == 'error':
+                raise RuntimeError(f'Evaluation process failed:\n{item}')
+            round_id, result = item
+            name, snapshot = self.pending.pop(round_id)
+            finished.append((name, result, snapshot))
+
+        return finished
+
+
+    def close(self, discard_pending: bool = False):
+        """
+        Stop the evaluation process, after the pending rounds are evaluated unless discard_pending
+        (then only the round being evaluated is finished).
+        """
+        if discard_pending:
+            self.stop.set()
+        self.snapshots.put(None)
+        self.process.join()
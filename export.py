@@ -0,0 +1,152 @@
+"""
+Export the gold-free inference path of a trained NCET model, which can be served by serve.py without allennlp or the training code.
+torchscript: Elmo, encoder, decoders and Viterbi decoding in a TorchScript file.
+onnx: Elmo, encoder and decoders in an ONNX graph with dynamic batch, token, sentence and candidate axes,
+      Viterbi decoding is done on the host when running with ONNX Runtime.
+"""
+import time
+print('[INFO] Starting import...')
+import_start_time = time.time()
+import torch
+import json
+import argparse
+from typing import Dict, Callable
+from torch.utils.data import DataLoader
+from allennlp.modules.elmo import batch_to_ids
+from Dataset import *
+from Model import *
+from ScriptModel import ScriptNCET, ScoreNCET
+from inference import print_comparison, OnnxRuntimeModel
+from checkpoint import restore_model
+print(f'[INFO] Import modules time: {time.time() - import_start_time}s')
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('-batch_size', type=int, default=64)
+parser.add_argument('-embed_size', type=int, default=128, help="embedding size (including the verb indicator)")
+parser.add_argument('-hidden_size', type=int, default=128, help="hidden size of lstm")
+parser.add_argument('-dropout', type=float, default=0.5, help="dropout rate")
+parser.add_argument('-elmo_dropout', type=float, default=0.5, help="dropout rate of elmo embedding")
+parser.add_argument('-elmo_dir', type=str, default='elmo', help="directory that contains options and weight files for allennlp Elmo")
+parser.add_argument('-embedding', type=str, choices=['elmo', 'static'], default='elmo',
+                    help="embedding backend. elmo: allennlp Elmo. static: memory-mapped word vectors + character CNN, much faster")
+parser.add_argument('-word_vectors', type=str, default=None,
+                    help="word vectors (.npy, created by utils.convert_word_vectors) of the static embedding backend")
+
+parser.add_argument('-restore', type=str, required=True, help="restoring model path")
+parser.add_argument('-output', type=str, required=True, help="path to store the exported model")
+parser.add_argument('-format', type=str, choices=['torchscript', 'onnx'], default='torchscript', help="format of the exported model")
+parser.add_argument('-test_set', type=str, default=None,
+                    help="if specified, check the exported model against the eager model on this data and compare their latency")
+opt = parser.parse_args()
+
+
+def get_example_inputs():
+    """
+    A small batch to run the model while exporting to ONNX. All axes are dynamic, so the sizes do not matter.
+    """
+    char_paragraph = batch_to_char_ids([['water', 'evaporates', 'into', 'vapor'], ['vapor', 'condenses']])
+    batch_size, max_tokens = char_paragraph.size(0), char_paragraph.size(1)
+    max_sents, max_cands = 2, 3
+
+    entity_mask = torch.zeros(batch_size, max_sents, max_tokens, dtype = torch.int)
+    entity_mask[:, 0, 0] = 1
+    verb_mask = torch.zeros(batch_size, max_sents, max_tokens, dtype = torch.int)
+    verb_mask[:, :, 1] = 1
+    loc_mask = torch.zeros(batch_size, max_cands, max_sents, max_tokens, dtype = torch.int)
+    loc_mask[:, :, :, -1] = 1
+    num_cands = torch.IntTensor([3, 2])
+    num_sents = torch.IntTensor([2, 1])
+
+    return char_paragraph, entity_mask, verb_mask, loc_mask, num_cands, num_sents
+
+
+def export_onnx(model: NCETModel, output_path: str):
+    """
+    Export everything before decoding to ONNX, the CRF transitions are stored in the metadata of the ONNX model.
+    """
+    require_torch('1.11', 'ONNX export (opset 16)')
+    onnx = import_optional('onnx', 'ONNX export')
+
+    score_model = torch.jit.script(ScoreNCET(model))
+    dynamic_axes = {'char_paragraph': {0: 'batch', 1: 'tokens'},
+                    'entity_mask': {0: 'batch', 1: 'sents', 2: 'tokens'},
+                    'verb_mask': {0: 'batch', 1: 'sents', 2: 'tokens'},
+                    'loc_mask': {0: 'batch', 1: 'cands', 2: 'sents', 3: 'tokens'},
+                    'num_cands': {0: 'batch'},
+                    'num_sents': {0: 'batch'},
+                    'tag_logits': {0: 'batch', 1: 'sents'},
+                    'loc_logits': {0: 'batch', 1: 'sents', 2: 'cands'}}
+    torch.onnx.export(score_model, get_example_inputs(), output_path, opset_version = 16,
+                      input_names = OnnxRuntimeModel.input_names, output_names = OnnxRuntimeModel.output_names,
+                      dynamic_axes = dynamic_axes)
+
+    onnx_model = onnx.load(output_path)
+    crf_params = {name: json.dumps(getattr(model.CRFLayer, name).tolist()) for name in OnnxRuntimeModel.crf_names}
+    onnx.helper.set_model_props(onnx_model, crf_params)
+    onnx.save(onnx_model, output_path)
+
+
+def run_predict(predict_fn: Callable, test_set, to_char_ids: Callable) -> Dict:
+    """
+    Predict the test set on CPU with predict_fn, which takes the same arguments as NCETModel.predict.
+    Return the model time and the unpadded predictions, in the format of the test function of train.py.
+    """
+    test_batch = DataLoader(dataset = test_set, batch_size = opt.batch_size, shuffle = False, collate_fn = Collate())
+    model_time = 0
+    all_predictions = []
+
+    with torch.no_grad():
+        for batch in test_batch:
+            char_paragraph = to_char_ids(batch['paragraph'])
+            metadata = batch['metadata']
+            num_cands = torch.IntTensor([meta['total_loc_cands'] for meta in metadata])
+            num_sents = torch.IntTensor([meta['total_sents'] for meta in metadata])
+
+            model_start_time = time.time()
+            pred_state_seq, pred_loc_seq = predict_fn(char_paragraph, batch['entity_mask'], batch['verb_mask'],
+                                                      batch['loc_mask'], num_cands, num_sents)
+            model_time += time.time() - model_start_time
+
+            pred_state_seq = [unpad(inst, pad_value = PAD_STATE) for inst in pred_state_seq.tolist()]
+            pred_loc_seq = [unpad(inst, pad_value = PAD_LOC) for inst in pred_loc_seq.tolist()]
+            all_predictions.extend(zip(pred_state_seq, pred_loc_seq))
+
+    return {'model_time': model_time, 'latency': model_time / len(test_set) * 1000,
+            'throughput': len(test_set) / model_time, 'predictions': all_predictions}
+
+
+if __name__ == "__main__":
+
+    print('[INFO] Start loading trained model...')
+    restore_start_time = time.time()
+    model = restore_model(opt, opt.restore, map_location = 'cpu')
+    model.eval()
+    print(f'[INFO] Loaded model from {opt.restore}, time elapse: {time.time() - restore_start_time}s')
+
+    export_start_time = time.time()
+    with torch.no_grad():
+        if opt.format == 'torchscript':
+            torch.jit.script(ScriptNCET(model)).save(opt.output)
+        elif opt.format == 'onnx':
+            export_onnx(model, output_path = opt.output)
+    print(f'[INFO] Exported {opt.format} model to {opt.output}, time elapse: {time.time() - export_start_time}s')
+
+    if opt.test_set:
+        test_set = ProparaDataset(opt.test_set, is_test = True)
+        load_start_time = time.time()
+        if opt.format == 'torchscript':
+            exported_model = torch.jit.load(opt.output)
+        elif opt.format == 'onnx':
+            exported_model = OnnxRuntimeModel(opt.output)
+        print(f'[INFO] Loaded {opt.format} model, time elapse: {time.time() - load_start_time}s')
+
+        def eager_predict(*inputs):
+            return model.predict(*inputs, reset_states = True)  # the exported Elmo does not carry states over batches
+
+        print('[INFO] Running the eager model...')
+        eager_result = run_predict(eager_predict, test_set, to_char_ids = batch_to_ids)
+        print(f'[INFO] Running the {opt.format} model...')
+        with torch.jit.optimized_execution(False):  # same as serve.py
+            exported_result = run_predict(exported_model, test_set, to_char_ids = batch_to_char_ids)
+        print_comparison('eager', eager_result, opt.format, exported_result)
@@ -0,0 +1,156 @@
+import io
+import copy
+import json
+import torch
+import torch.nn as nn
+from typing import Dict, List, Tuple, Callable
+from Constants import *
+from utils import get_length_mask, viterbi_decode, import_optional
+
+
+def quantize_model(model: nn.Module) -> nn.Module:
+    """
+    Apply int8 dynamic quantization to all LSTM and Linear modules of the model,
+    including the LSTMs, highway layers and projections inside Elmo.
+    Weights are stored in int8 and activations are quantized on the fly. Quantized models only run on CPU.
+    The original model is not modified.
+    """
+    quantized_model = torch.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype = torch.qint8)
+    quantized_model.EmbeddingLayer.clear_word_cache()  # recompute the cached Elmo token embeddings with the quantized weights
+    quantized_model.eval()
+    return quantized_model
+
+
+def check_bfloat16_support():
+    """
+    Raise an error if this PyTorch has no CPU bfloat16 kernels for the LSTMs and the Elmo character CNN,
+    which only recent versions have (tested with PyTorch 2.0), unlike PyTorch 1.3.1 of requirements.txt.
+    """
+    try:
+        with torch.no_grad():
+            nn.LSTM(input_size = 2, hidden_size = 2).to(torch.bfloat16)(torch.zeros(1, 1, 2, dtype = torch.bfloat16))
+            nn.Conv1d(2, 2, kernel_size = 1).to(torch.bfloat16)(torch.zeros(1, 2, 1, dtype = torch.bfloat16))
+    except RuntimeError as error:
+        raise RuntimeError(f'-precision bf16 needs CPU bfloat16 kernels of LSTM and Conv1d, which PyTorch {torch.__version__} '
+                           f'does not have, please use a recent PyTorch (tested with 2.0)') from error
+
+
+def convert_to_bfloat16(model: nn.Module) -> nn.Module:
+    """
+    Store the weights and activations of the embedding layer (including Elmo), the encoder and both decoders in bfloat16.
+    The CRF transitions stay in fp32: emissions are cast back to fp32 before Viterbi decoding,
+    and masked mean pooling accumulates in fp32 (see NCETModel.predict and MaskedMeanPooling).
+    The original model is not modified.
+    """
+    bf16_model = copy.deepcopy(model).to(torch.bfloat16)
+    bf16_model.CRFLayer.float()
+    # the Elmo states carried over from the previous batch are plain attributes, not converted by .to()
+    bf16_model.EmbeddingLayer.reset_states()
+    bf16_model.EmbeddingLayer.clear_word_cache()
+    bf16_model.eval()
+    return bf16_model
+
+
+def get_model_size(model: nn.Module) -> float:
+    """
+    Size of the serialized state dict of the model, in MB.
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1024 / 1024
+
+
+def prediction_agreement(baseline: List[Tuple[List[int], List[int]]], optimized: List[Tuple[List[int], List[int]]]) -> float:
+    """
+    Percentage of timesteps on which two versions of the model predict the same state and the same location.
+    Each argument is the 'predictions' field returned by the test function, i.e. (pred_state_seq, pred_loc_seq) per instance.
+    Steps where either version makes no location prediction (negative, e.g. with lazy location scoring) only compare states.
+    """
+    assert len(baseline) == len(optimized)
+    same, total = 0, 0
+    for (base_state, base_loc), (opt_state, opt_loc) in zip(baseline, optimized):
+        assert len(base_state) == len(opt_state)
+        same += sum(int(base_state[i] == opt_state[i] and (base_loc[i] == opt_loc[i] or min(base_loc[i], opt_loc[i]) < 0))
+                    for i in range(len(base_state)))
+        total += len(base_state)
+    return same / total * 100
+
+
+def compare_with_float(test_fn: Callable, test_set, model: nn.Module, optimize_fn: Callable, optimized_name: str) -> nn.Module:
+    """
+    Evaluate the float model with test_fn as a reference, then the model converted by optimize_fn, and print the comparison.
+    Only the predictions of the optimized model are written. Both models run on CPU.
+    Return the optimized model.
+    """
+    print('[INFO] Evaluating the float model as reference...')
+    model.EmbeddingLayer.reset_states()
+    float_result = test_fn(test_set, model, write_prediction = False)
+    float_result['model_size'] = get_model_size(model)
+
+    optimized_model = optimize_fn(model)
+    optimized_model.EmbeddingLayer.reset_states()  # start from the same Elmo states as the float model
+    print(f'[INFO] Evaluating the {optimized_name} model...')
+    optimized_result = test_fn(test_set, optimized_model)
+    optimized_result['model_size'] = get_model_size(optimized_model)
+
+    print_comparison('float', float_result, optimized_name, optimized_result)
+    return optimized_model
+
+
+def print_comparison(baseline_name: str, baseline: Dict, optimized_name: str, optimized: Dict):
+    """
+    Print the latency, model size and accuracy of two versions of the model side by side,
+    and how often their predictions agree.
+    Each of baseline and optimized is a dict returned by the test function, plus a 'model_size' field.
+    """
+    print('=' * 50)
+    print(f'{"":<25}{baseline_name:>12}{optimized_name:>12}')
+    for name, key, fmt in [('Latency (ms/instance)', 'latency', '.2f'),
+                           ('Throughput (instances/s)', 'throughput', '.1f'),
+                           ('Model time (s)', 'model_time', '.2f'),
+                           ('Total time (s)', 'total_time', '.2f'),
+                           ('Data wait (s)', 'data_wait', '.2f'),
+                           ('Model size (MB)', 'model_size', '.1f'),
+                           ('Total Accuracy (%)', 'total_accuracy', '.3f'),
+                           ('State Accuracy (%)', 'state_accuracy', '.3f'),
+                           ('Location Accuracy (%)', 'loc_accuracy', '.3f'),
+                           ('Scored loc pairs (%)', 'scored_loc_pairs', '.1f')]:
+        if key not in baseline or key not in optimized:
+            continue
+        print(f'{name:<25}{baseline[key]:>12{fmt}}{optimized[key]:>12{fmt}}')
+
+    print(f'Speedup: {baseline["model_time"] / optimized["model_time"]:.2f}x')
+    if 'total_accuracy' in baseline and 'total_accuracy' in optimized:
+        print(f'Total Accuracy difference: {optimized["total_accuracy"] - baseline["total_accuracy"]:+.3f}%')
+    print(f'Prediction agreement: {prediction_agreement(baseline["predictions"], optimized["predictions"]):.3f}% of the timesteps')
+    print('=' * 50)
+
+
+class OnnxRuntimeModel:
+    """
+    Run an NCET model exported to ONNX by export.py with ONNX Runtime on CPU.
+    The ONNX graph only computes the emission scores and the location scores,
+    Viterbi decoding is done on the host with the CRF transitions stored in the metadata of the ONNX model.
+    Called with the same arguments as NCETModel.predict, and returns the same values.
+    """
+    input_names = ['char_paragraph', 'entity_mask', 'verb_mask', 'loc_mask', 'num_cands', 'num_sents']
+    output_names = ['tag_logits', 'loc_logits']
+    crf_names = ['start_transitions', 'transitions', 'end_transitions']
+
+    def __init__(self, model_path: str):
+        onnxruntime = import_optional('onnxruntime', 'Running an ONNX model')
+        self.session = onnxruntime.InferenceSession(model_path, providers = ['CPUExecutionProvider'])
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.crf_params = {name: torch.tensor(json.loads(metadata[name])) for name in self.crf_names}
+
+
+    def __call__(self, char_paragraph, entity_mask, verb_mask, loc_mask, num_cands, num_sents):
+        inputs = [char_paragraph, entity_mask, verb_mask, loc_mask, num_cands, num_sents]
+        feeds = {name: tensor.cpu().numpy() for name, tensor in zip(self.input_names, inputs)}
+        tag_logits, loc_logits = [torch.from_numpy(output) for output in self.session.run(self.output_names, feeds)]
+
+        tag_mask = get_length_mask(lengths = num_sents.cpu(), max_len = entity_mask.size(-2))  # (batch, max_sents)
+        pred_state_seq = viterbi_decode(tag_logits.transpose(0, 1), mask = tag_mask.transpose(0, 1),
+                                        pad_value = PAD_STATE, **self.crf_params).transpose(0, 1)
+        pred_loc_seq = torch.argmax(loc_logits, dim = -1).masked_fill(~tag_mask, value = PAD_LOC)
+        return pred_state_seq, pred_loc_seq
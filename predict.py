@@ -58,7 +58,7 @@ def get_output(metadata: Dict, pred_state_seq: List[int], pred_loc_seq: List[int
     total_sents = metadata['total_sents']
 
     pred_state_seq = [idx2state[idx] for idx in pred_state_seq]  # pred_state_seq outside the function won't be changed
-    pred_loc_seq = [loc_cand_list[idx] for idx in pred_loc_seq]  # pred_loc_seq outside the function won't be changed
+    pred_loc_seq = [loc_cand_list[idx] if idx >= 0 else '?' for idx in pred_loc_seq]  # negative: no prediction (lazy location scoring)
 
     pred_loc_seq = predict_consistent_loc(pred_state_seq = pred_state_seq, pred_loc_seq = pred_loc_seq)
     prediction = format_final_prediction(pred_state_seq = pred_state_seq, pred_loc_seq = pred_loc_seq)
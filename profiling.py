@@ -0,0 +1,141 @@
+import time
+import contextlib
+import numpy as np
+import torch
+from utils import require_torch
+
+
+class PhaseProfiler:
+    """
+    Wall time of the phases of every step (a training step or a test batch). Phases are timed by "with profiler.phase(name)",
+    or measured elsewhere and added by add() (as background phases if they overlap the step, e.g. on another thread),
+    and step() ends the current step. Only the outermost phase is timed when
+    phases are nested, e.g. the model phases inside the evaluation phase of a training step.
+    On GPU, the device is synchronized around every phase so the times include its kernels, which slows the steps down.
+    Optionally, the steps [trace_start, trace_start + trace_steps) are also recorded by torch.profiler and exported
+    as a Chrome trace (chrome://tracing), with the phases as labeled ranges.
+    A disabled profiler does nothing.
+    """
+    def __init__(self, enabled: bool = True, cuda: bool = False, trace_path: str = None, trace_start: int = 10, trace_steps: int = 5):
+        self.enabled = enabled
+        self.cuda = cuda
+        self.trace_path = trace_path
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.trace = None
+        self.phases = []  # names in order of first appearance
+        self.times = {}  # name -> list of (step, seconds)
+        self.background = set()
+        self.step_times = []
+        self.num_steps = 0
+        self.depth = 0
+        self.step_start_time = time.perf_counter()
+        if self.enabled and self.trace_path:
+            require_torch('1.8.1', 'Exporting a trace of the profiled steps (torch.profiler)')
+        if self.enabled and self.trace_path and self.trace_start == 0:
+            self.start_trace()
+
+
+    def phase(self, name: str):
+        if not self.enabled or self.depth > 0:
+            return contextlib.nullcontext()
+        return self.timed_phase(name)
+
+
+    @contextlib.contextmanager
+    def timed_phase(self, name: str):
+        self.depth += 1
+        self.synchronize()
+        start_time = time.perf_counter()
+        try:
+            with torch.autograd.profiler.record_function(name) if self.trace is not None else contextlib.nullcontext():
+                yield
+        finally:
+            self.synchronize()
+            self.depth -= 1
+            self.add(name, time.perf_counter() - start_time)
+
+
+    def add(self, name: str, seconds: float, background: bool = False):
+        if not self.enabled:
+            return
+        if background:
+            self.background.add(name)
+        if name not in self.times:
+            self.phases.append(name)
+            self.times[name] = []
+        self.times[name].append((self.num_steps, seconds))
+
+
+    def step(self):
+        if not self.enabled:
+            return
+        self.synchronize()
+        end_time = time.perf_counter()
+        self.step_times.append(end_time - self.step_start_time)
+        self.num_steps += 1
+        if self.trace_path and self.num_steps == self.trace_start:
+            self.start_trace()
+        elif self.trace is not None and self.num_steps == self.trace_start + self.trace_steps:
+            self.stop_trace()
+        self.step_start_time = time.perf_counter()
+
+
+    def start_trace(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.trace = torch.profiler.profile(activities = activities, record_shapes = True)
+        self.trace.__enter__()
+
+
+    def stop_trace(self):
+        self.trace.__exit__(None, None, None)
+        self.trace.export_chrome_trace(self.trace_path)
+        print(f'[INFO] Exported the trace of steps {self.trace_start + 1}-{self.num_steps} to {self.trace_path}')
+        self.trace = None
+
+
+    def close(self):
+        """
+        Export the trace if the run ended inside the trace window.
+        """
+        if self.trace is not None:
+            self.stop_trace()
+
+
+    def synchronize(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+
+    def report(self, title: str) -> str:
+        """
+        Percentiles of the time of each phase over the steps it ran in (in ms), its total time and its share of the
+        total time of the steps. "other" is the rest of the step time, e.g. metrics and Python overhead.
+        Background phases (marked by *) are not a part of the step time.
+        """
+        if not self.step_times:
+            return f'{title}: no step profiled'
+        step_times = np.array(self.step_times)
+        per_step = {name: np.zeros(len(step_times)) for name in self.phases}
+        for name in self.phases:
+            for step, seconds in self.times[name]:
+                if step < len(step_times):  # phases of an unfinished step are left out
+                    per_step[name][step] += seconds
+        other = step_times - sum(per_step[name] for name in self.phases if name not in self.background)
+
+        rows = []
+        for name in self.phases:
+            steps = sorted({step for step, _ in self.times[name] if step < len(step_times)})
+            rows.append((name + '*' * (name in self.background), per_step[name][steps]))
+        rows += [('other', other), ('step', step_times)]
+        lines = [f'{title}: {len(step_times)} steps, time per step (ms)',
+                 f'{"phase":<20}{"steps":>7}{"mean":>10}{"p50":>10}{"p90":>10}{"p99":>10}{"max":>10}{"total(s)":>10}{"share":>8}']
+        for name, times in rows:
+            if len(times) == 0:
+                continue
+            p50, p90, p99 = np.percentile(times, [50, 90, 99]) * 1000
+            lines.append(f'{name:<20}{len(times):>7}{times.mean() * 1000:>10.2f}{p50:>10.2f}{p90:>10.2f}{p99:>10.2f}'
+                         f'{times.max() * 1000:>10.2f}{times.sum():>10.2f}{times.sum() / step_times.sum() * 100:>7.1f}%')
+        return '\n'.join(lines)
@@ -0,0 +1,88 @@
+"""
+Serve an NCET model exported by export.py. Only depends on torch and the data utilities, not on allennlp or the model code.
+ONNX models additionally need onnxruntime, and always run on CPU.
+"""
+import time
+print('[INFO] Starting import...')
+import_start_time = time.time()
+import torch
+import argparse
+from torch.utils.data import DataLoader
+from Constants import *
+from utils import batch_to_char_ids, unpad
+from Dataset import ProparaDataset, Collate
+from predict import get_output, write_output
+from inference import OnnxRuntimeModel
+print(f'[INFO] Import modules time: {time.time() - import_start_time}s')
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('-model', type=str, required=True, help="path to the model exported by export.py")
+parser.add_argument('-format', type=str, choices=['torchscript', 'onnx'], default='torchscript', help="format of the exported model")
+parser.add_argument('-test_set', type=str, default="data/test.json", help="path to test set")
+parser.add_argument('-dummy_test', type=str, default="data/dummy-predictions.tsv", help="path to dummy prediction file")
+parser.add_argument('-output', type=str, required=True, help="path to store prediction outputs")
+parser.add_argument('-batch_size', type=int, default=64)
+parser.add_argument('-no_cuda', action='store_true', default=False, help="if true, will only use cpu")
+opt = parser.parse_args()
+
+
+def serve(test_set, model):
+
+    print('[INFO] Start predicting...')
+    test_batch = DataLoader(dataset = test_set, batch_size = opt.batch_size, shuffle = False, collate_fn = Collate())
+
+    start_time = time.time()
+    model_time = 0
+    output_result = {}
+
+    # input shapes change with every batch, so the profiling graph executor would keep re-specializing the graph,
+    # which costs much more than it saves
+    with torch.no_grad(), torch.jit.optimized_execution(False):
+        for batch in test_batch:
+
+            char_paragraph = batch_to_char_ids(batch['paragraph'])
+            entity_mask = batch['entity_mask']
+            verb_mask = batch['verb_mask']
+            loc_mask = batch['loc_mask']
+            metadata = batch['metadata']
+            num_cands = torch.IntTensor([meta['total_loc_cands'] for meta in metadata])
+            num_sents = torch.IntTensor([meta['total_sents'] for meta in metadata])
+
+            if not opt.no_cuda:
+                char_paragraph = char_paragraph.cuda()
+                entity_mask = entity_mask.cuda()
+                verb_mask = verb_mask.cuda()
+                loc_mask = loc_mask.cuda()
+                num_cands = num_cands.cuda()
+                num_sents = num_sents.cuda()
+
+            model_start_time = time.time()
+            pred_state_seq, pred_loc_seq = model(char_paragraph, entity_mask, verb_mask, loc_mask, num_cands, num_sents)
+            model_time += time.time() - model_start_time
+            pred_state_seq = [unpad(inst, pad_value = PAD_STATE) for inst in pred_state_seq.tolist()]
+            pred_loc_seq = [unpad(inst, pad_value = PAD_LOC) for inst in pred_loc_seq.tolist()]
+
+            for i in range(len(metadata)):
+                pred_instance = get_output(metadata = metadata[i], pred_state_seq = pred_state_seq[i], pred_loc_seq = pred_loc_seq[i])
+                output_result[str(pred_instance['id']) + '-' + pred_instance['entity']] = pred_instance
+
+    write_output(output = output_result, dummy_filepath = opt.dummy_test, output_filepath = opt.output)
+    print(f'[INFO] Prediction finished. Model time: {model_time:.2f}s ({model_time / len(test_set) * 1000:.2f} ms/instance), '
+          f'time elapse: {time.time() - start_time}s')
+
+
+if __name__ == "__main__":
+    test_set = ProparaDataset(opt.test_set, is_test = True)
+
+    print('[INFO] Start loading exported model...')
+    load_start_time = time.time()
+    if opt.format == 'torchscript':
+        model = torch.jit.load(opt.model, map_location = 'cpu' if opt.no_cuda else 'cuda')
+        model.eval()
+    elif opt.format == 'onnx':
+        opt.no_cuda = True
+        model = OnnxRuntimeModel(opt.model)
+    print(f'[INFO] Loaded model from {opt.model}, time elapse: {time.time() - load_start_time}s')
+
+    serve(test_set, model)
@@ -0,0 +1,215 @@
+import os
+import json
+import math
+import time
+import random
+import argparse
+import itertools
+import contextlib
+import traceback
+import torch
+import numpy as np
+from typing import Callable, Dict, List, Tuple
+from Dataset import ProparaDataset, PreprocessedDataset
+from Model import NCETEmbedding, ElmoWordCache
+from utils import batch_to_char_ids
+
+
+def expand_sweep_spec(spec: Dict) -> List[Dict]:
+    """
+    List the hyper-parameter settings of the trials of a sweep, given by option name (without "-"). Either a grid search:
+        {"grid": {"lr": [1e-3, 3e-4], "dropout": [0.3, 0.5]}}
+    or a random search of "trials" settings, each value sampled from a list, from a "uniform" or "log_uniform" range,
+    or from a "randint" range of integers (both ends included):
+        {"random": {"lr": {"log_uniform": [1e-4, 1e-2]}, "hidden_size": {"randint": [64, 256]}}, "trials": 20, "seed": 1234}
+    """
+    if 'grid' in spec:
+        names = list(spec['grid'])
+        return [dict(zip(names, values)) for values in itertools.product(*[spec['grid'][name] for name in names])]
+
+    if 'random' in spec:
+        rng = random.Random(spec.get('seed', 1234))
+        settings = []
+        for _ in range(spec['trials']):
+            setting = {}
+            for name, space in spec['random'].items():
+                if isinstance(space, list):
+                    setting[name] = rng.choice(space)
+                elif 'uniform' in space:
+                    setting[name] = rng.uniform(*space['uniform'])
+                elif 'log_uniform' in space:
+                    low, high = space['log_uniform']
+                    setting[name] = math.exp(rng.uniform(math.log(low), math.log(high)))
+                elif 'randint' in space:
+                    setting[name] = rng.randint(*space['randint'])
+                else:
+                    raise ValueError(f'Unknown search space of {name}: {space}')
+            settings.append(setting)
+        return settings
+
+    raise ValueError('The sweep spec should have a "grid" or a "random" field')
+
+
+def check_setting(setting: Dict, parser: argparse.ArgumentParser) -> Dict:
+    """
+    Check the values of a hyper-parameter setting against the options of parser, and convert them to the option types,
+    e.g. an int option given 128.0 by a range. Raise a ValueError naming the option of a value of the wrong type.
+    """
+    actions = {action.dest: action for action in parser._actions}
+    checked = {}
+    for name, value in setting.items():
+        if name not in actions or name == 'help':
+            raise ValueError(f'Unknown option in the sweep spec: -{name}')
+        action = actions[name]
+
+        if action.nargs == 0:  # flags, e.g. -elmo_cache
+            if not isinstance(value, bool):
+                raise ValueError(f'Option -{name} of the sweep spec is a flag and expects true or false, got {value!r}')
+            checked[name] = value
+            continue
+
+        if isinstance(value, bool):
+            raise ValueError(f'Option -{name} of the sweep spec is not a flag and expects a value of its type, got {value!r}')
+        if action.type is int and isinstance(value, float):
+            if not value.is_integer():
+                raise ValueError(f'Option -{name} of the sweep spec expects an integer, got {value!r}')
+            value = int(value)
+        try:
+            value = action.type(value) if action.type is not None else value
+        except (TypeError, ValueError):
+            type_name = getattr(action.type, '__name__', str(action.type))
+            raise ValueError(f'Option -{name} of the sweep spec expects a value of type {type_name}, got {value!r}') from None
+        if action.choices is not None and value not in action.choices:
+            raise ValueError(f'Option -{name} of the sweep spec expects one of {list(action.choices)}, got {value!r}')
+        checked[name] = value
+
+    return checked
+
+
+def load_resources(opt: argparse.Namespace) -> Dict:
+    """
+    Preprocess the datasets and load Elmo (with its word cache with -elmo_cache) once for all the trials of a sweep,
+    in shared memory so the processes of the pool read them without a copy.
+    """
+    train_path, dev_path = ('data/debug.json', 'data/debug.json') if opt.debug else (opt.train_set, opt.dev_set)
+    train_set = PreprocessedDataset(ProparaDataset(train_path, is_test = False)).share_memory()
+    dev_set = PreprocessedDataset(ProparaDataset(dev_path, is_test = False)).share_memory()
+    elmo_bilm, word_cache = None, None
+    if opt.embedding == 'elmo':
+        elmo_bilm = NCETEmbedding.build_bilm(opt.elmo_dir)
+        if opt.elmo_cache:
+            word_cache = ElmoWordCache()
+            vocabulary = dev_set.vocabulary() + train_set.vocabulary()
+            with torch.no_grad():
+                word_cache.add_words(batch_to_char_ids([vocabulary]).squeeze(dim = 0).tolist(),
+                                     token_embedder = elmo_bilm._token_embedder)
+            word_cache.share_memory()
+        elmo_bilm.share_memory()
+    return {'train_set': train_set, 'dev_set': dev_set, 'elmo_bilm': elmo_bilm, 'word_cache': word_cache}
+
+
+# set in every process of the sweep pool by init_worker
+worker_opt = None
+worker_train_fn = None
+worker_resources = {}
+
+
+def init_worker(opt: argparse.Namespace, train_fn: Callable, resource_queue: torch.multiprocessing.Queue):
+    """
+    Initializer of the processes of the sweep pool. The shared resources come through a queue,
+    shared tensors cannot be passed as arguments of a spawned process.
+    """
+    global worker_opt, worker_train_fn
+    worker_opt, worker_train_fn = opt, train_fn
+    worker_resources.update(resource_queue.get())
+    torch.set_num_threads(max(1, os.cpu_count() // opt.max_parallel))  # the trials share the CPU cores of the machine
+
+
+def run_trial(trial: Tuple[int, Dict]) -> Dict:
+    """
+    Train the model of one hyper-parameter setting of a sweep, in a process of the sweep pool.
+    Its output goes to trial_{id}.log and its checkpoints to trial_{id}/ in -sweep_dir.
+    """
+    trial_id, setting = trial
+    trial_opt = argparse.Namespace(**{**vars(worker_opt), **setting})
+    trial_opt.mode = 'train'
+    trial_opt.ckpt_dir = os.path.join(worker_opt.sweep_dir, f'trial_{trial_id}')
+    os.makedirs(trial_opt.ckpt_dir, exist_ok = True)
+    torch.manual_seed(1234)  # every trial starts from the same random state, like a separate run
+    torch.cuda.manual_seed(1234)
+
+    start_time = time.time()
+    best_score = None
+    with open(os.path.join(worker_opt.sweep_dir, f'trial_{trial_id}.log'), 'w', encoding='utf-8') as trial_log, \
+            contextlib.redirect_stdout(trial_log):
+        print(f'Trial {trial_id}: {setting}')
+        try:
+            best_score = worker_train_fn(trial_opt, worker_resources)
+        except Exception:  # a failed trial (e.g. out of memory) does not stop the sweep
+            traceback.print_exc(file = trial_log)
+
+    return {'trial': trial_id, **setting, 'best_score': best_score, 'time': time.time() - start_time}
+
+
+def sweep(opt: argparse.Namespace, parser: argparse.ArgumentParser, train_fn: Callable, output: Callable):
+    """
+    Train one model per hyper-parameter setting of -sweep_spec, -max_parallel at a time in a pool of processes,
+    and gather their best dev scores into one table. train_fn(trial_opt, resources) trains the model of a trial
+    and returns its best dev score, it must be picklable, i.e. a module-level function.
+    """
+    if not opt.sweep_spec or not opt.sweep_dir:
+        print("[ERROR] Entered sweep mode but no sweep spec or sweep directory is specified.")
+        raise RuntimeError("Did not specify -sweep_spec or -sweep_dir option")
+    if opt.nproc * opt.nnodes > 1 or opt.stream or opt.resume:
+        raise RuntimeError("-nproc, -nnodes, -stream and -resume are not supported in sweep mode")
+    if opt.async_eval or opt.num_workers > 0:
+        output('[WARNING] The trials of a sweep cannot start processes, -async_eval and -num_workers are disabled')
+        opt.async_eval, opt.num_workers = False, 0
+
+    with open(opt.sweep_spec, 'r', encoding='utf-8') as spec_file:
+        settings = expand_sweep_spec(json.load(spec_file))
+    settings = [check_setting(setting, parser) for setting in settings]  # fail before loading anything
+    names = list(dict.fromkeys(name for setting in settings for name in setting))
+    os.makedirs(opt.sweep_dir, exist_ok = True)
+
+    start_time = time.time()
+    resources = load_resources(opt)
+    output(f'[INFO] Prepared the data and Elmo shared by {len(settings)} trials, time elapse: {time.time() - start_time:.2f}s')
+
+    results = []
+    processes = min(opt.max_parallel, len(settings))
+    context = torch.multiprocessing.get_context('spawn')  # CUDA cannot be used in forked processes
+    resource_queue = context.Queue()
+    for _ in range(processes):
+        resource_queue.put(resources)
+    with context.Pool(processes = processes, initializer = init_worker, initargs = (opt, train_fn, resource_queue)) as pool:
+        for result in pool.imap_unordered(run_trial, enumerate(settings)):
+            results.append(result)
+            if result['best_score'] is None:
+                output(f'[ERROR] Trial {result["trial"]} failed, see trial_{result["trial"]}.log')
+            else:
+                output(f'[INFO] Trial {result["trial"]} finished ({len(results)}/{len(settings)}), '
+                       f'best score: {result["best_score"]:.3f}, time elapse: {result["time"]:.2f}s')
+
+    results.sort(key = lambda result: result['best_score'] if result['best_score'] is not None else np.NINF, reverse = True)
+    columns = ['trial'] + names + ['best_score', 'time']
+    rows = [[str(result['trial'])] + [format_value(result[name]) if name in result else '' for name in names] +
+            [f'{result["best_score"]:.3f}' if result['best_score'] is not None else 'failed', f'{result["time"]:.1f}s']
+            for result in results]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    output('*' * 50)
+    output('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        output('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+
+    table_path = os.path.join(opt.sweep_dir, 'results.tsv')
+    with open(table_path, 'w', encoding='utf-8') as table_file:
+        for row in [columns] + rows:
+            table_file.write('\t'.join(row) + '\n')
+    output(f'[INFO] Sweep results saved to {table_path}, total time elapse: {time.time() - start_time:.2f}s')
+
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        return f'{value:.4g}'
+    return str(value)
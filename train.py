@@ -14,14 +14,24 @@ import numpy as np
 from typing import List, Dict
 from Constants import *
 import argparse
+import functools
+import multiprocessing
 # from torchsummaryX import summary
 # from tensorboardX import SummaryWriter
+import torch.distributed as dist
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from allennlp.modules.elmo import batch_to_ids
 from utils import *
 from predict import *
 from Dataset import *
 from Model import *
+from inference import quantize_model, check_bfloat16_support, convert_to_bfloat16, compare_with_float, print_comparison
+from evaluation import run_evaluation, AsyncEvaluator
+from checkpoint import slim_checkpoint, restore_model, CheckpointWriter
+from training_state import get_training_state, save_training_state, load_training_state, skip_trained_batches
+from sweep import sweep
+from profiling import PhaseProfiler
 import datetime as dt
 print(f'[INFO] Import modules time: {time.time() - import_start_time}s')
 torch.set_printoptions(threshold=np.inf)
@@ -39,49 +49,126 @@ parser.add_argument('-elmo_dropout', type=float, default=0.5, help="dropout rate
 parser.add_argument('-loc_loss', type=float, default=1.0, help="hyper-parameter to weight location loss and state_loss")
 
 # training parameters
-parser.add_argument('-mode', type=str, choices=['train', 'test'], default='train', help="train or test")
+parser.add_argument('-mode', type=str, choices=['train', 'test', 'sweep'], default='train',
+                    help="train, test, or sweep: train one model per hyper-parameter setting of -sweep_spec")
 parser.add_argument('-ckpt_dir', type=str, default=None, help="checkpoint directory")
 parser.add_argument('-save_mode', type=str, choices=['best', 'all', 'none'], default='best',
                     help="best (default): save checkpoints when reaching new best score; all: save all checkpoints; none: don't save")
 parser.add_argument('-epoch', type=int, default=100, help="number of epochs, use -1 to rely on early stopping only")
 parser.add_argument('-impatience', type=int, default=20, help='number of evaluation rounds for early stopping, use -1 to disable early stopping')
 parser.add_argument('-report', type=int, default=2, help="report frequence per epoch, should be at least 1")
+parser.add_argument('-train_metrics', type=str, choices=['all', 'report'], default='all',
+                    help="all (default): decode and compute training accuracy on every batch; "
+                         "report: only compute losses, decode and compute accuracy on the batches that report")
+parser.add_argument('-checkpoint_activations', action='store_true', default=False,
+                    help="recompute the activations of the encoder and the location decoder in the backward pass "
+                         "instead of storing them, lowering the peak memory of training at the cost of extra computation")
 parser.add_argument('-elmo_dir', type=str, default='elmo', help="directory that contains options and weight files for allennlp Elmo")
+parser.add_argument('-embedding', type=str, choices=['elmo', 'static'], default='elmo',
+                    help="embedding backend. elmo: allennlp Elmo. static: memory-mapped word vectors + character CNN, much faster")
+parser.add_argument('-word_vectors', type=str, default=None,
+                    help="word vectors (.npy, created by utils.convert_word_vectors) of the static embedding backend")
+parser.add_argument('-elmo_cache', action='store_true', default=False,
+                    help="cache the context-independent token embeddings of Elmo by word, precomputed over the vocabulary "
+                         "of the data, so the character CNN of Elmo only runs once per word")
 parser.add_argument('-train_set', type=str, default="data/train.json", help="path to training set")
 parser.add_argument('-dev_set', type=str, default="data/dev.json", help="path to dev set")
+parser.add_argument('-stream', action='store_true', default=False,
+                    help="stream the training set from JSONL file(s) instead of loading it into memory, "
+                         "-train_set should be a JSONL file, a directory of shards or a glob pattern")
+parser.add_argument('-shuffle_buffer', type=int, default=10000, help="size of the shuffle buffer in streaming mode")
+parser.add_argument('-num_workers', type=int, default=0, help="number of DataLoader worker processes for the training set")
+parser.add_argument('-nproc', type=int, default=1,
+                    help="number of training processes on this machine. If more than one process is used in total, "
+                         "train data-parallel with torch.distributed (gloo backend): every process trains on its own "
+                         "shard of the training set with -batch_size instances per step, and the gradients are averaged")
+parser.add_argument('-nnodes', type=int, default=1, help="number of machines of distributed training, each runs -nproc processes")
+parser.add_argument('-node_rank', type=int, default=0, help="rank of this machine in distributed training")
+parser.add_argument('-master_addr', type=str, default='127.0.0.1', help="address of the machine with -node_rank 0")
+parser.add_argument('-master_port', type=int, default=29500, help="free port on the machine with -node_rank 0")
+parser.add_argument('-prefetch', type=int, default=2,
+                    help="number of batches whose inputs are prepared ahead on a background thread while the model runs")
+parser.add_argument('-state_interval', type=int, default=0,
+                    help="if positive, save the full training state (model, optimizer, counters, best score and random states) "
+                         "to -ckpt_dir every this number of batches and at the end of every epoch, to be continued by -resume")
+parser.add_argument('-resume', action='store_true', default=False,
+                    help="continue training bit-for-bit from the training state saved in -ckpt_dir")
+parser.add_argument('-async_eval', action='store_true', default=False,
+                    help="evaluate snapshots of the weights on the dev set in a background process while training continues, "
+                         "checkpointing and early stopping act on the results as they arrive")
+parser.add_argument('-eval_threads', type=int, default=0,
+                    help="number of CPU threads of the -async_eval process, 0 for the torch default")
+
+# sweep parameters
+parser.add_argument('-sweep_spec', type=str, default=None,
+                    help="JSON file of the hyper-parameter search of sweep mode, a grid or a random search over the "
+                         "options of this script (see sweep.expand_sweep_spec), the other options are shared by all trials")
+parser.add_argument('-sweep_dir', type=str, default=None,
+                    help="directory of the logs, checkpoints and result table of the trials in sweep mode")
+parser.add_argument('-max_parallel', type=int, default=2, help="number of trials trained at the same time in sweep mode")
 
 # test parameters
 parser.add_argument('-test_set', type=str, default="data/test.json", help="path to test set")
 parser.add_argument('-restore', type=str, default=None, help="restoring model path")
 parser.add_argument('-dummy_test', type=str, default="data/dummy-predictions.tsv", help="path to dummy prediction file")
 parser.add_argument('-output', type=str, default=None, help="path to store prediction outputs")
+parser.add_argument('-quantize', type=str, choices=['none', 'dynamic'], default='none',
+                    help="dynamic: apply int8 dynamic quantization to LSTM and Linear modules for CPU inference, "
+                         "and compare latency, model size and accuracy with the float model")
+parser.add_argument('-precision', type=str, choices=['fp32', 'bf16'], default='fp32',
+                    help="bf16: run CPU inference with bfloat16 weights and activations (CRF decoding stays in fp32), "
+                         "and compare latency, accuracy and predictions with the fp32 model")
+parser.add_argument('-stateless_elmo', action='store_true', default=False,
+                    help="start every test batch from zero Elmo states, like the models exported by export.py, "
+                         "instead of the final states of the previous batch")
+parser.add_argument('-lazy_loc', action='store_true', default=False,
+                    help="decode the states first, and only score the locations of the entities with a C or M step, "
+                         "which are the only locations kept in the output")
+parser.add_argument('-loc_topk', type=int, default=0,
+                    help="if positive, only keep the k best location candidates of each instance by a cheap pre-ranking "
+                         "before running the location decoder")
 
 # other parameters
 parser.add_argument('-debug', action='store_true', default=False, help="enable debug mode, change data files to debug data")
 parser.add_argument('-no_cuda', action='store_true', default=False, help="if true, will only use cpu")
 parser.add_argument('-log_dir', type=str, default=None, help="the log directory to store training logs")
 parser.add_argument('-log_file', type=str, default=None, help="the log file to store training logs")
+parser.add_argument('-profile', action='store_true', default=False,
+                    help="record the wall time of the phases of every training step or test batch (data wait, batch_to_ids, "
+                         "embedding, TokenEncoder, StateTracker, CRF, LocationPredictor, backward, optimizer, evaluation) "
+                         "and print their percentiles, after every epoch and after testing")
+parser.add_argument('-profile_trace', type=str, default=None,
+                    help="with -profile, also export a torch.profiler Chrome trace of the steps in the window below to this file")
+parser.add_argument('-trace_start', type=int, default=10, help="number of steps before the window of -profile_trace")
+parser.add_argument('-trace_steps', type=int, default=5, help="number of steps in the window of -profile_trace")
 
 opt = parser.parse_args()
 
-if opt.log_dir and opt.log_file is None:
+# processes spawned by -async_eval and -nproc re-import this script, they should not create or truncate the log
+is_main_process = multiprocessing.current_process().name == 'MainProcess'
+log_file = None
+
+if is_main_process and opt.log_dir and opt.log_file is None:
     current_time = dt.datetime.now().strftime("%m-%d.%H-%M-%S")
     log_path = os.path.join(opt.log_dir, current_time + '.log')
     log_file = open(log_path, 'w', encoding='utf-8')
 
-if opt.log_file:
+if is_main_process and opt.log_file:
     log_file = open(opt.log_file, 'w', encoding='utf-8')
 
 
 def output(text):
+    if dist.is_initialized() and dist.get_rank() != 0:  # only the first process of distributed training logs
+        return
     print(text)
-    if opt.log_dir:
+    if log_file is not None:
         print(text, file = log_file)
 
 
-output('Received arguments:')
-output(opt)
-output('-' * 50)
+if is_main_process:
+    output('Received arguments:')
+    output(opt)
+    output('-' * 50)
 
 assert opt.report >= 1
 
@@ -89,7 +176,11 @@ torch.manual_seed(1234)
 torch.cuda.manual_seed(1234)
 
 
-def save_model(path: str, model: nn.Module):
+def save_model(path: str, model: nn.Module, writer: CheckpointWriter, snapshot: Dict[str, torch.Tensor] = None):
+    """
+    Save the weights of the model, or the weights in the snapshot of AsyncEvaluator, as a slim checkpoint
+    (without the frozen Elmo weights) written in the background by the writer.
+    """
     if opt.save_mode == 'none':
         return
 
@@ -100,34 +191,183 @@ def save_model(path: str, model: nn.Module):
     if not os.path.exists(opt.ckpt_dir):
         os.mkdir(opt.ckpt_dir)
 
-    model_state_dict = model.state_dict()
-    torch.save(model_state_dict, path)
+    writer.save(slim_checkpoint(model, snapshot), path)
+
+
+class ScoreTracker:
+    """
+    Track the best dev score, save checkpoints and stop training early according to the dev scores.
+    """
+    def __init__(self):
+        self.best_score = np.NINF
+        self.impatience = 0
+        self.writer = CheckpointWriter()
+
+
+    def update(self, eval_score: float, model: nn.Module, snapshot: Dict[str, torch.Tensor] = None):
+        """
+        Handle a new dev score of the model weights (or of a snapshot of them, see save_model).
+        Return whether training should stop early.
+        """
+        if eval_score > self.best_score:  # new best score
+            self.best_score = eval_score
+            self.impatience = 0
+            output('New best score!')
+            if opt.save_mode == 'all':
+                save_model(os.path.join(opt.ckpt_dir, f'best_checkpoint_{self.best_score:.3f}.pt'), model, self.writer, snapshot)
+            elif opt.save_mode == 'best':
+                save_model(os.path.join(opt.ckpt_dir, f'best_checkpoint.pt'), model, self.writer, snapshot)
+        else:
+            self.impatience += 1
+            output(f'Impatience: {self.impatience}, best score: {self.best_score:.3f}.')
+            if opt.save_mode == 'all':
+                save_model(os.path.join(opt.ckpt_dir, f'checkpoint_{eval_score:.3f}.pt'), model, self.writer, snapshot)
+            if self.impatience >= opt.impatience:
+                output('Early Stopping!')
+                return True
+        return False
+
+
+def get_batches(dataset, shuffle: bool = False, sampler = None, num_workers: int = 0) -> BatchPrefetcher:
+    """
+    Batches of the dataset with all model inputs ready on the target device, prepared on a background thread.
+    """
+    data_loader = DataLoader(dataset = dataset, batch_size = opt.batch_size, shuffle = shuffle, sampler = sampler,
+                             collate_fn = Collate(), num_workers = num_workers)
+    return BatchPrefetcher(data_loader, to_char_ids = batch_to_ids, cuda = not opt.no_cuda, queue_size = opt.prefetch)
+
+
+def evaluate_candidate_recall(test_set, model, ks: List[int]) -> Dict[int, float]:
+    """
+    Recall@k of the candidate pre-ranking (NCETModel.rank_candidates): the percentage of the steps whose gold location
+    is in the candidate set, for which the gold candidate is ranked in the top k.
+    """
+    test_batch = get_batches(test_set)
+    hits = {k: 0 for k in ks}
+    total = 0
+
+    with torch.no_grad():
+        for batch in test_batch:
+
+            entity_mask = batch['entity_mask']
+            loc_mask = batch['loc_mask']
+            gold_loc_seq = batch['gold_loc_seq']
+            num_cands = batch['num_cands']
+
+            token_rep = model.encode(batch['char_paragraph'], batch['verb_mask'])
+            scores = model.rank_candidates(token_rep, entity_mask = entity_mask, loc_mask = loc_mask, num_cands = num_cands)
+            has_gold = torch.ge(gold_loc_seq, 0)  # (batch, max_sents)
+            gold_scores = scores.gather(dim = 1, index = gold_loc_seq.clamp(min = 0).long())  # (batch, max_sents)
+            gold_rank = torch.sum(scores.unsqueeze(dim = 1) > gold_scores.unsqueeze(dim = -1), dim = -1)  # (batch, max_sents)
 
+            for k in ks:
+                hits[k] += torch.sum((gold_rank < k) & has_gold).item()
+            total += torch.sum(has_gold).item()
 
-def train():
+    return {k: hits[k] / max(total, 1) * 100 for k in ks}
 
-    train_set = ProparaDataset(opt.train_set, is_test = False)
-    shuffle_train = True
-    if opt.debug:
+
+def report_candidate_pruning(test_set, model):
+    """
+    Report the recall@k of the candidate pre-ranking on the whole test set, and the speedup of -loc_topk
+    on the long-tail paragraphs, which have more than k candidates.
+    """
+    model.EmbeddingLayer.reset_states()
+    recall = evaluate_candidate_recall(test_set, model, ks = sorted({1, 3, 5, 10, opt.loc_topk}))
+    print('[INFO] Candidate pre-ranking recall: ' + ', '.join(f'@{k} {value:.2f}%' for k, value in recall.items()))
+
+    long_tail = [idx for idx, instance in enumerate(test_set.dataset) if instance['total_loc_candidates'] > opt.loc_topk]
+    if not long_tail:
+        print(f'[INFO] No paragraph has more than {opt.loc_topk} candidates')
+        return
+    long_tail_set = torch.utils.data.Subset(test_set, long_tail)
+    print(f'[INFO] Timing {len(long_tail)} instances with more than {opt.loc_topk} candidates...')
+    model.EmbeddingLayer.reset_states()
+    full_result = test(long_tail_set, model, write_prediction = False)
+    model.EmbeddingLayer.reset_states()
+    pruned_result = test(long_tail_set, model, write_prediction = False, loc_topk = opt.loc_topk)
+    print(f'[INFO] Long-tail paragraphs: model time {full_result["model_time"]:.2f}s -> {pruned_result["model_time"]:.2f}s, '
+          f'speedup {full_result["model_time"] / pruned_result["model_time"]:.2f}x')
+
+
+def cache_elmo_words(model: NCETModel, vocabulary: List[str]):
+    start_time = time.time()
+    model.EmbeddingLayer.cache_words(vocabulary)
+    print(f'[INFO] Cached the Elmo token embeddings of {len(set(vocabulary))} words, time elapse: {time.time() - start_time}s')
+
+
+def train(resources: Dict = None) -> float:
+    """
+    Train a model with the options in opt and return its best dev score. The datasets, the Elmo biLM and the Elmo
+    word cache are loaded here unless resources gives them, e.g. shared by the trials of a sweep (see sweep.load_resources).
+    """
+    resources = resources or {}
+    train_set, dev_set = resources.get('train_set'), resources.get('dev_set')
+    elmo_bilm, word_cache = resources.get('elmo_bilm'), resources.get('word_cache')
+    if (opt.state_interval > 0 or opt.resume) and not opt.ckpt_dir:
+        print("[ERROR] Intended to save or resume the training state but no checkpoint directory is specified.")
+        raise RuntimeError("Did not specify -ckpt_dir option")
+
+    # in distributed training, only the process of rank 0 evaluates, logs and saves checkpoints
+    distributed = dist.is_initialized()
+    rank = dist.get_rank() if distributed else 0
+    if distributed and opt.stream:
+        raise RuntimeError("-stream is not supported by distributed training, the shards of the processes must be of equal size")
+    if distributed and (opt.state_interval > 0 or opt.resume):
+        raise RuntimeError("-state_interval and -resume are not supported by distributed training, "
+                           "the random states of the other processes are not saved")
+
+    if train_set is not None:
+        pass
+    elif opt.stream:
+        train_set = ProparaIterableDataset(opt.train_set, is_test = False, shuffle_buffer = opt.shuffle_buffer, seed = 1234)
+    else:
+        train_set = ProparaDataset(opt.train_set, is_test = False)
+    shuffle_train = not opt.stream  # streaming dataset shuffles through its own buffer
+    if opt.debug and not isinstance(train_set, PreprocessedDataset):
         print('*'*20 + '[INFO] Debug mode enabled. Switch training set to debug.json' + '*'*20)
         train_set = ProparaDataset('data/debug.json', is_test = False)
         shuffle_train = False
 
-    train_batch = DataLoader(dataset = train_set, batch_size = opt.batch_size, shuffle = shuffle_train, collate_fn = Collate())
-    dev_set = ProparaDataset(opt.dev_set, is_test = False)
+    if distributed:
+        train_sampler = DistributedSampler(train_set, shuffle = shuffle_train)  # equal-sized shard of every epoch
+        train_batch = get_batches(train_set, sampler = train_sampler, num_workers = opt.num_workers)
+    else:
+        train_sampler = None
+        train_batch = get_batches(train_set, shuffle = shuffle_train, num_workers = opt.num_workers)
+    dev_path = opt.dev_set
 
     if opt.debug:
         print('*'*20 + '[INFO] Debug mode enabled. Switch dev set to debug.json' + '*'*20)
-        dev_set = ProparaDataset('data/debug.json', is_test = False)
-
-    model = NCETModel(opt = opt, is_test = False)
+        dev_path = 'data/debug.json'
+    if dev_set is None:
+        dev_set = ProparaDataset(dev_path, is_test = False)
+
+    model = NCETModel(opt = opt, is_test = False, elmo_bilm = elmo_bilm, word_cache = word_cache)
+    evaluator = AsyncEvaluator(opt, dev_path = dev_path) if opt.async_eval and rank == 0 else None
+    if opt.elmo_cache and word_cache is None:
+        # words of streamed shards are cached on the fly
+        vocabulary = dev_set.vocabulary() + (train_set.vocabulary() if not isinstance(train_set, ProparaIterableDataset) else [])
+        cache_elmo_words(model, vocabulary)
     if not opt.no_cuda:
         model.cuda()
+    if distributed:
+        broadcast_parameters(model)
+        torch.manual_seed(1234 + rank)  # different dropout masks in different processes
 
     optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr=opt.lr)
-    best_score = np.NINF
-    impatience = 0
+    score_tracker = ScoreTracker()
+    profiler = model.profiler = get_profiler(enabled = opt.profile and rank == 0)
     epoch_i = 0
+    resume_state = None
+
+    if opt.resume:
+        resume_state = load_training_state(opt.ckpt_dir, model, optimizer)
+        score_tracker.best_score = resume_state['best_score']
+        score_tracker.impatience = resume_state['impatience']
+        epoch_i = resume_state['epoch']
+        output(f'Resumed training from {opt.ckpt_dir}: epoch {epoch_i + 1}, batch {resume_state["batch_cnt"]}, '
+               f'best score: {score_tracker.best_score:.3f}, impatience: {score_tracker.impatience}')
 
     if opt.epoch == -1:
         opt.epoch = np.inf
@@ -136,77 +376,98 @@ def train():
         opt.impatience = np.inf
 
     print('Start training...')
+    stop_training = False
 
-    while epoch_i < opt.epoch:
+    while epoch_i < opt.epoch and not stop_training:
 
         model.train()
-        train_instances = len(train_set)
+        if isinstance(train_set, ProparaIterableDataset):
+            train_set.set_epoch(epoch_i)
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch_i)
+        train_instances = len(train_sampler) if train_sampler is not None else len(train_set)
 
         start_time = time.time()
+        report_wait_time = train_batch.wait_time
         report_state_loss, report_loc_loss = 0, 0
         report_state_correct, report_state_pred = 0, 0
         report_loc_correct, report_loc_pred = 0, 0
+        report_state_tokens, report_loc_tokens = 0, 0
         batch_cnt = 0
 
-        if train_instances % opt.batch_size == 0:
+        if resume_state is not None:  # continue the epoch of the saved training state
+            torch.set_rng_state(resume_state['epoch_rng_state'])  # replay the data order of the epoch
+            report_state_loss, report_loc_loss, report_state_correct, report_state_pred, report_loc_correct, \
+                report_loc_pred, report_state_tokens, report_loc_tokens = resume_state['report']
+            batch_cnt = resume_state['batch_cnt']
+        epoch_rng_state = torch.get_rng_state()
+
+        if isinstance(train_set, ProparaIterableDataset):  # every DataLoader worker yields its own last partial batch
+            total_batches = train_set.num_batches(batch_size = opt.batch_size, num_workers = opt.num_workers)
+        elif train_instances % opt.batch_size == 0:
             total_batches = train_instances // opt.batch_size
         else:
             total_batches = train_instances // opt.batch_size + 1
         report_batch = get_report_time(total_batches = total_batches, report_times = opt.report)  # when to report results
 
-        for batch in train_batch:
+        batches = iter(train_batch)
+        if resume_state is not None:
+            skip_trained_batches(batches, resume_state)
+            resume_state = None
+
+        profiled_wait_time = train_batch.wait_time
+        for batch in batches:
+            profiler.add('data wait', train_batch.wait_time - profiled_wait_time)
+            profiler.add('batch_to_ids', train_batch.char_ids_time, background = True)
+            profiled_wait_time = train_batch.wait_time
             # with open('logs/debug.log', 'w', encoding='utf-8') as debug_file:
             #     torch.set_printoptions(threshold=np.inf)
             #     print(batch, file = debug_file)
             model.zero_grad()
 
-            paragraphs = batch['paragraph']
-            char_paragraph = batch_to_ids(paragraphs)
-            entity_mask = batch['entity_mask']
-            verb_mask = batch['verb_mask']
-            loc_mask = batch['loc_mask']
-            gold_loc_seq = batch['gold_loc_seq']
-            gold_state_seq = batch['gold_state_seq']
-            metadata = batch['metadata']
-            num_cands = torch.IntTensor([meta['total_loc_cands'] for meta in metadata])
-
-            if not opt.no_cuda:
-                char_paragraph = char_paragraph.cuda()
-                entity_mask = entity_mask.cuda()
-                verb_mask = verb_mask.cuda()
-                loc_mask = loc_mask.cuda()
-                gold_loc_seq = gold_loc_seq.cuda()
-                gold_state_seq = gold_state_seq.cuda()
-                num_cands = num_cands.cuda()
-
-            train_result = model(char_paragraph = char_paragraph, entity_mask = entity_mask, verb_mask = verb_mask,
-                                 loc_mask = loc_mask, gold_loc_seq = gold_loc_seq, gold_state_seq = gold_state_seq,
-                                 num_cands = num_cands)
+            # in "report" mode, only the batches that report run Viterbi decoding and accuracy computation
+            compute_metrics = opt.train_metrics == 'all' or (batch_cnt + 1) in report_batch
+            train_result = model(char_paragraph = batch['char_paragraph'], entity_mask = batch['entity_mask'],
+                                 verb_mask = batch['verb_mask'], loc_mask = batch['loc_mask'],
+                                 gold_loc_seq = batch['gold_loc_seq'], gold_state_seq = batch['gold_state_seq'],
+                                 num_cands = batch['num_cands'], compute_metrics = compute_metrics)
 
             train_state_loss, train_loc_loss, train_state_correct, train_state_pred,\
                 train_loc_correct, train_loc_pred = train_result
 
             train_loss = train_state_loss + opt.loc_loss * train_loc_loss
-            train_loss.backward()
-            optimizer.step()
-
-            report_state_loss += train_state_loss.item() * train_state_pred
-            report_loc_loss += train_loc_loss.item() * train_loc_pred
-            report_state_correct += train_state_correct
-            report_state_pred += train_state_pred
-            report_loc_correct += train_loc_correct
-            report_loc_pred += train_loc_pred
+            with profiler.phase('backward'):
+                train_loss.backward()
+            if distributed:
+                with profiler.phase('all-reduce'):
+                    all_reduce_gradients(model)
+            with profiler.phase('optimizer'):
+                optimizer.step()
+
+            # the losses are averaged over tokens, sum them weighted by token counts on device to avoid a host sync per batch
+            report_state_loss += train_state_loss.detach() * train_state_pred
+            report_loc_loss += train_loc_loss.detach() * train_loc_pred
+            report_state_tokens += train_state_pred
+            report_loc_tokens += train_loc_pred
+            if compute_metrics:
+                report_state_correct += train_state_correct
+                report_state_pred += train_state_pred
+                report_loc_correct += train_loc_correct
+                report_loc_pred += train_loc_pred
             batch_cnt += 1
 
             # time to report results
             if batch_cnt in report_batch:
 
-                state_loss = report_state_loss / report_state_pred  # average over all elements
-                loc_loss = report_loc_loss / report_loc_pred
+                state_loss = (report_state_loss / report_state_tokens).item()  # average over all elements
+                loc_loss = (report_loc_loss / report_loc_tokens).item()
+                # in "report" mode, the accuracies only cover the reporting batch
                 total_loss = state_loss + opt.loc_loss * loc_loss
                 state_accuracy = report_state_correct / report_state_pred
                 loc_accuracy = report_loc_correct / report_loc_pred
                 total_accuracy = (report_state_correct + report_loc_correct) / (report_state_pred + report_loc_pred)
+                elapsed_time = time.time() - start_time
+                wait_time = train_batch.wait_time - report_wait_time
 
                 output('*' * 50)
                 output(f'{batch_cnt}/{total_batches}, Epoch {epoch_i+1}:\n'
@@ -215,146 +476,183 @@ def train():
                        f'Total Accuracy: {total_accuracy*100:.3f}%, '
                        f'State Prediction Accuracy: {state_accuracy*100:.3f}%, '
                        f'Location Accuracy: {loc_accuracy*100:.3f}% \n'
-                       f'Time Elapse: {time.time()-start_time:.2f}s')
+                       f'Time Elapse: {elapsed_time:.2f}s, '
+                       f'Data Wait: {wait_time:.2f}s ({wait_time / elapsed_time * 100:.1f}%)')
                 output('-' * 50)
 
-                model.eval()
-                eval_score = evaluate(dev_set, model)
-                model.train()
-
-                if eval_score > best_score:  # new best score
-                    best_score = eval_score
-                    impatience = 0
-                    output('New best score!')
-                    if opt.save_mode == 'all':
-                        save_model(os.path.join(opt.ckpt_dir, f'best_checkpoint_{best_score:.3f}.pt'), model)
-                    elif opt.save_mode == 'best':
-                        save_model(os.path.join(opt.ckpt_dir, f'best_checkpoint.pt'), model)
-                else:
-                    impatience += 1
-                    output(f'Impatience: {impatience}, best score: {best_score:.3f}.')
-                    if opt.save_mode == 'all':
-                        save_model(os.path.join(opt.ckpt_dir, f'checkpoint_{eval_score:.3f}.pt'), model)
-                    if impatience >= opt.impatience:
-                        output('Early Stopping!')
-                        quit()
+                with profiler.phase('evaluation'):
+                    if evaluator is not None:
+                        evaluator.submit(model, name = f'{batch_cnt}/{total_batches}, Epoch {epoch_i+1}')
+                    elif rank == 0:
+                        model.eval()
+                        eval_score = evaluate(dev_set, model)
+                        model.train()
+                        stop_training = score_tracker.update(eval_score, model)
 
                 report_state_loss, report_loc_loss = 0, 0
                 report_state_correct, report_state_pred = 0, 0
                 report_loc_correct, report_loc_pred = 0, 0
+                report_state_tokens, report_loc_tokens = 0, 0
                 start_time = time.time()
-
+                report_wait_time = train_batch.wait_time
+
+            # in distributed training, rank 0 only decides to stop at the batches that report, and broadcasts the decision
+            # there, so all processes stop at the same batch
+            check_stop = not distributed or batch_cnt in report_batch
+            if evaluator is not None and not stop_training and check_stop:
+                stop_training = handle_async_results(evaluator, score_tracker, model)
+            if distributed and check_stop:
+                stop_training = broadcast_flag(stop_training)
+            if stop_training:
+                break
+
+            if opt.state_interval > 0 and (batch_cnt % opt.state_interval == 0 or batch_cnt == total_batches):
+                while evaluator is not None and evaluator.pending and not stop_training:  # the saved best score should be up to date
+                    stop_training = handle_async_results(evaluator, score_tracker, model, block = True)
+                if stop_training:
+                    break
+                report = (report_state_loss, report_loc_loss, report_state_correct, report_state_pred, report_loc_correct,
+                          report_loc_pred, report_state_tokens, report_loc_tokens)
+                # written after the checkpoints queued before, so the best checkpoint matches the saved best score
+                save_training_state(get_training_state(model, optimizer, report, epoch = epoch_i, batch_cnt = batch_cnt,
+                                                       epoch_rng_state = epoch_rng_state, best_score = score_tracker.best_score,
+                                                       impatience = score_tracker.impatience), opt.ckpt_dir, score_tracker.writer)
+            profiler.step()
+
+        if profiler.enabled:
+            output(profiler.report(f'Training profile, epochs 1-{epoch_i + 1}'))
         epoch_i += 1
 
-
         # summary(model, char_paragraph, entity_mask, verb_mask, loc_mask)
         # with SummaryWriter() as writer:
         #     writer.add_graph(model, (char_paragraph, entity_mask, verb_mask, loc_mask, gold_loc_mask, gold_state_mask))
 
+    if evaluator is not None:  # wait for the last rounds, unless training stopped early
+        while evaluator.pending and not stop_training:
+            stop_training = handle_async_results(evaluator, score_tracker, model, block = True)
+        evaluator.close(discard_pending = stop_training)
+    score_tracker.writer.close()
+    profiler.close()
+
+    return score_tracker.best_score
+
+
+def train_process(local_rank: int, main_opt: argparse.Namespace, log_path: str):
+    """
+    Entry of a process of distributed training, spawned by the main process of each machine.
+    """
+    global opt, log_file
+    opt = main_opt
+    init_distributed(rank = opt.node_rank * opt.nproc + local_rank, world_size = opt.nnodes * opt.nproc,
+                     master_addr = opt.master_addr, master_port = opt.master_port)
+    torch.set_num_threads(max(1, os.cpu_count() // opt.nproc))  # the processes share the CPU cores of the machine
+    if not opt.no_cuda:
+        torch.cuda.set_device(local_rank % torch.cuda.device_count())
+    if dist.get_rank() == 0 and log_path:
+        log_file = open(log_path, 'a', encoding='utf-8')
 
-def evaluate(dev_set, model):
-    dev_batch = DataLoader(dataset = dev_set, batch_size = opt.batch_size, shuffle = False, collate_fn = Collate())
+    train()
+    dist.destroy_process_group()
+    if log_file is not None:  # spawned processes exit without flushing their files
+        log_file.close()
 
-    start_time = time.time()
-    report_state_loss, report_loc_loss = 0, 0
-    report_state_correct, report_state_pred = 0, 0
-    report_loc_correct, report_loc_pred = 0, 0
 
-    with torch.no_grad():
-        for batch in dev_batch:
+def train_trial(trial_opt: argparse.Namespace, resources: Dict) -> float:
+    """
+    Train the model of a trial of sweep mode with its options, in a process of the sweep pool,
+    from the datasets and Elmo shared by the sweep.
+    """
+    global opt
+    opt = trial_opt
+    return train(resources)
 
-            paragraphs = batch['paragraph']
-            char_paragraph = batch_to_ids(paragraphs)
-            entity_mask = batch['entity_mask']
-            verb_mask = batch['verb_mask']
-            loc_mask = batch['loc_mask']
-            gold_loc_seq = batch['gold_loc_seq']
-            gold_state_seq = batch['gold_state_seq']
-            metadata = batch['metadata']
-            num_cands = torch.IntTensor([meta['total_loc_cands'] for meta in metadata])
 
-            if not opt.no_cuda:
-                char_paragraph = char_paragraph.cuda()
-                entity_mask = entity_mask.cuda()
-                verb_mask = verb_mask.cuda()
-                loc_mask = loc_mask.cuda()
-                gold_loc_seq = gold_loc_seq.cuda()
-                gold_state_seq = gold_state_seq.cuda()
-                num_cands = num_cands.cuda()
-
-            eval_result = model(char_paragraph = char_paragraph, entity_mask = entity_mask, verb_mask = verb_mask,
-                                loc_mask = loc_mask, gold_loc_seq = gold_loc_seq, gold_state_seq = gold_state_seq,
-                                num_cands = num_cands)
-
-            eval_state_loss, eval_loc_loss, eval_state_correct, eval_state_pred, \
-                eval_loc_correct, eval_loc_pred = eval_result
-
-            report_state_loss += eval_state_loss.item() * eval_state_pred
-            report_loc_loss += eval_loc_loss.item() * eval_loc_pred
-            report_state_correct += eval_state_correct
-            report_state_pred += eval_state_pred
-            report_loc_correct += eval_loc_correct
-            report_loc_pred += eval_loc_pred
-
-    state_loss = report_state_loss / report_state_pred  # average over all elements
-    loc_loss = report_loc_loss / report_loc_pred
-    total_loss = state_loss + opt.loc_loss * loc_loss
-    total_accuracy = (report_state_correct + report_loc_correct) / (report_state_pred + report_loc_pred)
-    state_accuracy = report_state_correct / report_state_pred
-    loc_accuracy = report_loc_correct / report_loc_pred
-
-    output(f'\tEvaluation:\n'
-           f'\tLoss: {total_loss:.3f}, State Loss: {state_loss:.3f}, '
-           f'Location Loss: {loc_loss:.3f}\n'
-           f'\tTotal Accuracy: {total_accuracy * 100:.3f}%, '
-           f'State Prediction Accuracy: {state_accuracy * 100:.3f}%, '
-           f'Location Accuracy: {loc_accuracy * 100:.3f}% \n'
-           f'\tTime Elapse: {time.time() - start_time:.2f}s')
+def get_profiler(enabled: bool) -> PhaseProfiler:
+    return PhaseProfiler(enabled = enabled, cuda = not opt.no_cuda, trace_path = opt.profile_trace,
+                         trace_start = opt.trace_start, trace_steps = opt.trace_steps)
+
+
+def evaluate(dev_set, model):
+    return report_evaluation(run_evaluation(dev_set, model, opt))
+
+
+def report_evaluation(result: Dict, name: str = None) -> float:
+    """
+    Print the result of run_evaluation, return the dev score.
+    """
+    output(f'\tEvaluation{" of " + name if name else ""}:\n'
+           f'\tLoss: {result["total_loss"]:.3f}, State Loss: {result["state_loss"]:.3f}, '
+           f'Location Loss: {result["loc_loss"]:.3f}\n'
+           f'\tTotal Accuracy: {result["total_accuracy"] * 100:.3f}%, '
+           f'State Prediction Accuracy: {result["state_accuracy"] * 100:.3f}%, '
+           f'Location Accuracy: {result["loc_accuracy"] * 100:.3f}% \n'
+           f'\tTime Elapse: {result["time"]:.2f}s, Data Wait: {result["data_wait"]:.2f}s')
     output('*' * 50)
 
-    return total_accuracy * 100
+    return result['total_accuracy'] * 100
+
 
+def handle_async_results(evaluator: AsyncEvaluator, score_tracker: ScoreTracker, model: nn.Module, block: bool = False) -> bool:
+    """
+    Handle the dev scores of the finished rounds of asynchronous evaluation. Return whether training should stop early.
+    """
+    for name, result, snapshot in evaluator.poll(block = block):
+        eval_score = report_evaluation(result, name = name)
+        if score_tracker.update(eval_score, model, snapshot):
+            return True
+    return False
 
-def test(test_set, model):
+
+def test(test_set, model, write_prediction: bool = True, lazy_loc: bool = False, loc_topk: int = 0,
+         kept_loc_only: bool = False) -> Dict:
 
     print('[INFO] Start testing...')
-    test_batch = DataLoader(dataset = test_set, batch_size = opt.batch_size, shuffle = False, collate_fn = Collate())
+    # lazy location scoring only predicts the locations at the steps with a C or M state, kept by predict_consistent_loc
+    kept_loc_only = kept_loc_only or lazy_loc
+    test_batch = get_batches(test_set)
+    profiler = model.profiler = get_profiler(enabled = opt.profile and write_prediction)  # the run of the final predictions
 
     start_time = time.time()
     report_state_correct, report_state_pred = 0, 0
     report_loc_correct, report_loc_pred = 0, 0
+    model_time = 0
     output_result = {}
+    all_predictions = []
+    scored_loc_pairs, total_loc_pairs = 0, 0
+    profiled_wait_time = 0
 
     with torch.no_grad():
         for batch in test_batch:
 
-            paragraphs = batch['paragraph']
-            char_paragraph = batch_to_ids(paragraphs)
-            entity_mask = batch['entity_mask']
-            verb_mask = batch['verb_mask']
-            loc_mask = batch['loc_mask']
             gold_loc_seq = batch['gold_loc_seq']
             gold_state_seq = batch['gold_state_seq']
             metadata = batch['metadata']
-            num_cands = torch.IntTensor([meta['total_loc_cands'] for meta in metadata])
-
-            if not opt.no_cuda:
-                char_paragraph = char_paragraph.cuda()
-                entity_mask = entity_mask.cuda()
-                verb_mask = verb_mask.cuda()
-                loc_mask = loc_mask.cuda()
-                gold_loc_seq = gold_loc_seq.cuda()
-                gold_state_seq = gold_state_seq.cuda()
-                num_cands = num_cands.cuda()
-
-            test_result = model(char_paragraph=char_paragraph, entity_mask=entity_mask, verb_mask=verb_mask,
-                                loc_mask=loc_mask, gold_loc_seq=gold_loc_seq, gold_state_seq=gold_state_seq,
-                                num_cands=num_cands)
-
-            pred_state_seq, pred_loc_seq, test_state_correct, test_state_pred,\
-                test_loc_correct, test_loc_pred = test_result
-
-            batch_size = len(paragraphs)
+            num_cands = batch['num_cands']
+            profiler.add('data wait', test_batch.wait_time - profiled_wait_time)
+            profiler.add('batch_to_ids', test_batch.char_ids_time, background = True)
+            profiled_wait_time = test_batch.wait_time
+
+            # gold sequences are only used for the accuracy report, not by the model
+            model_start_time = time.time()
+            pred_state_seq, pred_loc_seq = model.predict(char_paragraph=batch['char_paragraph'], entity_mask=batch['entity_mask'],
+                                                         verb_mask=batch['verb_mask'], loc_mask=batch['loc_mask'],
+                                                         num_cands=num_cands, num_sents=batch['num_sents'],
+                                                         lazy_loc=lazy_loc, loc_topk=loc_topk, reset_states=opt.stateless_elmo)
+            model_time += time.time() - model_start_time
+            scored_cands = torch.clamp(num_cands, max=loc_topk) if loc_topk > 0 else num_cands
+            if lazy_loc:
+                scored_cands = scored_cands[find_loc_steps(pred_state_seq).any(dim=-1)]
+            total_loc_pairs += torch.sum(num_cands).item()
+            scored_loc_pairs += torch.sum(scored_cands).item()
+            test_state_correct, test_state_pred = compute_state_accuracy(pred=pred_state_seq, gold=gold_state_seq,
+                                                                         pad_value=PAD_STATE)
+            test_loc_correct, test_loc_pred = compute_loc_pred_accuracy(pred=pred_loc_seq, gold=gold_loc_seq,
+                                                                        step_mask=find_loc_steps(pred_state_seq) if kept_loc_only else None)
+            pred_state_seq = [unpad(inst, pad_value=PAD_STATE) for inst in pred_state_seq.tolist()]
+            pred_loc_seq = [unpad(inst, pad_value=PAD_LOC) for inst in pred_loc_seq.tolist()]
+            all_predictions.extend(zip(pred_state_seq, pred_loc_seq))
+
+            batch_size = len(metadata)
             for i in range(batch_size):
                 pred_instance = get_output(metadata = metadata[i], pred_state_seq = pred_state_seq[i], pred_loc_seq = pred_loc_seq[i])
                 para_id = pred_instance['id']
@@ -365,24 +663,52 @@ def test(test_set, model):
             report_state_pred += test_state_pred
             report_loc_correct += test_loc_correct
             report_loc_pred += test_loc_pred
-
-    total_accuracy = (report_state_correct + report_loc_correct) / (report_state_pred + report_loc_pred)
-    state_accuracy = report_state_correct / report_state_pred
-    loc_accuracy = report_loc_correct / report_loc_pred
-
-    output(f'Test:\n'
-           f'Total Accuracy: {total_accuracy * 100:.3f}%, '
-           f'State Prediction Accuracy: {state_accuracy * 100:.3f}%, '
-           f'Location Accuracy: {loc_accuracy * 100:.3f}%')
-
-    write_output(output = output_result, dummy_filepath = opt.dummy_test, output_filepath = opt.output)
-    print(f'[INFO] Test finished. Time elapse: {time.time() - start_time}s')
+            profiler.step()
+
+    model.profiler = PhaseProfiler(enabled = False)
+    profiler.close()
+    result = {'model_time': model_time, 'latency': model_time / len(test_set) * 1000,
+              'throughput': len(test_set) / model_time, 'predictions': all_predictions,
+              'scored_loc_pairs': scored_loc_pairs / max(total_loc_pairs, 1) * 100}
+    if lazy_loc or loc_topk > 0:
+        print(f'[INFO] LocationPredictor ran on {scored_loc_pairs} of {total_loc_pairs} (entity, candidate) pairs, '
+              f'skipped {(1 - scored_loc_pairs / max(total_loc_pairs, 1)) * 100:.1f}%')
+    if report_state_pred > 0:  # unlabeled data has no gold sequence to compare with
+        total_accuracy = (report_state_correct + report_loc_correct) / (report_state_pred + report_loc_pred)
+        state_accuracy = report_state_correct / report_state_pred
+        loc_accuracy = report_loc_correct / max(report_loc_pred, 1)
+
+        output(f'Test:\n'
+               f'Total Accuracy: {total_accuracy * 100:.3f}%, '
+               f'State Prediction Accuracy: {state_accuracy * 100:.3f}%, '
+               f'Location Accuracy{" (C/M steps)" if kept_loc_only else ""}: {loc_accuracy * 100:.3f}%')
+        result.update({'total_accuracy': total_accuracy * 100, 'state_accuracy': state_accuracy * 100,
+                       'loc_accuracy': loc_accuracy * 100})
+
+    if write_prediction:
+        write_output(output = output_result, dummy_filepath = opt.dummy_test, output_filepath = opt.output)
+    result['total_time'] = time.time() - start_time
+    result['data_wait'] = test_batch.wait_time
+    print(f'[INFO] Test finished. Time elapse: {result["total_time"]}s, '
+          f'data wait: {result["data_wait"]:.2f}s ({result["data_wait"] / result["total_time"] * 100:.1f}%)')
+    if profiler.enabled:
+        print(profiler.report('Test profile'))
+    return result
 
 
 if __name__ == "__main__":
 
     if opt.mode == 'train':
-        train()
+        if opt.nproc * opt.nnodes > 1:
+            if log_file is not None:
+                log_file.flush()
+            torch.multiprocessing.spawn(train_process, args = (opt, log_file.name if log_file is not None else None),
+                                        nprocs = opt.nproc)
+        else:
+            train()
+
+    elif opt.mode == 'sweep':
+        sweep(opt, parser, train_trial, output)
 
     elif opt.mode == 'test':
         if not opt.restore:
@@ -408,13 +734,45 @@ if __name__ == "__main__":
 
         print('[INFO] Start loading trained model...')
         restore_start_time = time.time()
-        model = NCETModel(opt = opt, is_test = True)
-        model_state_dict = torch.load(opt.restore)
-        model.load_state_dict(model_state_dict)
+        model = restore_model(opt, opt.restore)
         model.eval()
-        print(f'[INFO] Loaded model from {opt.restore}, time elapse: {time.time() - restore_start_time}s')
+        print(f'[INFO] Loaded model from {opt.restore}, time elapse: {time.time() - restore_start_time}s, '
+              f'peak RSS: {peak_rss():.0f}MB')
+        if opt.elmo_cache:
+            cache_elmo_words(model, test_set.vocabulary())
+
+        if opt.quantize == 'dynamic' and opt.precision != 'fp32':
+            raise RuntimeError("-quantize and -precision cannot be used together")
+        test_fn = functools.partial(test, lazy_loc = opt.lazy_loc, loc_topk = opt.loc_topk)
+
+        if opt.quantize == 'dynamic':
+            # quantized kernels only run on CPU, the float model is evaluated first as a reference
+            opt.no_cuda = True
+            compare_with_float(test_fn, test_set, model, optimize_fn = quantize_model, optimized_name = 'int8')
+
+        elif opt.precision == 'bf16':
+            # reduced precision targets CPU inference, the fp32 model is evaluated first as a reference
+            check_bfloat16_support()
+            opt.no_cuda = True
+            compare_with_float(test_fn, test_set, model, optimize_fn = convert_to_bfloat16, optimized_name = 'bf16')
+
+        elif opt.lazy_loc or opt.loc_topk > 0:
+            if not opt.no_cuda:
+                model.cuda()
+            if opt.loc_topk > 0:
+                report_candidate_pruning(test_set, model)
+            # full location scoring is evaluated first as a reference of the time saving
+            print('[INFO] Evaluating with full location scoring as reference...')
+            model.EmbeddingLayer.reset_states()
+            # with -lazy_loc, both runs only score the locations at the C and M steps
+            full_result = test(test_set, model, write_prediction = False, kept_loc_only = opt.lazy_loc)
+            model.EmbeddingLayer.reset_states()  # start from the same Elmo states
+            fast_result = test_fn(test_set, model)
+            fast_name = '+'.join(['lazy'] * opt.lazy_loc + [f'top{opt.loc_topk}'] * (opt.loc_topk > 0))
+            print_comparison('full', full_result, fast_name, fast_result)
 
-        if not opt.no_cuda:
-            model.cuda()
+        else:
+            if not opt.no_cuda:
+                model.cuda()
 
-        test(test_set, model)
\ No newline at end of file
+            test(test_set, model)
\ No newline at end of file
@@ -0,0 +1,54 @@
+import os
+import torch
+import torch.nn as nn
+from typing import Dict, Iterator, Tuple
+from utils import get_rng_states, set_rng_states
+from checkpoint import slim_checkpoint, clone_tensors, load_model_state, CheckpointWriter
+
+
+def get_training_state(model: nn.Module, optimizer: torch.optim.Optimizer, report: Tuple, **counters) -> Dict:
+    """
+    The full training state: model, optimizer, the LSTM states Elmo carries between batches, all random states,
+    the report accumulators and the counters of the training loop (epoch, batch, best score, ...).
+    The model is a slim checkpoint, without the frozen Elmo weights, which are loaded from -elmo_dir again on -resume.
+    The tensors are cloned so the state can be written in the background. The accumulators may be tensors
+    on the device of the model, they are saved as python numbers.
+    """
+    return {'model': slim_checkpoint(model), 'optimizer': clone_tensors(optimizer.state_dict()),
+            'elmo_states': clone_tensors(model.EmbeddingLayer.get_states()), 'rng_states': get_rng_states(),
+            'report': tuple(value.item() if torch.is_tensor(value) else value for value in report), **counters}
+
+
+def save_training_state(state: Dict, ckpt_dir: str, writer: CheckpointWriter):
+    """
+    Save the training state to ckpt_dir, in the background. The state is written to a temporary file first,
+    so a run preempted while writing still has the previous state.
+    """
+    if not os.path.exists(ckpt_dir):
+        os.mkdir(ckpt_dir)
+
+    writer.save(state, os.path.join(ckpt_dir, 'training_state.pt'))
+
+
+def load_training_state(ckpt_dir: str, model: nn.Module, optimizer: torch.optim.Optimizer) -> Dict:
+    """
+    Restore the model, the optimizer and the Elmo states from the training state saved in ckpt_dir,
+    and return the state for the training loop to continue from.
+    """
+    state_path = os.path.join(ckpt_dir, 'training_state.pt')
+    state = torch.load(state_path, map_location = 'cpu')
+    load_model_state(model, state['model'], name = state_path)
+    optimizer.load_state_dict(state['optimizer'])
+    model.EmbeddingLayer.set_states(state['elmo_states'])
+    return state
+
+
+def skip_trained_batches(batches: Iterator, state: Dict):
+    """
+    Skip the batches of the epoch trained before the state was saved, then restore the random states of that moment.
+    The torch random state should be set to state['epoch_rng_state'] before batches is created, so the shuffled
+    data order of the epoch is replayed.
+    """
+    for _ in range(state['batch_cnt']):
+        next(batches)
+    set_rng_states(state['rng_states'])
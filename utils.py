@@ -6,8 +6,16 @@
 '''
 
 import json
+import os
+import random
+import importlib
+import sys
 import torch
-from typing import List
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.utils.checkpoint import checkpoint
+from typing import List, Dict
 import numpy as np
 from Constants import *
 import re
@@ -84,6 +92,83 @@ def count_average():
     load_data('./data/test.json')
 
 
+def write_jsonl_shards(json_file: str, output_dir: str, num_shards: int):
+    """
+    Convert a JSON split (a list of instances) into JSONL shards, one instance per line.
+    The shards can be read by ProparaIterableDataset without loading the whole split into memory.
+    Instances are distributed round-robin, so the shards have (almost) equal sizes.
+    """
+    data = json.load(open(json_file, 'r', encoding='utf-8'))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    prefix = os.path.splitext(os.path.basename(json_file))[0]
+    shard_files = [open(os.path.join(output_dir, f'{prefix}-{shard_i:05d}.jsonl'), 'w', encoding='utf-8')
+                   for shard_i in range(num_shards)]
+
+    for idx, instance in enumerate(data):
+        shard_files[idx % num_shards].write(json.dumps(instance) + '\n')
+
+    for shard_file in shard_files:
+        shard_file.close()
+    print(f'[INFO] Wrote {len(data)} instances from {json_file} to {num_shards} shard(s) in {output_dir}')
+
+
+def convert_word_vectors(text_file: str, output_file: str):
+    """
+    Convert word vectors in text format (one word and its vector per line, e.g. GloVe or fastText .vec)
+    to the format used by the static embedding backend: a float32 .npy matrix that can be memory-mapped,
+    and a .vocab file next to it with one word per line, in the same order.
+    The matrix is written through a memory map, so the vectors never need to fit in memory.
+    """
+    def read_lines():
+        with open(text_file, 'r', encoding='utf-8') as fin:
+            for line in fin:
+                fields = line.rstrip().split(' ')
+                if len(fields) > 2:  # skip the "num_words dim" header of fastText files
+                    yield fields
+
+    dim = len(next(read_lines())) - 1
+    num_words = sum(1 for fields in read_lines() if len(fields) > dim)
+
+    vectors = np.lib.format.open_memmap(output_file, mode='w+', dtype=np.float32, shape=(num_words, dim))
+    with open(os.path.splitext(output_file)[0] + '.vocab', 'w', encoding='utf-8') as vocab_file:
+        idx = 0
+        for fields in read_lines():
+            if len(fields) <= dim:
+                continue
+            vectors[idx] = np.asarray(fields[-dim:], dtype=np.float32)
+            vocab_file.write(' '.join(fields[:-dim]) + '\n')  # some words in GloVe 840B contain spaces
+            idx += 1
+    vectors.flush()
+    print(f'[INFO] Converted {num_words} word vectors of size {dim} from {text_file} to {output_file}')
+
+
+def batch_to_char_ids(batch: List[List[str]], max_word_length: int = 50) -> torch.Tensor:
+    """
+    Convert tokenized paragraphs to Elmo character ids, same as allennlp's "batch_to_ids",
+    so that the exported model can be served without allennlp.
+    Each word is encoded in utf-8 and wrapped with begin-of-word and end-of-word characters,
+    all ids are shifted by 1 to reserve 0 for padding.
+    Return:
+        character ids, size (batch, max_tokens, max_word_length)
+    """
+    bow_char, eow_char, pad_char = 258, 259, 260
+    max_tokens = max(len(paragraph) for paragraph in batch)
+    char_ids = torch.zeros(len(batch), max_tokens, max_word_length, dtype = torch.long)
+
+    for i, paragraph in enumerate(batch):
+        for j, word in enumerate(paragraph):
+            if word == '<S>' or word == '</S>':  # sentence boundary tokens have their own character ids
+                word_ids = [bow_char, 256 if word == '<S>' else 257, eow_char]
+            else:
+                word_ids = [bow_char] + list(word.encode('utf-8', 'ignore')[:max_word_length - 2]) + [eow_char]
+            word_ids += [pad_char] * (max_word_length - len(word_ids))
+            char_ids[i, j] = torch.LongTensor(word_ids) + 1
+
+    return char_ids
+
+
 def find_allzero_rows(vector: torch.IntTensor) -> torch.BoolTensor:
     """
     Find all-zero rows of a given tensor, which is of size (batch, max_sents, max_tokens).
@@ -97,22 +182,121 @@ def find_allzero_rows(vector: torch.IntTensor) -> torch.BoolTensor:
     return column_sum == 0
 
 
-def compute_state_accuracy(pred: List[List[int]], gold: List[List[int]], pad_value: int) -> (int, int):
+def count_tokens(char_paragraph: torch.Tensor) -> torch.Tensor:
     """
-    Given the predicted tags and gold tags, compute the prediction accuracy.
-    Note that we first need to deal with the padded parts of the gold tags.
+    Count the number of real tokens of each paragraph from the character ids generated by "batch_to_ids".
+    Padded tokens are all-zero character vectors.
+    Args:
+        char_paragraph - size (batch, max_tokens, max_chars)
+    Return:
+        number of tokens, size (batch,)
+    """
+    token_mask = torch.sum(torch.gt(char_paragraph, 0), dim = -1) > 0  # (batch, max_tokens)
+    return torch.sum(token_mask, dim = -1)
+
+
+def get_length_mask(lengths: torch.Tensor, max_len: int) -> torch.BoolTensor:
+    """
+    Build a mask from sequence lengths.
+    Args:
+        lengths - size (batch,)
+    Return:
+        a BoolTensor of size (batch, max_len), where the first lengths[i] positions of row i are True
+    """
+    positions = torch.arange(max_len, device = lengths.device).unsqueeze(dim = 0)
+    return torch.lt(positions, lengths.unsqueeze(dim = -1).long())
+
+
+def run_packed_lstm(lstm: torch.nn.LSTM, inputs: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+    """
+    Run a batch_first LSTM only over the valid timesteps of each sequence,
+    so that padding neither costs computation nor leaks into the backward direction.
+    Args:
+        inputs - size (batch, max_len, input_size)
+        lengths - number of valid timesteps of each sequence, all should be positive, size (batch,)
+    Return:
+        outputs - size (batch, max_len, num_directions * hidden_size), padded timesteps are all-zero
+    """
+    packed_inputs = pack_padded_sequence(inputs, lengths.cpu().long(), batch_first = True, enforce_sorted = False)
+    packed_outputs, _ = lstm(packed_inputs)
+    outputs, _ = pad_packed_sequence(packed_outputs, batch_first = True, total_length = inputs.size(1))
+    return outputs
+
+
+def viterbi_decode(emissions: torch.Tensor, mask: torch.Tensor, start_transitions: torch.Tensor,
+                   transitions: torch.Tensor, end_transitions: torch.Tensor, pad_value: int) -> torch.Tensor:
+    """
+    Tensorized Viterbi decoding of a linear-chain CRF. Written in TorchScript-compatible code.
+    Args:
+        emissions - emission scores, size (seq_len, batch, num_tags)
+        mask - BoolTensor of size (seq_len, batch), the first timestep of each sequence must be unmasked
+        start_transitions, transitions, end_transitions - CRF parameters, same as torchcrf.CRF
+        pad_value - tag of the masked timesteps
+    Return:
+        best tag sequences padded with pad_value, size (seq_len, batch)
     """
-    assert len(pred) == len(gold)
-    unpad_gold = [unpad(li, pad_value = pad_value) for li in gold]
-    correct_pred = 0
-    total_pred = 0
+    seq_len, batch_size = mask.size(0), mask.size(1)
 
-    for i in range(len(pred)):
-        assert len(pred[i]) == len(unpad_gold[i])
-        total_pred += len(pred[i])
-        correct_pred += np.sum(np.equal(pred[i], unpad_gold[i]))
+    # forward recursion, same as CRF._viterbi_decode
+    score = start_transitions + emissions[0]  # (batch, num_tags)
+    history = torch.jit.annotate(List[torch.Tensor], [])
+    for i in range(1, seq_len):
+        next_score = score.unsqueeze(dim = 2) + transitions + emissions[i].unsqueeze(dim = 1)
+        next_score, indices = next_score.max(dim = 1)  # best previous tag for each current tag
+        score = torch.where(mask[i].unsqueeze(dim = 1), next_score, score)
+        history.append(indices)
+    score = score + end_transitions
+    _, best_last_tag = score.max(dim = 1)  # (batch,)
 
-    return correct_pred.item(), total_pred
+    # backtrack all sequences together, each one starts from its own last valid timestep
+    seq_ends = mask.long().sum(dim = 0) - 1  # (batch,)
+    best_tags = torch.full((seq_len, batch_size), pad_value, dtype = torch.long, device = emissions.device)
+    cur_tag = best_last_tag
+    for i in range(seq_len - 1, -1, -1):
+        cur_tag = torch.where(seq_ends == i, best_last_tag, cur_tag)
+        best_tags[i] = torch.where(seq_ends >= i, cur_tag, best_tags[i])
+        if i > 0:
+            cur_tag = history[i - 1].gather(dim = 1, index = cur_tag.unsqueeze(dim = 1)).squeeze(dim = 1)
+
+    return best_tags
+
+
+def checkpoint_block(block, *inputs: torch.Tensor):
+    """
+    Run block(*inputs) with activation checkpointing.
+    torch.utils.checkpoint only backpropagates into the parameters of the block if one of its inputs requires grad,
+    which is not the case for the output of the frozen Elmo, so a dummy input that requires grad is added then.
+    """
+    if any(inp.requires_grad for inp in inputs):
+        return checkpoint(block, *inputs)
+
+    dummy = torch.ones(1, requires_grad=True)
+    return checkpoint(lambda _, *block_inputs: block(*block_inputs), dummy, *inputs)
+
+
+def find_loc_steps(pred_state_seq: torch.Tensor) -> torch.BoolTensor:
+    """
+    Find the steps whose location prediction is used in the final output, i.e. the predicted state is C or M.
+    Args:
+        pred_state_seq - size (batch, max_sents)
+    """
+    return torch.eq(pred_state_seq, state2idx['C']) | torch.eq(pred_state_seq, state2idx['M'])
+
+
+def compute_state_accuracy(pred: torch.Tensor, gold: torch.Tensor, pad_value: int) -> (int, int):
+    """
+    Given the predicted tags and gold tags, compute the prediction accuracy.
+    Both are padded with pad_value, and padded positions do not count.
+    Args:
+        pred - size (batch, max_sents)
+        gold - size (batch, max_sents)
+    """
+    assert pred.size() == gold.size()
+    is_valid = (gold != pad_value)
+    total_pred = torch.sum(is_valid)
+    correct_pred = torch.sum((pred == gold.long()) & is_valid)
+
+    return correct_pred.item(), total_pred.item()
 
 
 def compute_loc_accuracy(logits: torch.FloatTensor, gold: torch.IntTensor, pad_value: int) -> (int, int):
@@ -132,6 +316,25 @@ def compute_loc_accuracy(logits: torch.FloatTensor, gold: torch.IntTensor, pad_v
     return correct_pred.item(), total_pred.item()
 
 
+def compute_loc_pred_accuracy(pred: torch.Tensor, gold: torch.Tensor, step_mask: torch.BoolTensor = None) -> (int, int):
+    """
+    Given the predicted location indices and the gold location sequence, compute the location prediction accuracy.
+    Undefined gold locations (NIL, UNK, PAD) are all negative and do not count.
+    Args:
+        pred - size (batch, max_sents)
+        gold - size (batch, max_sents)
+        step_mask - if given, only the steps where it is True count (e.g. find_loc_steps), size (batch, max_sents)
+    """
+    assert pred.size() == gold.size()
+    is_valid = torch.ge(gold, 0)
+    if step_mask is not None:
+        is_valid = is_valid & step_mask
+    total_pred = torch.sum(is_valid)
+    correct_pred = torch.sum((pred == gold.long()) & is_valid)
+
+    return correct_pred.item(), total_pred.item()
+
+
 def get_pred_loc(loc_logits: torch.Tensor, gold_loc_seq: torch.IntTensor) -> List[List[int]]:
     """
     Get the predicted location sequence from raw logits.
@@ -152,6 +355,80 @@ def get_pred_loc(loc_logits: torch.Tensor, gold_loc_seq: torch.IntTensor) -> Lis
     return pred_loc
 
 
+def get_rng_states() -> Dict:
+    """
+    States of all the random number generators used in training: python, numpy, torch on CPU and on every GPU.
+    """
+    return {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+
+def set_rng_states(states: Dict):
+    """
+    Restore the random number generator states returned by get_rng_states.
+    """
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+    if states['cuda']:
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+def init_distributed(rank: int, world_size: int, master_addr: str, master_port: int):
+    """
+    Join the process group of distributed training, with the gloo backend.
+    """
+    dist.init_process_group('gloo', init_method = f'tcp://{master_addr}:{master_port}', rank = rank, world_size = world_size)
+
+
+def broadcast_parameters(model: torch.nn.Module):
+    """
+    Copy the trainable parameters of process 0 to all processes of distributed training.
+    """
+    for param in model.parameters():
+        if param.requires_grad:
+            dist.broadcast(param.data, src = 0)
+
+
+def all_reduce_gradients(model: torch.nn.Module):
+    """
+    Average the gradients of the trainable parameters over all processes of distributed training,
+    in a single all-reduce of the flattened gradients. Missing gradients count as zeros.
+    """
+    params = [param for param in model.parameters() if param.requires_grad]
+    for param in params:
+        if param.grad is None:
+            param.grad = torch.zeros_like(param)
+    grads = [param.grad for param in params]
+
+    flat_grads = _flatten_dense_tensors(grads)
+    dist.all_reduce(flat_grads)
+    flat_grads /= dist.get_world_size()
+    for grad, reduced_grad in zip(grads, _unflatten_dense_tensors(flat_grads, grads)):
+        grad.copy_(reduced_grad)
+
+
+def broadcast_flag(flag: bool) -> bool:
+    """
+    Return the value of the flag in process 0 of distributed training, so that all processes take the same decision.
+    """
+    flag_tensor = torch.IntTensor([int(flag)])
+    dist.broadcast(flag_tensor, src = 0)
+    return bool(flag_tensor.item())
+
+
+def peak_rss() -> float:
+    """
+    Peak resident memory of this process so far, in MB, or NaN where it is not available (Windows).
+    """
+    try:
+        import resource  # Unix only
+    except ImportError:
+        return float('nan')
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 1024  # in bytes on macOS, in KB on Linux
+
+
 def get_report_time(total_batches: int, report_times: int) -> List[int]:
     """
     Given the total number of batches in an epoch and the report times per epoch,
@@ -175,3 +452,23 @@ def unpad(source: List[int], pad_value: int) -> List[int]:
 def mean(source: List) -> float:
     return sum(source) / len(source)
 
+
+def require_torch(min_version: str, feature: str):
+    """
+    Raise an error if the installed PyTorch is older than min_version, which is needed by feature.
+    requirements.txt pins PyTorch 1.3.1, newer versions are only needed by optional features (see README).
+    """
+    from packaging import version
+    if version.parse(torch.__version__.split('+')[0]) < version.parse(min_version):
+        raise RuntimeError(f'{feature} needs PyTorch >= {min_version}, but PyTorch {torch.__version__} is installed')
+
+
+def import_optional(module_name: str, feature: str):
+    """
+    Import an optional dependency (see requirements-optional.txt), with an error naming the feature that needs it.
+    """
+    try:
+        return importlib.import_module(module_name)
+    except ImportError as error:
+        raise RuntimeError(f'{feature} needs {module_name}, install the optional dependencies by '
+                           f'"pip install -r requirements-optional.txt"') from error